@@ -10,6 +10,7 @@ KEY NOTE: Assumes all files are contiguous.  I sort the files by jd and then mat
 
 
 from ddr_compress.dbi import DataBaseInterface,gethostname,jdpol2obsnum
+from ddr_compress.checksum import ChecksumService
 import optparse,os,sys,re,numpy as n
 
 def file2jd(zenuv):
@@ -93,6 +94,10 @@ for night in nights:
     	print "adding {len} observations to the still db".format(len=len(obsinfo))
         #try:
         dbi.add_observations(obsinfo)
+        #record the checksums the stills verify their copies against
+        cs = ChecksumService(dbi,host=gethostname())
+        cs.checksum([obs['filename'] for obs in obsinfo])
+        cs.close()
         #except:
         print sys.exc_info()[0]
         print "problem!"
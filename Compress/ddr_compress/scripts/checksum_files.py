@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+"""
+Record the md5 checksums of datasets on this host in the still db, hashing
+the files of each Miriad dataset in parallel and skipping the ones whose
+checksums are already recorded.  With --verify, check a copy against the
+checksums recorded for its source: checksum_files.py --verify host:/path/zen.uv zen.uv
+Exits with 1 if the copy differs.
+"""
+from ddr_compress.dbi import DataBaseInterface,gethostname
+from ddr_compress.checksum import ChecksumService,dataset_md5
+import optparse,sys
+
+o = optparse.OptionParser()
+o.set_usage('checksum_files.py [options] *.uv')
+o.set_description(__doc__)
+o.add_option('--verify',
+        help='source (host:path) the single dataset given is a copy of.')
+o.add_option('--nthreads',type=int,default=4,
+        help='number of files hashed at once [default=4]')
+opts, args = o.parse_args(sys.argv[1:])
+dbi = DataBaseInterface()
+cs = ChecksumService(dbi,host=gethostname(),nthreads=opts.nthreads)
+if opts.verify is None:
+    checksums = cs.checksum(args)
+    for dataset in sorted(checksums):
+        print dataset_md5(checksums[dataset]),dataset
+    cs.close()
+else:
+    assert(len(args)==1)
+    bad = cs.verify(opts.verify,args[0])
+    cs.close()
+    if bad is None:
+        print "no checksums recorded for",opts.verify,"not verified"
+    elif len(bad)>0:
+        print "copy of",opts.verify,"differs in",' '.join(bad)
+        sys.exit(1)
@@ -1,6 +1,8 @@
 #! /bin/bash
 
 for file in $* ; do
-    rm -rf `python -c "import os; print os.path.basename('$file')"`
-    scp -r -c arcfour256 -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no $file .
+    base=`python -c "import os; print os.path.basename('$file')"`
+    rm -rf $base
+    scp -r -c arcfour256 -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no $file . || exit 1
+    checksum_files.py --verify $file $base || exit 1
 done
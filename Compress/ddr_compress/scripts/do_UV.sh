@@ -2,4 +2,5 @@
 
 rm -rf $1
 echo scp -r -c arcfour256 $2 .
-scp -r -c arcfour256 -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no $2 .
+scp -r -c arcfour256 -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no $2 . || exit 1
+checksum_files.py --verify $2 $1
@@ -1,4 +1,5 @@
 #! /bin/bash
 
-rm -rf $1c
-correct_psa128.py $1
+# $* may be a run of files, corrected in one process
+for f in $*; do rm -rf ${f}c; done
+correct_psa128.py $*
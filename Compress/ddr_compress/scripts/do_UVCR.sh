@@ -5,4 +5,6 @@ rm -rf $1R
 #xrfi_simple.py -a 1 --combine -t 80 --df=6 -c 0_65,377_388,510,770,840,852,913,921_922,932_934,942_1023 $1
 # XXX need to figure out why above command fails
 echo xrfi_simple.py -a 1 --df=6 -c ${FLAGCHANS} --combine -t 80 $1
-xrfi_simple.py -a 1 --df=6 -c ${FLAGCHANS} --combine -t 80 $1
+xrfi_simple.py -a 1 --df=6 -c ${FLAGCHANS} --combine -t 80 $1 || exit 1
+# record the checksums of $1R so that ACQUIRE_NEIGHBORS can verify its copies
+checksum_files.py $1R || echo checksums of $1R not recorded
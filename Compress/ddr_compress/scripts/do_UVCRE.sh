@@ -1,5 +1,7 @@
 #! /bin/bash
 
-rm -rf $2E
-echo ddr_filter_coarse.py -a 1 -p xx,xy,yx,yy --clean=1e-3 --maxbl=300 --output=ddr --invert $1 $2 $3
-ddr_filter_coarse.py -a 1 -p xx,xy,yx,yy --clean=1e-3 --maxbl=300 --output=ddr --invert $1 $2 $3
+# $* is a contiguous run of files led and trailed by their neighbors;
+# ddr_filter_coarse.py filters each file between the two around it
+if [ $# -gt 2 ]; then for f in ${@:2:$#-2}; do rm -rf ${f}E; done; fi
+echo ddr_filter_coarse.py -a 1 -p xx,xy,yx,yy --clean=1e-3 --maxbl=300 --output=ddr --invert $*
+ddr_filter_coarse.py -a 1 -p xx,xy,yx,yy --clean=1e-3 --maxbl=300 --output=ddr --invert $*
@@ -1,5 +1,6 @@
 #! /bin/bash
 
-rm -rf $2E
+# $* is a contiguous run of files led and trailed by their neighbors
+if [ $# -gt 2 ]; then for f in ${@:2:$#-2}; do rm -rf ${f}E; done; fi
 # XXX are we generating UVCRRE only, or D and F also?
-ddr_filter_coarse.py -a all -p xx,xy,yx,yy --maxbl=301 --clean=1e-3 --output=ddr --nsections=20 $1 $2 $3
+ddr_filter_coarse.py -a all -p xx,xy,yx,yy --maxbl=301 --clean=1e-3 --output=ddr --nsections=20 $*
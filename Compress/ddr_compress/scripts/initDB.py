@@ -1,7 +1,19 @@
 #!  /usr/bin/env python
+"""
+Create the still database, or bring one made by an earlier version up to
+date: adds any missing tables (such as status_change) and indexes, and
+builds the status_count table.  Existing data are kept.  Run this before deploying a
+new version of the still scripts.
+"""
 import optparse,sys,os
 from ddr_compress.dbi import DataBaseInterface
 
+o = optparse.OptionParser()
+o.set_usage('initDB.py')
+o.set_description(__doc__)
+opts, args = o.parse_args(sys.argv[1:])
+
 #open a connection to the db
 dbi = DataBaseInterface()
-#check that the tables 
+#create the tables and indexes that are missing
+dbi.createdb()
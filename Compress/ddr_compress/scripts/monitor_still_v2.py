@@ -26,6 +26,7 @@ colwidth = 50
 obslines = 20
 stat = ['\\','|','/','-','.']
 i =0
+last_change = -1
 try:
     while(1):
         #get the screen dimensions
@@ -43,15 +44,21 @@ try:
         curline = 2
         i +=1
         stdscr.addstr(0,30,stat[i%len(stat)])
-        s = dbi.Session()
-        totalobs = s.query(Observation).count()
+        # totals come from the status_count table; the observations being
+        # processed are only reread when a status has changed
+        counts = dbi.get_status_counts()
+        totalobs = sum([c[0] for c in counts.values()])
         stdscr.addstr(curline,0,"Number of observations currently in the database: {totalobs}".format(totalobs=totalobs))
         curline += 1
-        OBSs = s.query(Observation).filter(Observation.status!='UV_POT',Observation.status!='COMPLETE',Observation.currentpid>0).all()
-        POTCOUNT = s.query(Observation).filter(Observation.status=='UV_POT').count()
-        obsnums = [OBS.obsnum for OBS in OBSs]
-        obshosts = [OBS.stillhost for OBS in OBSs]
-        s.close()
+        POTCOUNT = counts.get('UV_POT',(0,0))[0]
+        change = dbi.get_last_change()
+        if change != last_change:
+            last_change = change
+            s = dbi.Session()
+            OBSs = s.query(Observation).filter(Observation.status!='UV_POT',Observation.status!='COMPLETE',Observation.currentpid>0).all()
+            obsnums = [OBS.obsnum for OBS in OBSs]
+            obshosts = [OBS.stillhost for OBS in OBSs]
+            s.close()
         hosts = list(set(obshosts))
         stdscr.addstr(curline,0,
         "Number of observations currently being processed: {num}".format(num=len(obsnums)));curline+=1
@@ -1,4 +1,12 @@
 #! /usr/bin/env python
+"""
+Schedule the still tasks of the observations in the database on the
+taskservers.  Before deploying a new version, run initDB.py against the
+database: it adds the tables and indexes this version relies on (e.g.
+status_change, which records every status and pid change) to a database
+created by an earlier version.  Without it, the first status update fails
+with "no such table".
+"""
 import ddr_compress as ddr,os,configparser
 import logging; logging.basicConfig(level=logging.DEBUG)
 import optparse
@@ -10,6 +18,12 @@ o.set_usage('qmaster_scheduler.py')
 o.set_description(__doc__)
 o.add_option('--taskservers',type='string',
         help='comma delimited list of host:port on which taskservers are running.  overrides config file')
+o.add_option('--event_driven',action='store_true',
+        help='follow status changes recorded in the database (pruned to the most recent, see dbi.prune_changes) instead of polling every observation each cycle.  Needs a database brought up to date by initDB.py.')
+o.add_option('--tcp',action='store_true',
+        help='send tasks over persistent tcp connections to taskservers started with --tcp, and receive task status from them')
+o.add_option('--max_run',type='int',default=1,
+        help='launch tasks that can take several files (UVC, UVCRE, UVCRRE) on runs of up to this many contiguous observations in one process.  Needs --tcp.  Default 1.')
 opts, args = o.parse_args(sys.argv[1:])
 
 #STILLS = ['still0', 'still1', 'still2', 'still3']
@@ -26,6 +40,10 @@ if os.path.exists(configfile):#todo config file an inputable thing above
     BLOCK_SIZE = int(config['scheduler']['block_size'])
     TIMEOUT = int(config['scheduler']['timeout'])
     SLEEPTIME = int(config['scheduler']['sleeptime'])
+    # cores and memory (MB) of each still, for packing tasks by their measured cost
+    if all([config.has_option(still,'cores') and config.has_option(still,'mem') for still in STILLS]):
+        STILL_RESOURCES = [(int(config[still]['cores']),float(config[still]['mem'])) for still in STILLS]
+    else: STILL_RESOURCES = None
     print STILLS,PORTS
 else:
     STILLS = ['still4', 'still5']
@@ -34,11 +52,13 @@ else:
     BLOCK_SIZE = 10 # number of files that are sent together to a still
     TIMEOUT = 600 # seconds; how long a task is allowed to be running before it is assumed to have failed
     SLEEPTIME = 1. # seconds; throttle on how often the scheduler polls the database
+    STILL_RESOURCES = None # list of (cores, memory in MB) per still; None for a fixed # of actions per still
 
 #--taskservers override from the command line
 if not opts.taskservers is None:
     STILLS=[]
     PORTS=[]
+    STILL_RESOURCES = None
     tmp = map(str,opts.taskservers.split(','))
     for t in tmp:
         still, port = t.strip().split(':')
@@ -46,6 +66,8 @@ if not opts.taskservers is None:
         PORTS.append(int(port))
 
 dbi = ddr.dbi.DataBaseInterface()
-task_clients = [ddr.task_server.TaskClient(dbi, s,port=p) for (s,p) in zip(STILLS,PORTS)]
-scheduler = ddr.task_server.Scheduler(task_clients, actions_per_still=ACTIONS_PER_STILL,blocksize=BLOCK_SIZE,nstills=len(STILLS))
-scheduler.start(dbi, ActionClass=ddr.task_server.Action, action_args=(task_clients,TIMEOUT), sleeptime=SLEEPTIME)
+if opts.tcp: TaskClient = ddr.task_server.StreamTaskClient
+else: TaskClient = ddr.task_server.TaskClient
+task_clients = [TaskClient(dbi, s,port=p) for (s,p) in zip(STILLS,PORTS)]
+scheduler = ddr.task_server.Scheduler(task_clients, actions_per_still=ACTIONS_PER_STILL,blocksize=BLOCK_SIZE,still_resources=STILL_RESOURCES,max_run=opts.max_run)
+scheduler.start(dbi, ActionClass=ddr.task_server.Action, action_args=(task_clients,TIMEOUT), sleeptime=SLEEPTIME, event_driven=opts.event_driven)
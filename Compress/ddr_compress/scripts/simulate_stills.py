@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+"""
+Simulate a night of observations flowing through the stills, to predict
+whether they keep up with the correlator.  Task durations and failure
+rates are taken from the logs in the database (--from_db), or are all
+--duration seconds.
+"""
+import ddr_compress.scheduler as sch
+import ddr_compress.simulator as sim
+import numpy as n
+import logging, optparse, sys
+
+o = optparse.OptionParser()
+o.set_usage('simulate_stills.py [options]')
+o.set_description(__doc__)
+o.add_option('--nobs', type='int', default=72,
+        help='number of observations per pol in the night.  Default 72.')
+o.add_option('--npols', type='int', default=4,
+        help='number of pols.  Default 4.')
+o.add_option('--cadence', type='float', default=600.,
+        help='seconds between observations from the correlator.  Default 600.')
+o.add_option('--nstills', type='int', default=4,
+        help='number of stills.  Default 4.')
+o.add_option('--actions_per_still', type='int', default=8,
+        help='number of actions run in parallel on a still.  Default 8.')
+o.add_option('--blocksize', type='int', default=10,
+        help='number of consecutive observations sent to the same still.  Default 10.')
+o.add_option('--max_run', type='int', default=1,
+        help='launch tasks that take several files on runs of up to this many observations.  Default 1.')
+o.add_option('--timeout', type='float', default=3600.,
+        help='seconds a task may run before it is assumed to have failed.  Default 3600.')
+o.add_option('--duration', type='float', default=600.,
+        help='seconds each task takes, when not measured.  Default 600.')
+o.add_option('--from_db', action='store_true',
+        help='model task durations and failures on the logs in the database.')
+o.add_option('--seed', type='int',
+        help='seed for the random durations and failures.')
+opts, args = o.parse_args(sys.argv[1:])
+logging.getLogger('scheduler').setLevel(logging.WARNING)
+
+if opts.from_db:
+    from ddr_compress.dbi import DataBaseInterface
+    model = sim.load_stage_model(DataBaseInterface(), default_duration=opts.duration)
+else: model = sim.StageModel(default_duration=opts.duration)
+s = sch.Scheduler(nstills=opts.nstills, actions_per_still=opts.actions_per_still,
+    blocksize=opts.blocksize, max_run=opts.max_run)
+r = sim.Simulator(s, model, nobs=opts.nobs, npols=opts.npols, cadence=opts.cadence,
+    timeout=opts.timeout, seed=opts.seed).run()
+
+print 'observations: %d arrived, %d COMPLETE, %d failed' % (r['nobs'], r['ncomplete'], r['nfailed'])
+night = (opts.nobs - 1) * opts.cadence
+if r['time_to_complete'] is None: print 'not all observations completed'
+else: print 'time to COMPLETE: %.1f h (night lasts %.1f h)' % (r['time_to_complete']/3600., night/3600.)
+if len(r['latency']) > 0:
+    latency = n.array(r['latency']) / 3600.
+    print 'latency per obs: median %.2f h, max %.2f h' % (n.median(latency), latency.max())
+    # latency that grows through the night means the stills fall behind
+    half = len(latency) / 2
+    if half > 0: print 'latency, first half of night: %.2f h, second half: %.2f h' % (latency[:half].mean(), latency[half:].mean())
+print 'queue depth: mean %.1f, max %d' % (r['mean_queue'], r['max_queue'])
+for still in sorted(r['utilisation']):
+    print 'still %d utilisation: %.1f%%' % (still, 100 * r['utilisation'][still])
@@ -16,6 +16,8 @@ o.add_option('--logfile',
             help="optionally send logs to a file instead")
 o.add_option('--configfile',
             help='Input a configuration file. see ddr_compress/configs/ for template')
+o.add_option('--tcp',action='store_true',
+            help='take tasks over persistent tcp connections, acknowledging each and pushing task status back to the scheduler (qmaster_scheduler.py --tcp)')
 opts, args = o.parse_args(sys.argv[1:])
 configfile = os.path.expanduser('~/.ddr_compress/still.cfg')
 logger = logging.getLogger('taskserver')
@@ -46,5 +48,6 @@ dbi = ddr.dbi.DataBaseInterface()
 logger.debug('testing db connection')
 dbi.test_db()
 logger.debug('starting task_server on {hostname}:{port}'.format(hostname=hostname,port=opts.port))
-task_server = ddr.task_server.TaskServer(dbi, data_dir=DATA_DIR,port=opts.port)
+if opts.tcp: task_server = ddr.task_server.StreamTaskServer(dbi, data_dir=DATA_DIR,port=opts.port)
+else: task_server = ddr.task_server.TaskServer(dbi, data_dir=DATA_DIR,port=opts.port)
 task_server.start()
@@ -32,15 +32,14 @@ logger = logging.getLogger('summarize_still')
 dbi = DataBaseInterface()
 s = dbi.Session()
 print "summarizing Distiller"
-OBSs = s.query(Observation)
-JDs =  [OBS.julian_date for OBS in OBSs]
+JDs =  [JD for (JD,) in s.query(Observation.julian_date)]
 nights = n.sort(list(set(map(int,JDs))))
 print "number of nights ingested:",len(nights)
 
-Nobs = s.query(Observation).count()
-Nprogress = s.query(Observation).filter(Observation.status!='NEW',Observation.status!='UV_POT',
-        Observation.status!='NEW',Observation.status!='COMPLETE').count()
-Ncomplete = s.query(Observation).filter(Observation.status=='COMPLETE').count()
+counts = dbi.get_status_counts()
+Nobs = sum([c[0] for c in counts.values()])
+Nprogress = sum([c[0] for (status,c) in counts.iteritems() if not status in ('NEW','UV_POT','COMPLETE')])
+Ncomplete = counts.get('COMPLETE',(0,0))[0]
 print "Total observations in still:", Nobs
 print "Number complete:",Ncomplete
 print "Number in progress:",Nprogress
@@ -1 +1 @@
-import scheduler, task_server, dbi
+import scheduler, task_server, dbi, simulator, checksum
@@ -0,0 +1,99 @@
+'''Checksums of the datasets the stills move around.  A ChecksumService
+hashes the components of Miriad datasets (each file in the directory) in a
+pool of threads, with large reads (hashlib and file reads release the GIL,
+so the threads run in parallel), and caches each digest in the database
+with the size and mtime of the file it was taken from.  A component is
+only read again once its size or mtime changes.  Copies made by do_UV.sh
+and do_ACQUIRE_NEIGHBORS.sh are verified against the digests recorded
+where the source was written, without reading the source again.'''
+from multiprocessing.pool import ThreadPool
+import hashlib, os, socket, logging
+
+logger = logging.getLogger('checksum')
+logger.setLevel(logging.INFO)
+
+BLOCKSIZE = 2**22 # bytes per read
+
+def md5_file(filename, blocksize=BLOCKSIZE):
+    '''Return the md5 hexdigest of the contents of filename.'''
+    hasher = hashlib.md5()
+    f = open(filename, 'rb')
+    try:
+        buf = f.read(blocksize)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = f.read(blocksize)
+    finally: f.close()
+    return hasher.hexdigest()
+
+def components(dataset):
+    '''Return the list of (component,filename) that make up dataset: the
+    files in a Miriad dataset directory, by name, or ('',dataset) for a
+    plain file.'''
+    if not os.path.isdir(dataset): return [('', dataset)]
+    names = [f for f in os.listdir(dataset) if os.path.isfile(os.path.join(dataset, f))]
+    names.sort()
+    return [(f, os.path.join(dataset, f)) for f in names]
+
+def dataset_md5(digests):
+    '''Combine digests (dict of component:md5) into one md5 for the dataset.
+    A plain file keeps its own md5.'''
+    if digests.keys() == ['']: return digests['']
+    hasher = hashlib.md5()
+    for component in sorted(digests): hasher.update('%s %s\n' % (component, digests[component]))
+    return hasher.hexdigest()
+
+class ChecksumService:
+    '''Hashes datasets on this host, caching digests in dbi.'''
+    def __init__(self, dbi=None, host=None, nthreads=4, blocksize=BLOCKSIZE):
+        '''dbi: the DataBaseInterface holding the cache (None for no cache).
+        host: the name of this host in the database (as in File.host).
+        nthreads: # of components hashed at once.'''
+        if host is None: host = socket.gethostname()
+        self.dbi = dbi
+        self.host = host
+        self.blocksize = blocksize
+        self.pool = ThreadPool(nthreads)
+    def _md5(self, filename):
+        return md5_file(filename, self.blocksize)
+    def checksum(self, datasets):
+        '''Return dict of dataset:{component:md5} for datasets (paths on this
+        host), hashing only the components not in the cache, or whose size
+        or mtime changed since they were cached.'''
+        datasets = [os.path.abspath(d) for d in datasets]
+        if self.dbi is None: cached = {}
+        else: cached = self.dbi.get_checksums(self.host, datasets)
+        records, todo = {}, []
+        for d in datasets:
+            records[d] = {}
+            for c,filename in components(d):
+                st = os.stat(filename)
+                old = cached.get(d, {}).get(c, None)
+                if not old is None and old[:2] == (st.st_size, st.st_mtime):
+                    records[d][c] = old
+                else: todo.append((d, c, filename, st.st_size, st.st_mtime))
+        if len(todo) > 0:
+            logger.debug('hashing %d components' % len(todo))
+            md5s = self.pool.map(self._md5, [t[2] for t in todo], chunksize=1)
+            for (d,c,filename,size,mtime),md5 in zip(todo, md5s): records[d][c] = (size, mtime, md5)
+        # datasets with new digests, or components that went away
+        changed = [d for d in records if records[d] != cached.get(d, {})]
+        if not self.dbi is None and len(changed) > 0:
+            self.dbi.set_checksums(self.host, dict([(d,records[d]) for d in changed]))
+        return dict([(d, dict([(c,r[2]) for (c,r) in records[d].iteritems()])) for d in records])
+    def verify(self, source, copy):
+        '''Check copy, a local copy of source ('host:path', as passed to
+        scp), against the digests recorded for source on its host, without
+        reading source.  Returns the list of components that differ, are
+        missing or are extra, or None if nothing is recorded for source.'''
+        if ':' in source: host, path = source.split(':', 1)
+        else: host, path = self.host, os.path.abspath(source)
+        recorded = self.dbi.get_checksums(host, [path]).get(path, None)
+        copy = os.path.abspath(copy)
+        digests = self.checksum([copy])[copy]
+        if recorded is None: return None
+        recorded = dict([(c,r[2]) for (c,r) in recorded.iteritems()])
+        return sorted([c for c in set(recorded) | set(digests) if recorded.get(c, None) != digests.get(c, None)])
+    def close(self):
+        self.pool.close()
+        self.pool.join()
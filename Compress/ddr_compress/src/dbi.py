@@ -1,10 +1,12 @@
-from sqlalchemy import Table, Column, String, Integer, ForeignKey, Float,func,DateTime,Enum,BigInteger,Numeric,Text
+from sqlalchemy import Table, Column, String, Integer, ForeignKey, Float,func,DateTime,Enum,BigInteger,Numeric,Text,Index
 from sqlalchemy.orm import relationship, backref,sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine,and_,inspect
+from sqlalchemy.orm.exc import NoResultFound,MultipleResultsFound
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.pool import StaticPool,QueuePool
 from ddr_compress.scheduler import FILE_PROCESSING_STAGES
-import aipy as a, os, numpy as n,sys,logging
+import aipy as a, os, numpy as n,sys,logging,hashlib
 import configparser
 #Based on example here: http://www.pythoncentral.io/overview-sqlalchemys-expression-language-orm-queries/
 Base = declarative_base()
@@ -33,6 +35,18 @@ def jdpol2obsnum(jd,pol,djd):
     assert(obsint < 2**31)
     return int(obsint + polnum*(2**32))
 
+def jdpol2obsnums(jds,pols,djds):
+    """
+    jdpol2obsnum for many observations at once.
+    input: arrays (or lists) of julian dates, pol strings and lengths of obs
+    output: array of unique indices
+    """
+    dublinjd = n.array(jds,dtype=n.float64) - 2415020
+    obsint = n.trunc(dublinjd/n.array(djds,dtype=n.float64)).astype(n.int64)
+    polnum = n.array([a.miriad.str2pol[pol] for pol in pols],dtype=n.int64)+10
+    assert(n.all(obsint < 2**31))
+    return obsint + polnum*(2**32)
+
 def updateobsnum(context):
     """
     helper function for Observation sqlalchemy object.
@@ -90,13 +104,16 @@ class Observation(Base):
                         primaryjoin=obsnum==neighbors.c.low_neighbor_id,
                         secondaryjoin=obsnum==neighbors.c.high_neighbor_id,
                         backref="low_neighbors")
+#neighbors are looked up by julian date within a pol, and linked both ways
+Index('ix_observation_pol_julian_date',Observation.pol,Observation.julian_date)
+Index('ix_neighbors_high_neighbor_id',neighbors.c.high_neighbor_id)
 
 class File(Base):
     __tablename__ = 'file'
     filenum = Column(Integer, primary_key=True)
     filename = Column(String(100))
     host = Column(String(100))
-    obsnum=Column(BigInteger,ForeignKey('observation.obsnum'))
+    obsnum=Column(BigInteger,ForeignKey('observation.obsnum'),index=True)
     #this next line creates an attribute Observation.files which is the list of all
     #  files associated with this observation
     observation = relationship(Observation,backref=backref('files',uselist=True))
@@ -110,6 +127,74 @@ class Log(Base):
     exit_status = Column(Integer)
     timestamp = Column(DateTime,nullable=False,default=func.current_timestamp())
     logtext = Column(Text)
+class StatusChange(Base):
+    """
+    one row per change to the status or pid of an observation, holding the
+    values after the change.  Schedulers follow this table (see
+    DataBaseInterface.get_changes) instead of polling every observation,
+    and prune its old rows (see DataBaseInterface.prune_changes).
+    """
+    __tablename__ = 'status_change'
+    changenum = Column(Integer,primary_key=True)
+    obsnum = Column(BigInteger,ForeignKey('observation.obsnum'))
+    status = Column(Enum(*FILE_PROCESSING_STAGES,name='FILE_PROCESSING_STAGES'))
+    currentpid = Column(Integer)
+    timestamp = Column(DateTime,nullable=False,default=func.current_timestamp())
+class TaskStat(Base):
+    """
+    the resources a task used while it ran: peak cpu (percent of one core)
+    and peak resident memory (MB), as sampled by the TaskServer.
+    """
+    __tablename__ = 'task_stat'
+    statnum = Column(Integer,primary_key=True)
+    obsnum = Column(BigInteger,ForeignKey('observation.obsnum'))
+    task = Column(Enum(*FILE_PROCESSING_STAGES,name='FILE_PROCESSING_STAGES'))
+    host = Column(String(100))
+    cpu = Column(Float)
+    mem = Column(Float)
+    timestamp = Column(DateTime,nullable=False,default=func.current_timestamp())
+class StatusCount(Base):
+    """
+    the number of observations in each status on each still host ('' for
+    none), and how many of them have a task running (currentpid>0).  Kept
+    current by the DataBaseInterface as observations are added and
+    updated, so that dashboards can read totals without scanning the
+    observation table.  The table holds counts once it has a
+    STATUS_COUNT_MARKER row, written when it is (re)built from the
+    observation table; until then no changes are applied to it.
+    """
+    __tablename__ = 'status_count'
+    status = Column(Enum(*FILE_PROCESSING_STAGES,name='FILE_PROCESSING_STAGES'),primary_key=True)
+    stillhost = Column(String(100),primary_key=True)
+    nobs = Column(Integer,nullable=False,default=0)
+    nrunning = Column(Integer,nullable=False,default=0)
+class Checksum(Base):
+    """
+    the md5 of each component of a dataset (the files in a Miriad
+    directory, or '' for a plain file) where it sits on host, with the size
+    and mtime the component had when it was hashed.  See
+    ddr_compress.checksum.
+    """
+    __tablename__ = 'checksum'
+    host = Column(String(100),primary_key=True)
+    dataset = Column(String(200),primary_key=True)
+    component = Column(String(100),primary_key=True)
+    size = Column(BigInteger)
+    mtime = Column(Float(precision=53))
+    md5 = Column(String(32))
+    timestamp = Column(DateTime,nullable=False,default=func.current_timestamp())
+# (status,stillhost) of the row marking the status_count table as built
+STATUS_COUNT_MARKER = ('NEW','#built')
+# number of status changes prune_changes keeps (several nights' worth)
+CHANGES_KEPT = 100000
+# insert prefix, per dialect, that skips rows whose key already exists
+INSERT_IGNORE = {'mysql':'IGNORE', 'sqlite':'OR IGNORE'}
+def count_key(status,stillhost,currentpid):
+    """
+    the status_count row and running flag an observation counts towards
+    """
+    if stillhost is None: stillhost = ''
+    return (status,stillhost),int(not currentpid is None and currentpid>0)
 #note the Cal object/table is added here
 #to provide support for omnical.
 # the DataBaseInterface Class does not currently support Cal
@@ -151,7 +236,6 @@ class DataBaseInterface(object):
             self.engine = create_engine('sqlite:///',
                                         connect_args={'check_same_thread':False},
                                         poolclass=StaticPool)
-            self.createdb()
         else:
             self.engine = create_engine(
                     'mysql://{username}:{password}@{hostip}:{port}/{dbname}'.format(
@@ -159,6 +243,7 @@ class DataBaseInterface(object):
                                 pool_size=20,
                                 max_overflow=40)
         self.Session = sessionmaker(bind=self.engine)
+        if test: self.createdb()
     def test_db(self):
         tables = Base.metadata.tables.keys()
         print "found %i tables"%len(tables)
@@ -198,10 +283,22 @@ class DataBaseInterface(object):
 
     def createdb(self):
         """
-        creates the tables in the database.
+        creates the tables in the database, and builds the status_count
+        table from the observation table.  This also brings a database from
+        an earlier version up to date: create_all only makes the indexes of
+        the tables it creates, so indexes missing from existing tables are
+        added here.
         """
         Base.metadata.bind = self.engine
         Base.metadata.create_all()
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            have = set([ix['name'] for ix in inspector.get_indexes(table.name)])
+            for index in table.indexes:
+                if not index.name in have:
+                    logger.info('createdb: adding index %s to %s' % (index.name,table.name))
+                    index.create(self.engine)
+        self.rebuild_status_counts()
 
     def add_log(self,obsnum,status,logtext,exit_status):
         """
@@ -246,6 +343,46 @@ class DataBaseInterface(object):
         logtext = '\n'.join([LOG.logtext for LOG in LOGs])
         s.close()
         return logtext #maybe this isn't the best format to be giving the logs
+    def add_task_stat(self,obsnum,task,host,cpu,mem):
+        """
+        record the peak cpu (percent of one core) and memory (MB) used by a
+        run of task on obsnum
+        """
+        STAT = TaskStat(obsnum=obsnum,task=task,host=host,cpu=cpu,mem=mem)
+        s = self.Session()
+        s.add(STAT)
+        s.commit()
+        s.close()
+    def get_task_costs(self):
+        """
+        return the average of the recorded peak usage of each task
+        returns: dict of task:(cores,mem) with mem in MB
+        """
+        s = self.Session()
+        COSTS = s.query(TaskStat.task,func.avg(TaskStat.cpu),func.avg(TaskStat.mem)).group_by(TaskStat.task)
+        costs = dict([(task,(float(cpu)/100.,float(mem))) for (task,cpu,mem) in COSTS])
+        s.close()
+        return costs
+    def get_stage_history(self):
+        """
+        summarize the logs of each stage: how long its runs took, estimated
+        as the time from each log (written at launch) to the next log of the
+        same obs, and the fraction of its runs that failed.
+        returns: dict of stage:(list of durations in s,failure fraction)
+        """
+        s = self.Session()
+        LOGS = s.query(Log.obsnum,Log.stage,Log.exit_status,Log.timestamp).order_by(Log.obsnum,Log.timestamp,Log.lognum)
+        durations,nruns,nfail = {},{},{}
+        last = None
+        for obsnum,stage,exit_status,timestamp in LOGS:
+            if stage is None: continue
+            nruns[stage] = nruns.get(stage,0) + 1
+            if not exit_status in (None,0): nfail[stage] = nfail.get(stage,0) + 1
+            if not last is None and last[0] == obsnum:
+                durations.setdefault(last[1],[]).append((timestamp-last[2]).total_seconds())
+            last = (obsnum,stage,timestamp)
+        s.close()
+        return dict([(stage,(durations.get(stage,[]),float(nfail.get(stage,0))/nruns[stage])) for stage in nruns])
     def get_terminal_obs(self,nfail=5):
         """
         Get the obsids of things that have failed nfail times or more (and never completed).
@@ -268,6 +405,9 @@ class DataBaseInterface(object):
         s.add(OBS)
         s.commit()
         obsnum = OBS.obsnum
+        s.add(StatusChange(obsnum=obsnum,status=status,currentpid=None))
+        self.add_counts(s,{(status,''):[1,0]})
+        s.commit()
         s.close()
         self.add_file(obsnum,host,filename)#todo test.
         sys.stdout.flush()
@@ -303,35 +443,73 @@ class DataBaseInterface(object):
         neighbor_low  (julian_date)
 
         What it does:
-        adds observations with status NEW
-        Links neighboring observations in the database
-        """
-        neighbors = {}
-        for obs in obslist:
-        	#ORIGINIAL v
-            #obsnum = self.add_observation(obs['julian_date'],obs['pol'],obs['filename'],obs['host'],length=obs['length'],status='NEW')
-            #DEBUG v
-            obsnum = self.add_observation(obs['julian_date'],obs['pol'],obs['filename'],obs['host'],length=float(obs['length']),status='NEW')
-            neighbors[obsnum] = (obs.get('neighbor_low',None),obs.get('neighbor_high',None))
+        adds the observations (with status) and their files, each with one
+        statement, and links neighboring observations in the database.
+        Neighbors are matched by julian date within pol, first among the
+        new observations (sorted by julian date) then, with a bulk query
+        per pol, among those already in the database.
+        Nothing is added if a neighbor cannot be found.
+        returns: list of obsnums, in the order of obslist
+        """
+        if len(obslist)==0: return []
+        jds = n.array([float(obs['julian_date']) for obs in obslist])
+        pols = [obs['pol'] for obs in obslist]
+        lengths = [float(obs['length']) for obs in obslist]
+        obsnums = [int(obsnum) for obsnum in jdpol2obsnums(jds,pols,lengths)]
         s = self.Session()
-        for middleobsnum in neighbors:
-            OBS = s.query(Observation).filter(Observation.obsnum==middleobsnum).one()
-            if not neighbors[middleobsnum][0] is None:
-                L = s.query(Observation).filter(
-                        Observation.julian_date==neighbors[middleobsnum][0],
-                        Observation.pol == OBS.pol).one()
-                OBS.low_neighbors = [L]
-            if not neighbors[middleobsnum][1] is None:
-                H = s.query(Observation).filter(
-                        Observation.julian_date==neighbors[middleobsnum][1],
-                        Observation.pol == OBS.pol).one()
-                OBS.high_neighbors = [H]
-                sys.stdout.flush()
-            OBS.status = status
-            s.add(OBS)
+        try:
+            s.execute(Observation.__table__.insert(),
+                [{'obsnum':obsnum,'julian_date':jds[i],'pol':pols[i],'status':status,'length':lengths[i]}
+                    for i,obsnum in enumerate(obsnums)])
+            s.execute(File.__table__.insert(),
+                [{'obsnum':obsnum,'filename':obslist[i]['filename'],'host':obslist[i]['host']}
+                    for i,obsnum in enumerate(obsnums)])
+            s.execute(StatusChange.__table__.insert(),
+                [{'obsnum':obsnum,'status':status,'currentpid':None} for obsnum in obsnums])
+            links = set()
+            for pol in set(pols):
+                I = n.array([i for i in xrange(len(obslist)) if pols[i]==pol])
+                lows = self._find_obsnums(s,pol,[obslist[i].get('neighbor_low',None) for i in I],jds[I],
+                    [obsnums[i] for i in I])
+                highs = self._find_obsnums(s,pol,[obslist[i].get('neighbor_high',None) for i in I],jds[I],
+                    [obsnums[i] for i in I])
+                for i,low,high in zip(I,lows,highs):
+                    if not low is None: links.add((low,obsnums[i]))
+                    if not high is None: links.add((obsnums[i],high))
+            if len(links)>0:
+                s.execute(neighbors.insert(),
+                    [{'low_neighbor_id':low,'high_neighbor_id':high} for (low,high) in links])
+            self.add_counts(s,{(status,''):[len(obsnums),0]})
             s.commit()
-        s.close()
-        return neighbors.keys()
+        finally:
+            s.close()
+        return obsnums
+    def _find_obsnums(self,s,pol,want,jds,obsnums,tol=5e-9):
+        """
+        find the obsnums of the pol observations at the julian dates in want
+        (None entries are skipped), among the new observations at jds
+        (with obsnums) or else in the database.
+        returns: list of obsnums (None where want is None)
+        """
+        found = [None]*len(want)
+        order = n.argsort(jds)
+        sjds = jds[order]
+        missing = {}
+        for i,jd in enumerate(want):
+            if jd is None: continue
+            jd = float(jd)
+            j = n.searchsorted(sjds,jd-tol)
+            if j<len(sjds) and abs(sjds[j]-jd)<tol: found[i] = obsnums[order[j]]
+            else: missing.setdefault(round(jd,8),[]).append(i)
+        jdlist = list(set([float(want[i]) for I in missing.values() for i in I]))
+        for k in xrange(0,len(jdlist),500):
+            ROWS = s.query(Observation.julian_date,Observation.obsnum).filter(
+                    Observation.pol==pol,Observation.julian_date.in_(jdlist[k:k+500]))
+            for jd,obsnum in ROWS:
+                for i in missing.pop(round(float(jd),8),[]): found[i] = int(obsnum)
+        if len(missing)>0:
+            raise NoResultFound('no %s observation at julian date %s'%(pol,min(missing.keys())))
+        return found
     def get_neighbors(self,obsnum):
         """
         get the neighbors given the input obsnum
@@ -339,15 +517,15 @@ class DataBaseInterface(object):
         return: list of two obsnums
         If no neighbor, returns None the list entry
 
-        Todo: test. no close!!
+        reads the (indexed) neighbors table directly, without loading the
+        observation
         """
         s = self.Session()
-        OBS = s.query(Observation).filter(Observation.obsnum==obsnum).one()
-        try: high = OBS.high_neighbors[0].obsnum
-        except(IndexError):high = None
-        try: low = OBS.low_neighbors[0].obsnum
-        except(IndexError):low=None
+        low = s.query(neighbors.c.low_neighbor_id).filter(neighbors.c.high_neighbor_id==obsnum).first()
+        high = s.query(neighbors.c.high_neighbor_id).filter(neighbors.c.low_neighbor_id==obsnum).first()
         s.close()
+        if not low is None: low = int(low[0])
+        if not high is None: high = int(high[0])
         return (low,high)
 
 
@@ -365,10 +543,7 @@ class DataBaseInterface(object):
         input: obsnum, still host
         retuns: True for success, False for failure
         """
-        OBS = self.get_obs(obsnum)
-        OBS.stillhost=host
-        yay = self.update_obs(OBS)
-        return yay
+        return self.set_obs_fields({obsnum:{'stillhost':host}})
 
     def get_obs_still_path(self,obsnum):
         """
@@ -382,10 +557,7 @@ class DataBaseInterface(object):
         input: obsnum, path to assigned scratch space on still
         returns: True for success, False for failure
         """
-        OBS = self.get_obs(obsnum)
-        OBS.stillpath = path
-        yay = self.update_obs(OBS)
-        return yay
+        return self.set_obs_fields({obsnum:{'stillpath':path}})
     def get_obs_pid(self,obsnum):
         """
         todo
@@ -397,10 +569,7 @@ class DataBaseInterface(object):
         """
         set to -1 if no task is running
         """
-        OBS = self.get_obs(obsnum)
-        OBS.currentpid = pid
-        yay = self.update_obs(OBS)
-        return yay
+        return self.update_obs_state(obsnum,currentpid=pid)
     def get_input_file(self,obsnum):
         """
         input:observation number
@@ -435,10 +604,252 @@ class DataBaseInterface(object):
         change the satus of obsnum to status
         input: obsnum (key into the observation table, returned by add_observation and others)
         """
-        OBS = self.get_obs(obsnum)
-        OBS.status = status
-        self.update_obs(OBS)
+        return self.update_obs_state(obsnum,status=status)
+    def update_obs_state(self,obsnum,status=None,currentpid=None):
+        """
+        set the status and/or pid of obsnum (None leaves a field as it is)
+        and record the change in the status_change table, in one transaction.
+        returns: True
+        """
+        fields = {}
+        if not status is None: fields['status'] = status
+        if not currentpid is None: fields['currentpid'] = currentpid
+        return self.set_obs_fields({obsnum:fields})
+    def set_obs_fields(self,updates):
+        """
+        set columns of many observations in one transaction.
+        input: dict of obsnum:{column name:value}, eg
+            {obsnum1:{'status':'UV','currentpid':0},obsnum2:{'stillhost':'still1'}}
+        Changes to status or currentpid are recorded in the status_change table.
+        returns: True
+        """
+        columns = Observation.__table__.columns.keys()
+        for fields in updates.values():
+            for k in fields:
+                if not k in columns: raise ValueError('Observation has no column %s' % k)
+        s = self.Session()
+        obsnums = updates.keys()
+        OBSs = []
+        for i in xrange(0,len(obsnums),500):
+            OBSs += s.query(Observation).filter(Observation.obsnum.in_(obsnums[i:i+500])).all()
+        counts = {}
+        for OBS in OBSs:
+            fields = updates[OBS.obsnum]
+            self.count_change(counts,OBS,**fields)
+            for k,v in fields.iteritems(): setattr(OBS,k,v)
+            if fields.has_key('status') or fields.has_key('currentpid'):
+                s.add(StatusChange(obsnum=OBS.obsnum,status=OBS.status,currentpid=OBS.currentpid))
+        if len(OBSs) != len(updates):
+            s.rollback()
+            s.close()
+            found = set([OBS.obsnum for OBS in OBSs])
+            raise NoResultFound('No observations %s' % [o for o in obsnums if not o in found])
+        self.add_counts(s,counts)
+        s.commit()
+        s.close()
         return True
+    def count_change(self,counts,OBS,**fields):
+        """
+        add to counts (a dict of (status,stillhost):[dnobs,dnrunning]) the
+        change in the status_count table from setting fields of OBS
+        """
+        old,oldrun = count_key(OBS.status,OBS.stillhost,OBS.currentpid)
+        new,newrun = count_key(fields.get('status',OBS.status),fields.get('stillhost',OBS.stillhost),
+            fields.get('currentpid',OBS.currentpid))
+        if old == new and oldrun == newrun: return
+        counts.setdefault(old,[0,0])
+        counts[old][0] -= 1; counts[old][1] -= oldrun
+        counts.setdefault(new,[0,0])
+        counts[new][0] += 1; counts[new][1] += newrun
+    def add_counts(self,s,counts):
+        """
+        apply counts (see count_change) to the status_count table, within
+        the transaction of session s.  Rows are updated in place so that
+        concurrent writers do not overwrite each other's counts.  Nothing
+        is applied to a table that has not been built (see
+        rebuild_status_counts), which will count these changes when it is.
+        """
+        status,stillhost = STATUS_COUNT_MARKER
+        if s.query(StatusCount).filter(StatusCount.status==status,StatusCount.stillhost==stillhost).count() == 0:
+            return
+        for (status,stillhost),(dnobs,dnrunning) in counts.iteritems():
+            if dnobs == 0 and dnrunning == 0: continue
+            ROW = s.query(StatusCount).filter(StatusCount.status==status,StatusCount.stillhost==stillhost)
+            delta = {StatusCount.nobs:StatusCount.nobs+dnobs,StatusCount.nrunning:StatusCount.nrunning+dnrunning}
+            if ROW.update(delta,synchronize_session=False) == 0:
+                # a new row: add it empty (unless another writer just did) and count into it
+                s.execute(StatusCount.__table__.insert().prefix_with(INSERT_IGNORE[self.engine.dialect.name]),
+                    {'status':status,'stillhost':stillhost,'nobs':0,'nrunning':0})
+                ROW.update(delta,synchronize_session=False)
+    def rebuild_status_counts(self):
+        """
+        recompute the status_count table from the observation table, with
+        one grouped query, and mark it as built
+        """
+        s = self.Session()
+        s.query(StatusCount).delete()
+        counts = {}
+        ROWS = s.query(Observation.status,Observation.stillhost,Observation.currentpid>0,func.count('*')).group_by(
+                    Observation.status,Observation.stillhost,Observation.currentpid>0)
+        for status,stillhost,running,nobs in ROWS:
+            if status is None: continue
+            key = count_key(status,stillhost,None)[0]
+            counts.setdefault(key,[0,0])
+            counts[key][0] += nobs
+            if running: counts[key][1] += nobs
+        counts[STATUS_COUNT_MARKER] = [0,0]
+        for (status,stillhost),(nobs,nrunning) in counts.iteritems():
+            s.add(StatusCount(status=status,stillhost=stillhost,nobs=nobs,nrunning=nrunning))
+        try: s.commit()
+        except IntegrityError: s.rollback() # rebuilt by another writer at the same time
+        s.close()
+    def get_checksums(self,host,datasets):
+        """
+        the checksums recorded for datasets on host
+        returns: dict of dataset:{component:(size,mtime,md5)}, for the
+            datasets that have any
+        """
+        s = self.Session()
+        checksums = {}
+        datasets = list(datasets)
+        for i in xrange(0,len(datasets),500):
+            ROWS = s.query(Checksum).filter(Checksum.host==host,Checksum.dataset.in_(datasets[i:i+500]))
+            for C in ROWS:
+                checksums.setdefault(C.dataset,{})[C.component] = (C.size,C.mtime,C.md5)
+        s.close()
+        return checksums
+    def set_checksums(self,host,checksums):
+        """
+        replace the checksums recorded for datasets on host
+        input: dict of dataset:{component:(size,mtime,md5)}
+        """
+        s = self.Session()
+        datasets = checksums.keys()
+        for i in xrange(0,len(datasets),500):
+            s.query(Checksum).filter(Checksum.host==host,Checksum.dataset.in_(datasets[i:i+500])).delete(
+                synchronize_session=False)
+        rows = [{'host':host,'dataset':dataset,'component':component,'size':size,'mtime':mtime,'md5':md5}
+            for (dataset,components) in checksums.iteritems()
+            for (component,(size,mtime,md5)) in components.iteritems()]
+        if len(rows)>0: s.execute(Checksum.__table__.insert(),rows)
+        s.commit()
+        s.close()
+    def get_status_counts(self,by_host=False):
+        """
+        return the number of observations in each status, and how many of
+        those have a task running, from the status_count table.
+        returns: dict of status:(nobs,nrunning), or with by_host, dict of
+            (status,stillhost):(nobs,nrunning) with stillhost '' for obs not
+            yet on a still.
+        Pair with get_last_change to refresh only when something changed.
+        A table that has not been built (as in a database from before it
+        existed) is built first.
+        """
+        s = self.Session()
+        ROWS = s.query(StatusCount.status,StatusCount.stillhost,StatusCount.nobs,StatusCount.nrunning).all()
+        s.close()
+        if not STATUS_COUNT_MARKER in [(status,stillhost) for status,stillhost,nobs,nrunning in ROWS]:
+            self.rebuild_status_counts()
+            s = self.Session()
+            ROWS = s.query(StatusCount.status,StatusCount.stillhost,StatusCount.nobs,StatusCount.nrunning).all()
+            s.close()
+        counts = {}
+        for status,stillhost,nobs,nrunning in ROWS:
+            if nobs == 0 or (status,stillhost) == STATUS_COUNT_MARKER: continue
+            if by_host: key = (status,stillhost)
+            else: key = status
+            c = counts.get(key,(0,0))
+            counts[key] = (c[0]+nobs,c[1]+nrunning)
+        return counts
+    def get_changes(self,since=0):
+        """
+        return the status changes recorded after change number since, oldest
+        first, as a list of (changenum,obsnum,status,pid) tuples.
+        Pass the last changenum seen as since to get only newer changes.
+        """
+        s = self.Session()
+        CHANGES = s.query(StatusChange.changenum,StatusChange.obsnum,StatusChange.status,
+                    StatusChange.currentpid).filter(StatusChange.changenum>since).order_by(
+                    StatusChange.changenum)
+        changes = [(int(C.changenum),int(C.obsnum),C.status,C.currentpid) for C in CHANGES]
+        s.close()
+        return changes
+    def get_last_change(self):
+        """
+        return the number of the most recent status change (0 if none)
+        """
+        s = self.Session()
+        last = s.query(func.max(StatusChange.changenum)).scalar()
+        s.close()
+        if last is None: return 0
+        return int(last)
+    def get_first_change(self):
+        """
+        return the number of the oldest status change still recorded (0 if
+        none).  A reader whose last change is older than this has missed
+        changes that were pruned.
+        """
+        s = self.Session()
+        first = s.query(func.min(StatusChange.changenum)).scalar()
+        s.close()
+        if first is None: return 0
+        return int(first)
+    def prune_changes(self,keep=CHANGES_KEPT):
+        """
+        delete all but the most recent keep status changes (at least the
+        last one is always kept, so change numbers carry on from it).
+        returns: the number of changes deleted
+        """
+        s = self.Session()
+        last = s.query(func.max(StatusChange.changenum)).scalar()
+        ndel = 0
+        if not last is None:
+            ndel = s.query(StatusChange).filter(StatusChange.changenum<=last-max(keep,1)).delete(
+                synchronize_session=False)
+        s.commit()
+        s.close()
+        return ndel
+    def get_obs_states(self,obsnums=None):
+        """
+        retrieve the state of many observations at once (all of them if
+        obsnums is None), with one joined query.
+        returns: dict of obsnum:{'status','currentpid','stillhost','stillpath',
+            'neighbors','input_file'}
+        where neighbors is (low,high) as returned by get_neighbors and
+        input_file is (host,path,file) as returned by get_input_file (None
+        if the observation has no input file).  Raises MultipleResultsFound,
+        as get_input_file does, if an observation has several input files.
+        """
+        s = self.Session()
+        LOW = neighbors.alias('low')
+        HIGH = neighbors.alias('high')
+        q = s.query(Observation.obsnum,Observation.status,Observation.currentpid,
+                Observation.stillhost,Observation.stillpath,
+                LOW.c.low_neighbor_id,HIGH.c.high_neighbor_id,File.host,File.filename).outerjoin(
+                LOW,LOW.c.high_neighbor_id==Observation.obsnum).outerjoin(
+                HIGH,HIGH.c.low_neighbor_id==Observation.obsnum).outerjoin(
+                File,and_(File.obsnum==Observation.obsnum,File.filename.like('%uv')))
+        if obsnums is None: rows = q.all()
+        else:
+            obsnums = list(obsnums)
+            rows = []
+            for i in xrange(0,len(obsnums),500):
+                rows += q.filter(Observation.obsnum.in_(obsnums[i:i+500])).all()
+        states = {}
+        for (obsnum,status,pid,stillhost,stillpath,low,high,host,filename) in rows:
+            if not low is None: low = int(low)
+            if not high is None: high = int(high)
+            if filename is None: input_file = None
+            else: input_file = (host,os.path.dirname(filename),os.path.basename(filename))
+            old = states.get(int(obsnum),{'input_file':input_file})['input_file']
+            if old != input_file:
+                s.close()
+                raise MultipleResultsFound('observation %d has input files %s and %s' % (obsnum,old,input_file))
+            states[int(obsnum)] = {'status':status,'currentpid':pid,
+                                   'stillhost':stillhost,'stillpath':stillpath,
+                                   'neighbors':(low,high),'input_file':input_file}
+        s.close()
+        return states
 
 
 
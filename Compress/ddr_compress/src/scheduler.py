@@ -1,4 +1,4 @@
-import time, logging
+import time, logging, heapq, Queue
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('scheduler')
 logger.setLevel(logging.DEBUG)
@@ -23,6 +23,8 @@ FILE_PROCESSING_PREREQS = { # link task to prerequisite state of neighbors, key
     'ACQUIRE_NEIGHBORS': (FILE_PROCESSING_STAGES.index('UVCR'), FILE_PROCESSING_STAGES.index('CLEAN_UVCR')),
     'CLEAN_UVCR': (FILE_PROCESSING_STAGES.index('UVCRRE'),None),
 }
+# tasks whose do_X.sh scripts can process a contiguous run of obs in one process
+RUN_TASKS = ['UVC', 'UVCRE', 'UVCRRE']
 
 class Action:
     '''An Action performs a task on an observation, and is scheduled by a Scheduler.'''
@@ -38,6 +40,8 @@ class Action:
         self.priority = 0
         self.launch_time = -1
         self.timeout = timeout
+        self.neighbors = (None,None) # set by Scheduler.get_action
+        self.obs_run = [obs] # the contiguous obs this action is taken on, in time order
     def set_priority(self, p):
         '''Assign a priority to this action.  Highest priorities are scheduled first.'''
         self.priority = p
@@ -73,21 +77,181 @@ class Action:
 
 def action_cmp(x,y): return cmp(x.priority, y.priority)
 
-class Scheduler:
+class ActionQueue:
+    '''Queued Actions, kept in one heap per (still, is_transfer) and
+    indexed by obs, so that pushing, replacing, removing and popping the
+    highest priority action of a still are all O(log n).  There is at most
+    one queued action per obs.  Removed actions are left in their heap,
+    marked dead, and skipped when popped; heaps are rebuilt once more than
+    half their entries are dead.'''
+    def __init__(self):
+        self.clear()
+    def clear(self):
+        self.heaps = {} # (still,tx):[[-priority,count,action],...]
+        self.index = {} # obs:heap entry
+        self._count = 0
+        self._dead = 0
+    def __len__(self): return len(self.index)
+    def __contains__(self, obs): return self.index.has_key(obs)
+    def get(self, obs):
+        '''Return the action queued for obs, or None.'''
+        try: return self.index[obs][-1]
+        except(KeyError): return None
+    def _entry(self, a):
+        # Ties in priority go to the action queued first
+        self._count += 1
+        entry = [-a.priority, self._count, a]
+        self.index[a.obs] = entry
+        return entry
+    def push(self, a):
+        '''Queue action a, replacing any action queued for the same obs.'''
+        self.remove(a.obs)
+        heapq.heappush(self.heaps.setdefault((a.still, a.is_transfer), []), self._entry(a))
+    def reset(self, actions):
+        '''Replace the queue with actions (one per obs), in O(n).'''
+        self.clear()
+        for a in actions:
+            self.remove(a.obs)
+            self.heaps.setdefault((a.still, a.is_transfer), []).append(self._entry(a))
+        for heap in self.heaps.values(): heapq.heapify(heap)
+        if self._dead > 0: self._compact()
+    def remove(self, obs):
+        '''Drop the action queued for obs, if any.'''
+        entry = self.index.pop(obs, None)
+        if entry is None: return
+        entry[-1] = None
+        self._dead += 1
+        if self._dead > len(self.index): self._compact()
+    def _compact(self):
+        for k,heap in self.heaps.items():
+            heap = [e for e in heap if not e[-1] is None]
+            heapq.heapify(heap)
+            self.heaps[k] = heap
+        self._dead = 0
+    def pop(self, still, tx=False):
+        '''Remove and return the highest priority action for still.'''
+        heap = self.heaps.get((still, tx), [])
+        while len(heap) > 0:
+            a = heapq.heappop(heap)[-1]
+            if a is None:
+                self._dead -= 1
+                continue
+            del(self.index[a.obs])
+            return a
+        raise IndexError('No actions available for still-%d\n' % still)
+    def actions(self):
+        '''Return all queued actions, highest priority first.'''
+        entries = self.index.values()
+        entries.sort()
+        return [e[-1] for e in entries]
+
+class StateTable:
+    '''An in-memory copy of the status, pid and neighbors of every obs, kept
+    current from the status changes a DataBaseInterface records (see
+    DataBaseInterface.get_changes).  It answers the same queries as the
+    DataBaseInterface (get_obs_status, get_obs_pid, get_neighbors,
+    list_observations, get_terminal_obs), so that a Scheduler can be run
+    against it without touching the database for each obs.'''
+    def __init__(self):
+        self.status, self.pid, self.neighbors = {}, {}, {}
+        self.terminal = []
+        self.last_change = 0
+        self.dirty = set()
+    def load(self, dbi, changes=True):
+        '''Read the state of every obs from dbi in one bulk query.  If
+        changes, also note the latest change dbi has recorded, from which
+        refresh carries on.'''
+        if changes: self.last_change = dbi.get_last_change()
+        states = dbi.get_obs_states()
+        self.status, self.pid, self.neighbors = {}, {}, {}
+        for obs,state in states.iteritems(): self._set_state(obs, state)
+        self.terminal = dbi.get_terminal_obs()
+        self.dirty = set(self.status.keys())
+    def _set_state(self, obs, state):
+        self.status[obs] = state['status']
+        self.pid[obs] = state['currentpid']
+        self.neighbors[obs] = tuple(state['neighbors'])
+        # Obs added after their neighbors are linked to them from this side
+        low, high = self.neighbors[obs]
+        if self.neighbors.has_key(low): self.neighbors[low] = (self.neighbors[low][0], obs)
+        if self.neighbors.has_key(high): self.neighbors[high] = (obs, self.neighbors[high][1])
+    def notify(self, obs, status=None, pid=None):
+        '''Record that obs changed status and/or pid (None leaves a field as
+        it is), marking it and its neighbors for re-evaluation.  This is
+        called for each change read by refresh, and may also be called by
+        task completion callbacks running in the same process.'''
+        if not status is None: self.status[obs] = status
+        if not pid is None: self.pid[obs] = pid
+        self.dirty.add(obs)
+        for n in self.neighbors.get(obs, ()):
+            if not n is None: self.dirty.add(n)
+    def refresh(self, dbi):
+        '''Apply the changes dbi has recorded since the last refresh (or
+        load).  Obs not seen before are read from dbi.  If dbi has pruned
+        changes that were not yet applied, every obs is read again.'''
+        if hasattr(dbi, 'get_first_change') and self.last_change < dbi.get_first_change() - 1:
+            logger.info('StateTable.refresh: changes since %d were pruned; reloading' % self.last_change)
+            self.load(dbi)
+            return
+        changes = dbi.get_changes(self.last_change)
+        if len(changes) == 0: return
+        new = set([obs for (cnt,obs,status,pid) in changes if not self.status.has_key(obs)])
+        if len(new) > 0:
+            for obs,state in dbi.get_obs_states(new).iteritems(): self._set_state(obs, state)
+        for cnt,obs,status,pid in changes: self.notify(obs, status, pid)
+        self.last_change = changes[-1][0]
+        self.terminal = dbi.get_terminal_obs()
+    def pop_dirty(self):
+        '''Return the set of obs to re-evaluate, and clear it.'''
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+    def get_obs_status(self, obs): return self.status[obs]
+    def get_obs_pid(self, obs): return self.pid[obs]
+    def get_neighbors(self, obs): return self.neighbors[obs]
+    def list_observations(self):
+        obs = [f for f in self.status if self.status[f] != 'NEW']
+        obs.sort()
+        return obs
+    def get_terminal_obs(self): return self.terminal
+
+class Scheduler(object):
     '''A Scheduler reads a DataBaseInterface to determine what Actions can be
     taken, and then schedules them on stills according to priority.'''
-    def __init__(self, nstills=4, actions_per_still=8, transfers_per_still=2, blocksize=10):
+    def __init__(self, nstills=4, actions_per_still=8, transfers_per_still=2, blocksize=10,
+            still_resources=None, default_cost=(1.,0.), lookahead=32, max_run=1):
         '''nstills: # of stills in system,
         actions_per_still: # of actions that can be scheduled simultaneously
-                           per still.'''
+                           per still.
+        still_resources: if given, a list of (# of cores, memory in MB) for
+            each still.  Actions are then only launched on a still while the
+            summed cost (see task_cost) of its running actions fits, which
+            packs many cheap tasks or few heavy ones per still.
+            actions_per_still still caps the # of actions.
+        default_cost: (cores, MB) assumed for tasks without measurements.
+        lookahead: # of queued actions that may be passed over in favor
+            of cheaper ones when the first does not fit on a still.
+        max_run: if > 1, an action for a task in RUN_TASKS is launched
+            together with the queued actions for the same task on up to
+            max_run-1 of its neighbors on the same still (see gather_run),
+            as one process taking the whole contiguous run of obs.'''
         self.nstills = nstills
         self.actions_per_still = actions_per_still
         self.transfers_per_still = transfers_per_still
         self.blocksize = blocksize
         self.active_obs = []
         self._active_obs_dict = {}
-        self.action_queue = []
+        self.queue = ActionQueue()
+        self.states = None
         self.launched_actions = {}
+        self._launched = {} # (still,obs):launched action
+        self.still_resources = still_resources
+        self.default_cost = default_cost
+        self.lookahead = lookahead
+        self.max_run = max_run
+        self.task_costs = {} # task:(cores,MB), see update_task_costs
+        self.cost_interval = 60. # seconds between reads of task costs
+        self.prune_interval = 3600. # seconds between prunings of recorded status changes
+        self.notices = Queue.Queue() # (obs,status,pid) pushed by notify
         for still in xrange(nstills):
             self.launched_actions[still] = []
         self._run = False
@@ -99,49 +263,152 @@ class Scheduler:
         #logger.addHandler(fh)
         #logger.setLevel(logging.DEBUG)
         #logger.info('setting up stream')
+    @property
+    def action_queue(self):
+        '''The queued actions, highest priority first.'''
+        return self.queue.actions()
     def quit(self):
         self._run = False
-    def start(self, dbi, ActionClass=None, action_args=(), sleeptime=.1):
+    def notify(self, obs, status=None, pid=None):
+        '''Tell the Scheduler that obs changed status and/or pid (None if
+        unchanged), e.g. from a status message pushed by a task server.
+        Safe to call from any thread.  The Scheduler wakes at once to
+        apply the change rather than waiting out its sleeptime or for the
+        change to be read back from the database.'''
+        self.notices.put((obs, status, pid))
+    def wait_for_notices(self, timeout):
+        '''Return the notices received through notify, waiting up to
+        timeout seconds for the first.'''
+        notices = []
+        try: notices.append(self.notices.get(timeout=timeout))
+        except(Queue.Empty): return notices
+        while True:
+            try: notices.append(self.notices.get_nowait())
+            except(Queue.Empty): return notices
+    def start(self, dbi, ActionClass=None, action_args=(), sleeptime=.1, event_driven=False):
         '''Begin scheduling (blocking).
-        dbi: DataBaseInterface'''
+        dbi: DataBaseInterface
+        event_driven: instead of polling every obs in dbi each cycle, load
+            the state of all obs once into a StateTable, follow the status
+            changes dbi records, and re-evaluate only obs whose own or
+            neighbors' state changed.'''
         self._run = True
         logger.info('Scheduler.start: entering loop')
+        if event_driven:
+            self.states = StateTable()
+            self.states.load(dbi)
+        cost_time = prune_time = 0
+        notices = []
         while self._run:
             #tic = time.time()
-            logger.info("getting active obs")
-            self.get_new_active_obs(dbi)
-            logger.info('updating action queue')
-            self.update_action_queue(dbi, ActionClass, action_args)
+            if hasattr(dbi, 'prune_changes') and time.time() > prune_time + self.prune_interval:
+                dbi.prune_changes()
+                prune_time = time.time()
+            if not self.still_resources is None and time.time() > cost_time + self.cost_interval:
+                self.update_task_costs(dbi)
+                cost_time = time.time()
+            if event_driven:
+                logger.info('applying status changes')
+                self.states.refresh(dbi)
+                for obs,status,pid in notices: self.states.notify(obs, status, pid)
+                self.update_changed_actions(self.states, self.states.pop_dirty(), ActionClass, action_args)
+            else:
+                # One bulk read of every obs per cycle, where dbi supports it
+                if hasattr(dbi, 'get_obs_states'):
+                    states = StateTable()
+                    states.load(dbi, changes=False)
+                else: states = dbi
+                logger.info("getting active obs")
+                self.get_new_active_obs(states)
+                logger.info('updating action queue')
+                self.update_action_queue(states, ActionClass, action_args)
             # Launch actions that can be scheduled
             logger.info('launching actions')
-            for still in self.launched_actions:
-                while len(self.get_launched_actions(still,tx=False)) < self.actions_per_still:
-                    try: a = self.pop_action_queue(still,tx=False)
-                    except(IndexError): # no actions can be taken on this still
-                        #logger.info('No actions available for still-%d\n' % still)
-                        break # move on to next still
-                    self.launch_action(a)
-                while len(self.get_launched_actions(still,tx=True)) < self.transfers_per_still:
-                    try: a = self.pop_action_queue(still,tx=True)
-                    except(IndexError): # no actions can be taken on this still
-                        #logger.info('No actions available for still-%d\n' % still)
-                        break # move on to next still
-                    self.launch_action(a)
-            self.clean_completed_actions(dbi)
-            time.sleep(sleeptime)
+            self.launch_actions()
+            if event_driven: self.clean_completed_actions(self.states)
+            else: self.clean_completed_actions(states)
+            notices = self.wait_for_notices(sleeptime)
+    def launch_actions(self):
+        '''Fill the free action and transfer slots of every still from the
+        queue.'''
+        for still in self.launched_actions:
+            skipped = []
+            while len(self.get_launched_actions(still,tx=False)) < self.actions_per_still:
+                if len(skipped) >= self.lookahead: break
+                try: a = self.pop_action_queue(still,tx=False)
+                except(IndexError): # no actions can be taken on this still
+                    #logger.info('No actions available for still-%d\n' % still)
+                    break # move on to next still
+                if self.fits(a): self.launch_action(self.gather_run(a))
+                else: skipped.append(a)
+            for a in skipped: self.queue.push(a) # leave these for a later cycle
+            while len(self.get_launched_actions(still,tx=True)) < self.transfers_per_still:
+                try: a = self.pop_action_queue(still,tx=True)
+                except(IndexError): # no actions can be taken on this still
+                    #logger.info('No actions available for still-%d\n' % still)
+                    break # move on to next still
+                self.launch_action(a)
+    def gather_run(self, a):
+        '''Take the queued actions for the same task as a on the contiguous
+        neighbors of a.obs on the same still (up to max_run obs in all) off
+        the queue, and launch them as part of a by setting a.obs_run.
+        Returns a.'''
+        if self.max_run <= 1 or not a.task in RUN_TASKS: return a
+        def same(obs):
+            b = self.queue.get(obs)
+            if b is None or b.task != a.task or b.still != a.still: return None
+            return b
+        low, high = [], []
+        lo, hi = a, a
+        while len(low) + len(high) + 1 < self.max_run:
+            b = same(lo.neighbors[0])
+            if b is None: b = same(hi.neighbors[1])
+            if b is None: break
+            self.queue.remove(b.obs)
+            if b.obs == lo.neighbors[0]: low.insert(0, b); lo = b
+            else: high.append(b); hi = b
+        a.obs_run = [b.obs for b in low] + [a.obs] + [b.obs for b in high]
+        if len(a.obs_run) > 1: logger.debug('Scheduler.gather_run: (%s,%d) takes obs %s' % (a.task, a.obs, a.obs_run))
+        return a
+    def update_task_costs(self, dbi):
+        '''Read the measured cost of each task type from dbi.'''
+        self.task_costs = dbi.get_task_costs()
+    def task_cost(self, task):
+        '''Return the (cores, MB) a task is expected to use.'''
+        return self.task_costs.get(task, self.default_cost)
+    def fits(self, a):
+        '''Return whether action a fits in the cores and memory left on its
+        still (always True without still_resources).  A still with nothing
+        running accepts any action, so that no task is starved by an
+        estimate bigger than the still.'''
+        if self.still_resources is None: return True
+        running = self.get_launched_actions(a.still, tx=False)
+        if len(running) == 0: return True
+        ncores, mem = self.still_resources[a.still]
+        cpu, used = self.task_cost(a.task)
+        for r in running:
+            c, m = self.task_cost(r.task)
+            cpu += c; used += m
+        return cpu <= ncores and used <= mem
     def pop_action_queue(self, still, tx=False):
         '''Return highest priority action for the given still.'''
-        for i in xrange(len(self.action_queue)):
-            a = self.action_queue[i]
-            if a.still == still and a.is_transfer == tx:
-                return self.action_queue.pop(i)
-        raise IndexError('No actions available for still-%d\n' % still)
+        return self.queue.pop(still, tx=tx)
     def get_launched_actions(self, still, tx=False):
         return [a for a in self.launched_actions[still] if a.is_transfer == tx]
     def launch_action(self, a):
         '''Launch the specified Action and record its launch for tracking later.'''
         self.launched_actions[a.still].append(a)
-        a.launch()
+        for obs in a.obs_run: self._launched[(a.still,obs)] = a
+        try: a.launch()
+        except(IOError),e: self.launch_failed(a, e)
+    def launch_failed(self, a, error):
+        '''Forget the launch of an Action that its still refused or never
+        received, so that it is rescheduled.'''
+        logger.error('Scheduler.launch_failed: (%s,%d) on still %d: %s' % (a.task, a.obs, a.still, error))
+        if a in self.launched_actions[a.still]: self.launched_actions[a.still].remove(a)
+        for obs in a.obs_run:
+            self._launched.pop((a.still,obs), None)
+            if not self.states is None: self.states.dirty.add(obs)
     def kill_action(self, a):
         '''Subclass this to actually kill the process.'''
         logger.info('Scheduler.kill_action: called on (%s,%d)' % (a.task, a.obs))
@@ -167,14 +434,17 @@ class Scheduler:
                     logger.info('Task %s for obs %s on still %d HAS DIED. failcount=%d' % (a.task, a.obs, still,self.failcount[str(a.obs)+status]))
                 else: # still active
                     updated_actions.append(a)
+                    continue
+                for obs in a.obs_run:
+                    self._launched.pop((still,obs), None)
+                    # obs that are done with an action need a new one
+                    if not self.states is None: self.states.dirty.add(obs)
             self.launched_actions[still] = updated_actions
     def already_launched(self, action):
         '''Determine if this action has already been launched.  Enforces
         fact that only one valid action can be taken for a given obs
         at any one time.'''
-        for a in self.launched_actions[action.still]:
-            if a.obs == action.obs: return True
-        return False
+        return self._launched.has_key((action.still,action.obs))
     def get_new_active_obs(self, dbi):
         '''Check for any new obs that may have appeared.  Actions for
         these obs may potentially take priority over ones currently
@@ -198,8 +468,27 @@ class Scheduler:
         actions = [a for a in actions if self.failcount.get(str(a.obs)+dbi.get_obs_status(a.obs),0)<MAXFAIL] #filter actions that have utterly failed us
         actions = [a for a in actions if not a.obs in failed]#Filter actions that have failed before
         for a in actions: a.set_priority(self.determine_priority(a,dbi))
-        actions.sort(action_cmp, reverse=True) # place most important actions first
-        self.action_queue = actions # completely throw out previous action list
+        self.queue.reset(actions) # completely throw out previous action list
+    def update_changed_actions(self, dbi, obs_list, ActionClass=None, action_args=()):
+        '''Event-driven counterpart to update_action_queue: regenerate the
+        actions of only the obs in obs_list (those whose own or neighbors'
+        state changed), keeping the queued actions of all other obs.
+        dbi is normally the StateTable being followed.'''
+        if len(obs_list) == 0: return
+        failed = set(dbi.get_terminal_obs())
+        for f in obs_list:
+            self.queue.remove(f)
+            status = dbi.get_obs_status(f)
+            if status in ('NEW', 'COMPLETE'): continue
+            if not self._active_obs_dict.has_key(f):
+                self._active_obs_dict[f] = len(self.active_obs)
+                self.active_obs.append(f)
+            if f in failed: continue
+            a = self.get_action(dbi, f, ActionClass=ActionClass, action_args=action_args)
+            if a is None or self.already_launched(a): continue
+            if self.failcount.get(str(a.obs)+status,0) >= MAXFAIL: continue
+            a.set_priority(self.determine_priority(a,dbi))
+            self.queue.push(a)
     def get_action(self, dbi, obs, ActionClass=None, action_args=()):
         '''Find the next actionable step for obs f (one for which all
         prerequisites have been met.  Return None if no action is available.
@@ -220,6 +509,7 @@ class Scheduler:
         still = self.obs_to_still(obs)
         if ActionClass is None: ActionClass = Action
         a = ActionClass(obs, next_step, neighbor_status, still, *action_args)
+        a.neighbors = neighbors
         if a.has_prerequisites(): return a
         else:
             #logging.debug('scheduler.get_action: (%s,%d) does not have prereqs' % (a.task, a.obs))
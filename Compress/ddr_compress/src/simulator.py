@@ -0,0 +1,185 @@
+'''A discrete-event simulator of the still pipeline.  A Simulator drives a
+real scheduler.Scheduler against an in-memory SimDataBaseInterface on a
+virtual clock: observations arrive at the correlator cadence, each launched
+Action finishes (or fails) after a duration drawn from a StageModel, and
+the Scheduler runs a cycle after every event.  This predicts whether the
+stills keep up with the correlator, and lets changes to
+FILE_PROCESSING_STAGES, actions_per_still, blocksize or the priority
+function (by subclassing Scheduler) be evaluated offline.'''
+import scheduler as sch
+import heapq, random, logging
+
+logger = logging.getLogger('simulator')
+logger.setLevel(logging.INFO)
+
+class StageModel:
+    '''The duration and failure rate of each task.'''
+    def __init__(self, durations=None, failures=None, default_duration=600.):
+        '''durations: dict of task:list of durations (s) to sample from.
+        failures: dict of task:probability that a run fails.
+        default_duration: duration of tasks without durations.'''
+        if durations is None: durations = {}
+        if failures is None: failures = {}
+        self.durations = durations
+        self.failures = failures
+        self.default_duration = default_duration
+    def sample(self, task, rng=random):
+        '''Return (duration in s, whether the run fails) for a run of task.'''
+        durations = self.durations.get(task, [])
+        if len(durations) == 0: duration = self.default_duration
+        else: duration = rng.choice(durations)
+        return duration, rng.random() < self.failures.get(task, 0.)
+
+def load_stage_model(dbi, default_duration=600.):
+    '''Return a StageModel of the runs recorded in the logs of dbi (see
+    DataBaseInterface.get_stage_history).'''
+    history = dbi.get_stage_history()
+    durations = dict([(stage,d) for (stage,(d,f)) in history.iteritems() if len(d) > 0])
+    failures = dict([(stage,f) for (stage,(d,f)) in history.iteritems()])
+    return StageModel(durations, failures, default_duration=default_duration)
+
+class SimDataBaseInterface:
+    '''The parts of DataBaseInterface a Scheduler reads, held in memory.
+    Obs that have not arrived yet have status NEW.'''
+    def __init__(self, nfail=sch.MAXFAIL):
+        self.status, self.pid, self.neighbors = {}, {}, {}
+        self.nfails = {}
+        self.nfail = nfail
+    def add_observation(self, obs, neighbors, status='NEW'):
+        self.status[obs] = status
+        self.pid[obs] = None
+        self.neighbors[obs] = neighbors
+        self.nfails[obs] = 0
+    def list_observations(self):
+        obs = [f for f in self.status if self.status[f] != 'NEW']
+        obs.sort()
+        return obs
+    def get_obs_status(self, obs): return self.status[obs]
+    def get_obs_pid(self, obs): return self.pid[obs]
+    def get_neighbors(self, obs): return self.neighbors[obs]
+    def set_obs_status(self, obs, status): self.status[obs] = status
+    def set_obs_pid(self, obs, pid):
+        self.pid[obs] = pid
+        if pid == -9: self.nfails[obs] += 1
+    def get_terminal_obs(self):
+        return [f for f in self.nfails if self.nfails[f] >= self.nfail]
+
+class SimAction(sch.Action):
+    '''An Action whose task runs on the virtual clock of a Simulator.'''
+    def __init__(self, obs, task, neighbor_status, still, sim, timeout=3600.):
+        sch.Action.__init__(self, obs, task, neighbor_status, still, timeout=timeout)
+        self.sim = sim
+    def launch(self, launch_time=None):
+        return sch.Action.launch(self, self.sim.now)
+    def timed_out(self, curtime=None):
+        return sch.Action.timed_out(self, self.sim.now)
+    def _command(self):
+        self.sim.start_task(self)
+
+class Simulator:
+    '''Runs a Scheduler on a night of observations, on a virtual clock.'''
+    def __init__(self, scheduler, model, nobs=72, npols=1, cadence=600.,
+            cycle_delay=1., timeout=3600., seed=None):
+        '''scheduler: the scheduler.Scheduler (or subclass) to evaluate.
+        model: the StageModel of task durations and failures.
+        nobs: # of observations per pol, arriving one every cadence (s).
+        cycle_delay: seconds from an event to the scheduling cycle that
+            follows it (about the sleeptime of the Scheduler).
+        timeout: seconds before an action is considered failed.'''
+        self.scheduler = scheduler
+        self.model = model
+        self.cadence = cadence
+        self.cycle_delay = cycle_delay
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.dbi = SimDataBaseInterface()
+        self.now = 0.
+        self.events = [] # heap of [time,count,func,args]
+        self._count = 0
+        self._cycle_at = None
+        self.arrival, self.done = {}, {} # obs:time
+        # time integrals for the averages reported
+        self.stats = {'queue':0., 'maxqueue':0, 'busy':dict([(still,0.) for still in scheduler.launched_actions])}
+        self.last_time = 0.
+        for pol in xrange(npols):
+            obsnums = [pol * 2**32 + i for i in xrange(nobs)] # matches Scheduler.determine_priority
+            for i,obs in enumerate(obsnums):
+                low, high = None, None
+                if i > 0: low = obsnums[i-1]
+                if i < nobs-1: high = obsnums[i+1]
+                self.dbi.add_observation(obs, (low,high))
+                self.schedule(i * cadence, self.arrive, obs)
+    def schedule(self, t, func, *args):
+        self._count += 1
+        heapq.heappush(self.events, [t, self._count, func, args])
+    def arrive(self, obs):
+        '''The correlator writes obs.'''
+        self.dbi.set_obs_status(obs, 'UV_POT')
+        self.arrival[obs] = self.now
+    def start_task(self, a):
+        '''Called as a is launched: schedule its completion or failure.'''
+        if a.task == 'COMPLETE': duration, failed = 0., False # the task server just records it
+        else: duration, failed = self.model.sample(a.task, self.rng)
+        if duration > a.timeout: duration, failed = a.timeout, True # killed by the Scheduler
+        for obs in a.obs_run: self.dbi.set_obs_pid(obs, 1) # running
+        self.schedule(self.now + duration, self.finish_task, a, failed)
+    def finish_task(self, a, failed):
+        for obs in a.obs_run:
+            if failed:
+                self.dbi.set_obs_pid(obs, -9)
+                continue
+            self.dbi.set_obs_status(obs, a.task)
+            self.dbi.set_obs_pid(obs, 0)
+            if a.task == 'COMPLETE': self.done[obs] = self.now
+    def cycle(self):
+        '''One pass of the Scheduler loop (see Scheduler.start).'''
+        self._cycle_at = None
+        s = self.scheduler
+        s.clean_completed_actions(self.dbi)
+        s.get_new_active_obs(self.dbi)
+        s.update_action_queue(self.dbi, SimAction, (self, self.timeout))
+        s.launch_actions()
+    def advance(self, t):
+        dt = t - self.last_time
+        s = self.scheduler
+        self.stats['queue'] += len(s.queue) * dt
+        self.stats['maxqueue'] = max(self.stats['maxqueue'], len(s.queue))
+        for still in s.launched_actions:
+            self.stats['busy'][still] += len(s.get_launched_actions(still)) * dt
+        self.now = self.last_time = t
+    def run(self, until=None):
+        '''Process events until none are left (or the clock reaches until).
+        Returns the report.'''
+        while len(self.events) > 0:
+            t, cnt, func, args = self.events[0]
+            if not until is None and t > until: break
+            heapq.heappop(self.events)
+            self.advance(t)
+            func(*args)
+            if func != self.cycle and self._cycle_at is None:
+                self._cycle_at = t + self.cycle_delay
+                self.schedule(self._cycle_at, self.cycle)
+        return self.report()
+    def report(self):
+        '''Return a dict of:
+        nobs, ncomplete, nfailed: # of obs arrived, COMPLETE, given up on
+        time: seconds from the first arrival to the last event
+        time_to_complete: seconds from the first arrival until every obs
+            that arrived was COMPLETE (None if some are not)
+        latency: list of seconds from arrival to COMPLETE, in arrival order
+        mean_queue, max_queue: (time-averaged) # of queued actions
+        utilisation: dict of still:fraction of action slots busy'''
+        t = max(self.now, 1e-9)
+        s = self.scheduler
+        arrived = sorted(self.arrival.keys(), key=lambda obs: (self.arrival[obs], obs))
+        latency = [self.done[obs] - self.arrival[obs] for obs in arrived if self.done.has_key(obs)]
+        complete = len(self.done) == len(self.arrival) and len(self.arrival) > 0
+        ttc = None
+        if complete: ttc = max(self.done.values()) - min(self.arrival.values())
+        return {'nobs':len(self.arrival), 'ncomplete':len(self.done),
+            'nfailed':len(self.dbi.get_terminal_obs()), 'time':t,
+            'time_to_complete':ttc, 'latency':latency,
+            'mean_queue':self.stats['queue'] / t, 'max_queue':self.stats['maxqueue'],
+            'utilisation':dict([(still, busy / (t * s.actions_per_still))
+                for (still,busy) in self.stats['busy'].iteritems()]),
+        }
@@ -1,12 +1,16 @@
 import SocketServer
 import logging, threading, subprocess, time
-import socket, os,tempfile,psutil
+import socket, os,psutil
+import struct, json, Queue, select, collections
 
 logger = logging.getLogger('taskserver')
 logger.setLevel(logging.DEBUG)
 logger.propagate = True
 PKT_LINE_LEN = 160
 STILL_PORT = 14204
+LOG_CHUNK = 2**16 # bytes; task output is written to the db log in chunks of at most this
+LOG_INTERVAL = 10. # seconds; or, when less has accumulated, at most this often
+SAMPLE_INTERVAL = 5. # seconds between samples of the cpu and memory use of a task
 def pad(s, line_len=PKT_LINE_LEN):
     return (s + ' '*line_len)[:line_len]
 
@@ -26,54 +30,131 @@ def from_pkt(pkt, line_len=PKT_LINE_LEN):
         args.append(arg)
     return task, obs, still, args
 
+# Messages over stream connections are JSON dicts, each preceded by its length
+FRAME_HDR = struct.Struct('!I')
+MAX_FRAME_LEN = 2**24
+
+def send_msg(sock, msg):
+    '''Send msg (a dict) over a stream socket as one length-prefixed frame.'''
+    data = json.dumps(msg)
+    sock.sendall(FRAME_HDR.pack(len(data)) + data)
+
+def _recv_all(sock, nbytes):
+    chunks = []
+    while nbytes > 0:
+        chunk = sock.recv(nbytes)
+        if len(chunk) == 0: raise EOFError('connection closed')
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return ''.join(chunks)
+
+def recv_msg(sock):
+    '''Return the next dict sent with send_msg over sock.  Raises EOFError
+    when the connection is closed.'''
+    nbytes, = FRAME_HDR.unpack(_recv_all(sock, FRAME_HDR.size))
+    if nbytes > MAX_FRAME_LEN: raise IOError('frame of %d bytes is too long' % nbytes)
+    return json.loads(_recv_all(sock, nbytes))
+
 class Task:
-    def __init__(self, task, obs, still, args, dbi, cwd='.'):
+    def __init__(self, task, obs, still, args, dbi, cwd='.', obs_run=None):
+        '''obs_run: the contiguous obs, including obs, that the script of
+        task processes in this one process (default [obs]).'''
         self.task = task
         self.obs = obs
+        if obs_run is None: obs_run = [obs]
+        self.obs_run = obs_run
         self.still = still
         self.args = args
         self.dbi = dbi
         self.cwd = cwd
         self.process = None
-        self.OUTFILE = tempfile.TemporaryFile()
-        self.outfile_counter = 0
+        self.logtext = [] # output read but not yet written to the db log
+        self.loglen = 0
+        self.log_time = time.time()
+        self.end_time = None # when the output of the task was seen to end
+        self.child = None # the psutil.Process sampled by sample
+        self.sample_time = 0
+        self.max_cpu, self.max_mem, self.nsamples = 0., 0., 0
     def run(self):
         if not self.process is None:
             raise RuntimeError('Cannot run a Task that has been run already.')
         if self.task == 'UV': # on first copy of data to still, record in db that obs is assigned here
-            self.dbi.set_obs_still_host(self.obs, self.still)
-            self.dbi.set_obs_still_path(self.obs, os.path.abspath(self.cwd))
+            self.dbi.set_obs_fields({self.obs:{'stillhost':self.still, 'stillpath':os.path.abspath(self.cwd)}})
         self.process = self._run()
         self.record_launch()
     def _run(self):
         logger.info('Task._run: (%s,%d) %s cwd=%s' % (self.task,self.obs,' '.join(['do_%s.sh' % self.task] + self.args),self.cwd))
-        #process= subprocess.Popen(['do_%s.sh' % self.task] + self.args, cwd=self.cwd,stderr=subprocess.PIPE,stdout=subprocess.PIPE) # XXX d something with stdout stderr
-        #create a temp file descriptor for stdout and stderr
-        self.OUTFILE = tempfile.TemporaryFile()
-        self.outfile_counter = 0
+        # stdout and stderr go to a pipe, read by the TaskServer as output arrives
         try:
-            process= psutil.Popen(['do_%s.sh' % self.task] + self.args, cwd=self.cwd,stderr=self.OUTFILE,stdout=self.OUTFILE)
+            process= psutil.Popen(['do_%s.sh' % self.task] + self.args, cwd=self.cwd,stderr=subprocess.STDOUT,stdout=subprocess.PIPE)
             process.cpu_affinity(range(psutil.cpu_count()))
             self.dbi.add_log(self.obs,self.task,' '.join(['do_%s.sh' % self.task] + self.args+['\n']),None)
         except Exception,e:
             logger.error('Task._run: (%s,%d) %s error="%s"' % (self.task,self.obs,' '.join(['do_%s.sh' % self.task] + self.args),e))
         return process
+    def fileno(self):
+        '''The fd of the output pipe of the task, or None if there is none
+        (left to read).'''
+        if self.process is None or self.process.stdout is None or self.process.stdout.closed: return None
+        return self.process.stdout.fileno()
+    def read_output(self):
+        '''Read the output available on the pipe of the task, without
+        blocking, and queue it for the db log.  Returns what was read.
+        The pipe is closed when the output ends.'''
+        fd = self.fileno()
+        if fd is None or len(select.select([fd],[],[],0)[0]) == 0: return ''
+        data = os.read(fd, LOG_CHUNK)
+        if len(data) == 0:
+            self.process.stdout.close()
+            if self.end_time is None: self.end_time = time.time()
+        self.logtext.append(data)
+        self.loglen += len(data)
+        return data
+    def flush_log(self, force=False):
+        '''Write queued output to the db log, in chunks of at most LOG_CHUNK
+        bytes, once LOG_CHUNK bytes have accumulated or LOG_INTERVAL has
+        passed since the last write (or if force).'''
+        if self.loglen == 0: return
+        if not force and self.loglen < LOG_CHUNK and time.time() < self.log_time + LOG_INTERVAL: return
+        logtext = ''.join(self.logtext)
+        self.logtext, self.loglen = [], 0
+        logger.debug('Task.flush_log: ({task},{obsnum}) adding {d} log characters'.format(task=self.task,obsnum=self.obs,d=len(logtext)))
+        for i in xrange(0, len(logtext), LOG_CHUNK):
+            self.dbi.update_log(self.obs,self.task,logtext=logtext[i:i+LOG_CHUNK],exit_status=self.process.poll())
+        self.log_time = time.time()
     def poll(self):
-        #logger.debug('Task.pol: (%s,%d)  reading to log position %d'%(self.task,self.obs,self.outfile_counter))
         if self.process is None: return None
-        self.OUTFILE.seek(self.outfile_counter)
-        logtext = self.OUTFILE.read()
-        #logger.debug('Task.pol: (%s,%d) found %d log characters' % (self.task,self.obs,len(logtext)))
-        if len(logtext)>self.outfile_counter:
-            logger.debug('Task.pol: ({task},{obsnum}) adding {d} log characeters'.format(task=self.task,obsnum=self.obs,d=len(logtext)))
-            self.dbi.update_log(self.obs,self.task,logtext=logtext,exit_status=self.process.poll())
-            self.outfile_counter += len(logtext)
-            #logger.debug('Task.pol: (%s,%d) setting next log position to %d' % (self.task,self.obs,self.outfile_counter))
-        #logger.debug('Task.pol: (%s,%d) post log addition' % (self.task,self.obs))
-        return self.process.poll()
+        self.read_output()
+        self.flush_log()
+        status = self.process.poll()
+        if not status is None and self.end_time is None: self.end_time = time.time()
+        return status
+    def sample(self):
+        '''Sample the cpu and memory use of the process the task script
+        runs, at most every SAMPLE_INTERVAL, without blocking: cpu use is
+        averaged since the previous sample.'''
+        if time.time() < self.sample_time + SAMPLE_INTERVAL: return
+        self.sample_time = time.time()
+        try:
+            if self.child is None:
+                self.child = self.process.children()[0]
+                #Check the affinity!
+                if len(self.child.cpu_affinity())<psutil.cpu_count(): self.child.cpu_affinity(range(psutil.cpu_count()))
+                self.child.cpu_percent(interval=None) # cpu use is measured from here
+                return
+            cpu = self.child.cpu_percent(interval=None)
+            self.sample_usage(cpu, self.child.memory_info().rss/1024.**2)
+            logger.debug('Proc info on {obsnum}:{task}:{pid} - cpu={cpu:.1f}%%, mem={mem:.1f}%%, Naffinity={aff}'.format(
+                        obsnum=self.obs,task=self.task,pid=self.child.pid,cpu=cpu,mem=self.child.memory_percent(),aff=len(self.child.cpu_affinity())))
+        except(Exception):
+            self.child = None
     def finalize(self):
         logger.info('Task.finalize waiting: ({task},{obsnum})'.format(task=self.task,obsnum=self.obs))
-        self.process.communicate()
+        while len(self.read_output()) > 0: pass
+        # output still open is held by processes the script left behind
+        if not self.fileno() is None: self.process.stdout.close()
+        self.process.wait()
+        self.flush_log(force=True)
         #try:
         #    stdout,stderr=self.process.communicate()
         #    if stderr is None:
@@ -89,6 +170,7 @@ class Task:
         self.dbi.update_log(self.obs,exit_status=self.process.poll())
         if self.poll(): self.record_failure()
         else: self.record_completion()
+        if self.nsamples > 0: self.record_usage()
     def kill(self):
         self.record_failure()
         logger.debug('Task.kill Trying to kill: ({task},{obsnum}) pid={pid}'.format(task=self.task,obsnum=self.obs,pid=self.process.pid))
@@ -99,14 +181,20 @@ class Task:
         self.process.kill()
         os.wait()
         logger.debug('Task.kill Successfully killed ({task},{obsnum})'.format(task=self.task,obsnum=self.obs))
+    def sample_usage(self, cpu, mem):
+        '''Keep the peak cpu (percent of one core) and memory (MB) seen.'''
+        self.max_cpu = max(self.max_cpu, cpu)
+        self.max_mem = max(self.max_mem, mem)
+        self.nsamples += 1
+    def record_usage(self):
+        self.dbi.add_task_stat(self.obs, self.task, self.still, self.max_cpu, self.max_mem)
     def record_launch(self):
-        self.dbi.set_obs_pid(self.obs, self.process.pid)
+        self.dbi.set_obs_fields(dict([(obs,{'currentpid':self.process.pid}) for obs in self.obs_run]))
     def record_failure(self):
-        self.dbi.set_obs_pid(self.obs, -9)
+        self.dbi.set_obs_fields(dict([(obs,{'currentpid':-9}) for obs in self.obs_run]))
         logger.error('Task.record_failure.  TASK FAIL ({task},{obsnum})'.format(task=self.task,obsnum=self.obs))
     def record_completion(self):
-        self.dbi.set_obs_status(self.obs, self.task)
-        self.dbi.set_obs_pid(self.obs,0)
+        self.dbi.set_obs_fields(dict([(obs,{'status':self.task, 'currentpid':0}) for obs in self.obs_run]))
 class TaskClient:
     def __init__(self, dbi, host, port=STILL_PORT):
         self.dbi = dbi
@@ -117,15 +205,18 @@ class TaskClient:
         pkt = to_pkt(task, obs, self.host_port[0], args)
         self.sock.sendto(pkt, self.host_port)
     def gen_args(self, task, obs):
-        pot,path,basename = self.dbi.get_input_file(obs)
+        # the obs and its neighbors are read with two bulk queries
+        state = self.dbi.get_obs_states([obs])[obs]
+        nstates = self.dbi.get_obs_states([n for n in state['neighbors'] if not n is None])
+        pot,path,basename = state['input_file']
         outhost,outpath = self.dbi.get_output_location(obs)
         # hosts and paths are not used except for ACQUIRE_NEIGHBORS and CLEAN_NEIGHBORS
-        stillhost,stillpath = self.dbi.get_obs_still_host(obs), self.dbi.get_obs_still_path(obs)
-        neighbors = [(self.dbi.get_obs_still_host(n),self.dbi.get_obs_still_path(n)) + self.dbi.get_input_file(n)
-            for n in self.dbi.get_neighbors(obs) if not n is None]
-        neighbors_base = list(self.dbi.get_neighbors(obs))
-        if not neighbors_base[0] is None: neighbors_base[0] = self.dbi.get_input_file(neighbors_base[0])[-1]
-        if not neighbors_base[1] is None: neighbors_base[1] = self.dbi.get_input_file(neighbors_base[1])[-1]
+        stillhost,stillpath = state['stillhost'], state['stillpath']
+        neighbors = [(nstates[n]['stillhost'],nstates[n]['stillpath']) + tuple(nstates[n]['input_file'])
+            for n in state['neighbors'] if not n is None]
+        neighbors_base = list(state['neighbors'])
+        if not neighbors_base[0] is None: neighbors_base[0] = nstates[neighbors_base[0]]['input_file'][-1]
+        if not neighbors_base[1] is None: neighbors_base[1] = nstates[neighbors_base[1]]['input_file'][-1]
         def interleave(filename, appendage='cR'):
             # make sure this is in sync with do_X.sh task scripts.
             rv = [filename]
@@ -155,6 +246,16 @@ class TaskClient:
             'COMPLETE': [],
         }
         return args[task]
+    def gen_run_args(self, task, obs_run):
+        '''Return the args for the script of task processing the contiguous
+        obs in obs_run (in time order) in one process.  The args of
+        neighboring obs overlap (e.g. the triplets of UVCRE), so those of
+        each obs are merged in order, dropping repeats.'''
+        args = []
+        for obs in obs_run:
+            for arg in self.gen_args(task, obs):
+                if not arg in args: args.append(arg)
+        return args
     def tx(self, task, obs):
         args = self.gen_args(task, obs)
         self._tx(task, obs, args)
@@ -165,6 +266,114 @@ class TaskClient:
         else:
             self._tx('KILL', obs, [str(pid)])
 
+class StreamTaskClient(TaskClient):
+    '''A TaskClient for a StreamTaskServer.  Tasks are sent over a
+    persistent TCP connection (reopened as needed), several per message
+    with tx_batch, and each message waits for the server to acknowledge
+    it, so a task that cannot be launched raises IOError at once instead
+    of timing out later.  Status messages pushed by the server (a task
+    launched, completed or failed) are passed to on_status, from a reader
+    thread.'''
+    def __init__(self, dbi, host, port=STILL_PORT, on_status=None, timeout=30.):
+        self.dbi = dbi
+        self.host_port = (host,port)
+        self.on_status = on_status
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock() # one message awaits its reply at a time
+        self.msg_id = 0
+        self.replies = Queue.Queue()
+        self.batch = None
+    def connect(self):
+        if not self.sock is None: return
+        self.sock = socket.create_connection(self.host_port, self.timeout)
+        self.sock.settimeout(None)
+        self.replies = Queue.Queue()
+        t = threading.Thread(target=self._read, args=(self.sock, self.replies))
+        t.daemon = True
+        t.start()
+    def _read(self, sock, replies):
+        try:
+            while True:
+                msg = recv_msg(sock)
+                if msg['type'] != 'status': replies.put(msg)
+                elif not self.on_status is None: self.on_status(msg)
+        except(EOFError,IOError,ValueError): pass
+        replies.put(None) # wake a sender waiting on this connection
+    def close(self):
+        if self.sock is None: return
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except(socket.error): pass
+        self.sock.close()
+        self.sock = None
+    def _send(self, tasks):
+        '''Send [(task,obs,args),...] in one message and wait for the reply.
+        Each entry may carry the obs_run of the task as a fourth item.
+        Returns a list with None for each task launched and an error
+        string for each refused.  Raises IOError if there is no reply.'''
+        self.lock.acquire()
+        try:
+            self.msg_id += 1
+            msg = {'type':'tasks', 'id':self.msg_id,
+                'tasks':[[t[0], t[1], self.host_port[0]] + list(t[2:]) for t in tasks]}
+            try:
+                self.connect()
+                send_msg(self.sock, msg)
+            except(socket.error):
+                self.close() # the connection may have dropped since the last message: retry once
+                self.connect()
+                send_msg(self.sock, msg)
+            replies = self.replies
+            while True:
+                try: reply = replies.get(timeout=self.timeout)
+                except(Queue.Empty): reply = None
+                if reply is None:
+                    self.close()
+                    raise IOError('no reply from %s:%d' % self.host_port)
+                if reply['id'] == self.msg_id: break
+        except(socket.error),e:
+            self.close()
+            raise IOError('cannot send to %s:%d: %s' % (self.host_port + (e,)))
+        finally:
+            self.lock.release()
+        return reply.get('errors', [None] * len(tasks))
+    def _tx(self, task, obs, args):
+        logger.debug('StreamTaskClient._tx: sending (%s,%d) with args=%s' % (task, obs, ' '.join(args)))
+        error = self._send([(task, obs, args)])[0]
+        if not error is None: raise IOError('(%s,%d) refused: %s' % (task, obs, error))
+    def tx_batch(self, tasks):
+        '''Send the [(task,obs),...] in tasks in one message.  Returns a
+        list with None for each task launched and an error string for each
+        refused.'''
+        return self._send([self._entry(t) for t in tasks])
+    def _entry(self, t):
+        if len(t) == 2: return (t[0], t[1], self.gen_args(t[0], t[1]))
+        task, obs, obs_run = t
+        return (task, obs, self.gen_run_args(task, obs_run), obs_run)
+    def tx(self, task, obs):
+        if self.batch is None: TaskClient.tx(self, task, obs)
+        else: self.batch.append((task, obs))
+    def tx_run(self, task, obs_run):
+        '''Launch task in one process on the contiguous obs of obs_run (in
+        time order), recording the pid and status of all of them.  The
+        task is identified by the obs of the first element.'''
+        obs = obs_run[0]
+        if self.batch is None:
+            error = self._send([self._entry((task, obs, obs_run))])[0]
+            if not error is None: raise IOError('(%s,%d) refused: %s' % (task, obs, error))
+        else: self.batch.append((task, obs, obs_run))
+    def begin_batch(self):
+        '''Hold the tasks passed to tx until end_batch.'''
+        self.batch = []
+    def end_batch(self):
+        '''Send the tasks held since begin_batch in one message.  Returns
+        [(task,obs,error),...] for the tasks that were not launched.'''
+        batch, self.batch = self.batch, None
+        if not batch: return []
+        try: errors = self.tx_batch(batch)
+        except(IOError),e: errors = [str(e)] * len(batch)
+        return [(t[0],t[1],error) for (t,error) in zip(batch,errors) if not error is None]
+
 # XXX consider moving this class to a separate file
 import scheduler
 class Action(scheduler.Action):
@@ -173,13 +382,37 @@ class Action(scheduler.Action):
         self.task_client = task_clients[still]
     def _command(self):
         logger.debug('Action: task_client(%s,%d)' % (self.task, self.obs))
-        self.task_client.tx(self.task, self.obs)
+        if len(self.obs_run) > 1: self.task_client.tx_run(self.task, self.obs_run)
+        else: self.task_client.tx(self.task, self.obs)
 
 class Scheduler(scheduler.Scheduler):
-    def __init__(self, task_clients, actions_per_still=8, blocksize=10):
+    def __init__(self, task_clients, actions_per_still=8, blocksize=10, still_resources=None, max_run=1):
+        if max_run > 1 and not all([hasattr(tc, 'tx_run') for tc in task_clients]):
+            logger.warning('Scheduler: runs of obs need task clients with tx_run; launching one obs per task')
+            max_run = 1
         scheduler.Scheduler.__init__(self, nstills=len(task_clients),
-            actions_per_still=actions_per_still, blocksize=blocksize)
+            actions_per_still=actions_per_still, blocksize=blocksize, still_resources=still_resources,
+            max_run=max_run)
         self.task_clients = task_clients
+        for tc in task_clients:
+            if isinstance(tc, StreamTaskClient) and tc.on_status is None: tc.on_status = self.status_received
+    def launch_actions(self):
+        '''Launch actions as scheduler.Scheduler does, but send all those for
+        a StreamTaskClient in one message per cycle.'''
+        clients = [tc for tc in self.task_clients if isinstance(tc, StreamTaskClient)]
+        for tc in clients: tc.begin_batch()
+        try: scheduler.Scheduler.launch_actions(self)
+        finally:
+            for still,tc in enumerate(self.task_clients):
+                if not tc in clients: continue
+                for task,obs,error in tc.end_batch():
+                    a = self._launched.get((still,obs)) # obs leads the obs_run of a
+                    if not a is None: self.launch_failed(a, error)
+    def status_received(self, msg):
+        '''Pass a status message pushed by a StreamTaskServer on to notify.'''
+        status = msg['status']
+        if not status is None: status = str(status)
+        self.notify(int(msg['obs']), status=status, pid=msg['pid'])
     def kill_action(self, a):
         scheduler.Scheduler.kill_action(self, a)
         still = self.obs_to_still(a.obs)
@@ -199,17 +432,43 @@ class TaskHandler(SocketServer.BaseRequestHandler):
     def handle(self):
         task, obs, still, args = self.get_pkt()
         logger.info('TaskHandler.handle: received (%s,%d) with args=%s' % (task,obs,' '.join(args)))
-        if task == 'KILL':
-            self.server.kill(int(args[0])) #TODO I THINK THIS IS WHERE WE HAVE A PROBLE. RUN and maybe COMPLETE need to clean up existing threads.
-        elif task == 'COMPLETE':
-            self.server.dbi.set_obs_status(obs, task)
-        else:
-            t = Task(task, obs, still, args, self.server.dbi, self.server.data_dir)
-            self.server.append_task(t)
-            t.run()
+        self.server.dispatch(task, obs, still, args)
+
+class StreamTaskHandler(SocketServer.BaseRequestHandler):
+    '''Serves one StreamTaskClient connection: launches the tasks in each
+    message received, replies with an ack (or, if any task was refused, a
+    nack listing the errors), and subscribes the connection to the status
+    messages of the server.'''
+    def handle(self):
+        self.server.subscribe(self.request)
+        try:
+            while True:
+                try: msg = recv_msg(self.request)
+                except(EOFError,IOError,ValueError): break
+                if msg.get('type') != 'tasks': continue
+                errors = []
+                for entry in msg['tasks']:
+                    task, obs, still, args = entry[:4]
+                    task, still, args = str(task), str(still), map(str, args)
+                    obs_run = None
+                    if len(entry) > 4: obs_run = map(int, entry[4])
+                    logger.info('StreamTaskHandler.handle: received (%s,%d) with args=%s' % (task,obs,' '.join(args)))
+                    try:
+                        self.server.dispatch(task, int(obs), still, args, obs_run=obs_run)
+                        errors.append(None)
+                    except(Exception),e:
+                        logger.error('StreamTaskHandler.handle: (%s,%d) failed: %s' % (task,obs,e))
+                        errors.append(str(e))
+                if any([not e is None for e in errors]): reply = {'type':'nack', 'id':msg['id'], 'errors':errors}
+                else: reply = {'type':'ack', 'id':msg['id']}
+                try: self.server.send(self.request, reply)
+                except(socket.error): break
+        finally:
+            self.server.unsubscribe(self.request)
 
 class TaskServer(SocketServer.UDPServer):
     allow_reuse_address = True
+    TaskClass = Task
     def __init__(self, dbi, data_dir='.', port=STILL_PORT, handler=TaskHandler):
         SocketServer.UDPServer.__init__(self, ('', port), handler)
         self.active_tasks_semaphore = threading.Semaphore()
@@ -218,30 +477,97 @@ class TaskServer(SocketServer.UDPServer):
         self.data_dir = data_dir
         self.is_running = False
         self.watchdog_count = 0
+        self.subscribers = []
+        self.send_lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe() # written to wake finalize_tasks
+        self.last_done = None # when the last task finished, until the next launch
+        self.latencies = collections.deque(maxlen=1000) # seconds from a task finishing to the next launch
+    def wakeup(self):
+        try: os.write(self.wakeup_w, 'x')
+        except(OSError): pass
+    def dispatch(self, task, obs, still, args, obs_run=None):
+        '''Act on a task received from a client.  obs_run lists the obs a
+        task processes in one process (see Task).'''
+        if task == 'KILL':
+            self.kill(int(args[0])) #TODO I THINK THIS IS WHERE WE HAVE A PROBLE. RUN and maybe COMPLETE need to clean up existing threads.
+        elif task == 'COMPLETE':
+            self.dbi.set_obs_status(obs, task)
+            self.push_status(obs, task, task, None)
+        else:
+            t = self.TaskClass(task, obs, still, args, self.dbi, self.data_dir, obs_run=obs_run)
+            t.run()
+            self.append_task(t)
+            for o in t.obs_run: self.push_status(o, task, None, t.process.pid)
+            self.record_latency()
+    def record_latency(self):
+        '''Record the time from the last task finishing to this launch.'''
+        last_done, self.last_done = self.last_done, None
+        if last_done is None: return
+        self.latencies.append(time.time() - last_done)
+        logger.debug('TaskServer.record_latency: %.3f s from completion to launch' % self.latencies[-1])
+    def subscribe(self, sock):
+        '''Send status messages to the connection sock.'''
+        self.send_lock.acquire()
+        self.subscribers.append(sock)
+        self.send_lock.release()
+    def unsubscribe(self, sock):
+        self.send_lock.acquire()
+        if sock in self.subscribers: self.subscribers.remove(sock)
+        self.send_lock.release()
+    def send(self, sock, msg):
+        self.send_lock.acquire()
+        try: send_msg(sock, msg)
+        finally: self.send_lock.release()
+    def push_status(self, obs, task, status, pid):
+        '''Tell subscribers that, as task was launched, completed or failed,
+        obs has status (None if unchanged) and pid as recorded in the dbi.'''
+        if len(self.subscribers) == 0: return
+        msg = {'type':'status', 'obs':obs, 'task':task, 'status':status, 'pid':pid}
+        for sock in self.subscribers[:]:
+            try: self.send(sock, msg)
+            except(socket.error): self.unsubscribe(sock)
+    def task_done(self, t):
+        for obs in t.obs_run:
+            if t.poll(): self.push_status(obs, t.task, None, -9)
+            else: self.push_status(obs, t.task, t.task, 0)
+        if not t.end_time is None: self.last_done = t.end_time
     def append_task(self, t):
         self.active_tasks_semaphore.acquire()
         self.active_tasks.append(t)
         self.active_tasks_semaphore.release()
+        self.wakeup()
     def finalize_tasks(self, poll_interval=5.):
+        '''Supervise active tasks until shutdown.  Waits in select on the
+        output pipes of the tasks, which end when they exit, and on a wakeup
+        pipe written to as tasks are added, so that output is logged as it
+        arrives and completions are finalized at once.  Tasks without a
+        pipe are polled every poll_interval.'''
         while self.is_running:
             self.active_tasks_semaphore.acquire()
-            new_active_tasks = []
-            for t in self.active_tasks:
-                if t.poll() is None: # not complete
-                    new_active_tasks.append(t)
-                    try:
-                        c = t.process.children()[0]
-                        #Check the affinity!
-                        if len(c.cpu_affinity())<psutil.cpu_count():c.cpu_affinity(range(psutil.cpu_count()))
-                        logger.debug('Proc info on {obsnum}:{task}:{pid} - cpu={cpu:.1f}%%, mem={mem:.1f}%%, Naffinity={aff}'.format(
-                                    obsnum=t.obs,task=t.task,pid=c.pid,cpu=c.cpu_percent(interval=1.0),mem=c.memory_percent(),aff=len(c.cpu_affinity())))
-                    except:
-                        continue
-                else:
-                    t.finalize()
-            self.active_tasks = new_active_tasks
+            tasks = self.active_tasks[:]
             self.active_tasks_semaphore.release()
-            time.sleep(poll_interval)
+            fds = {}
+            for t in tasks:
+                if not t.fileno() is None: fds[t.fileno()] = t
+            timeout = poll_interval
+            if any([not t.end_time is None for t in tasks]): timeout = .1 # output ended, awaiting exit
+            timeout = min(timeout, SAMPLE_INTERVAL)
+            try: readable = select.select(fds.keys() + [self.wakeup_r], [], [], timeout)[0]
+            except(select.error): readable = [] # interrupted by a signal
+            if self.wakeup_r in readable: os.read(self.wakeup_r, 4096)
+            for fd in readable:
+                if fds.has_key(fd): fds[fd].read_output()
+            done = []
+            for t in tasks:
+                if t.poll() is None: t.sample() # not complete
+                else: done.append(t)
+            if len(done) > 0:
+                self.active_tasks_semaphore.acquire()
+                self.active_tasks = [t for t in self.active_tasks if not t in done]
+                self.active_tasks_semaphore.release()
+            for t in done:
+                t.finalize()
+                self.task_done(t)
             if self.watchdog_count==100:
                 logger.debug('TaskServer is alive')
                 self.watchdog_count=0
@@ -251,6 +577,7 @@ class TaskServer(SocketServer.UDPServer):
         for task in self.active_tasks:
             if task.process.pid == pid:
                 task.kill()
+                for obs in task.obs_run: self.push_status(obs, task.task, None, -9)
                 break
     def start(self):
         self.is_running = True
@@ -265,8 +592,28 @@ class TaskServer(SocketServer.UDPServer):
             t.join()
     def shutdown(self):
         self.is_running = False
+        self.wakeup()
         for t in self.active_tasks:
             try: t.process.kill()
             except(OSError): pass
         SocketServer.UDPServer.shutdown(self)
 
+class StreamTaskServer(SocketServer.ThreadingMixIn, TaskServer):
+    '''A TaskServer that takes tasks over persistent TCP connections from
+    StreamTaskClients (see StreamTaskHandler) and pushes the status of
+    tasks back over them.'''
+    daemon_threads = True
+    socket_type = socket.SOCK_STREAM
+    # TaskServer is a UDPServer: use TCPServer's handling of connections
+    server_activate = SocketServer.TCPServer.server_activate.im_func
+    get_request = SocketServer.TCPServer.get_request.im_func
+    shutdown_request = SocketServer.TCPServer.shutdown_request.im_func
+    close_request = SocketServer.TCPServer.close_request.im_func
+    def __init__(self, dbi, data_dir='.', port=STILL_PORT, handler=StreamTaskHandler):
+        TaskServer.__init__(self, dbi, data_dir=data_dir, port=port, handler=handler)
+    def shutdown(self):
+        for sock in self.subscribers[:]:
+            try: sock.shutdown(socket.SHUT_RDWR)
+            except(socket.error): pass
+        TaskServer.shutdown(self)
+        self.server_close()
@@ -0,0 +1,81 @@
+import unittest, os, shutil, tempfile, hashlib
+import ddr_compress.checksum as ck
+from ddr_compress.dbi import DataBaseInterface
+
+class CountingChecksumService(ck.ChecksumService):
+    def __init__(self, *args, **kwargs):
+        ck.ChecksumService.__init__(self, *args, **kwargs)
+        self.hashed = []
+    def _md5(self, filename):
+        self.hashed.append(os.path.basename(filename))
+        return ck.ChecksumService._md5(self, filename)
+
+def write_dataset(dataset, contents):
+    os.mkdir(dataset)
+    for name in contents:
+        f = open(os.path.join(dataset, name), 'wb')
+        f.write(contents[name])
+        f.close()
+
+class TestChecksum(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.contents = {'header':'h'*100, 'vartable':'v'*10, 'visdata':os.urandom(2**20)}
+        self.uv = os.path.join(self.dir, 'zen.2456446.1234.xx.uv')
+        write_dataset(self.uv, self.contents)
+        self.dbi = DataBaseInterface(configfile=None, test=True)
+        self.cs = CountingChecksumService(self.dbi, host='pot0', nthreads=3, blocksize=2**16)
+    def tearDown(self):
+        self.cs.close()
+        shutil.rmtree(self.dir)
+    def test_md5_file(self):
+        filename = os.path.join(self.uv, 'visdata')
+        self.assertEqual(ck.md5_file(filename, blocksize=1000), hashlib.md5(self.contents['visdata']).hexdigest())
+    def test_components(self):
+        self.assertEqual([c for c,f in ck.components(self.uv)], ['header','vartable','visdata'])
+        filename = os.path.join(self.uv, 'visdata')
+        self.assertEqual(ck.components(filename), [('',filename)])
+    def test_checksum(self):
+        digests = self.cs.checksum([self.uv])[self.uv]
+        self.assertEqual(digests, dict([(c,hashlib.md5(self.contents[c]).hexdigest()) for c in self.contents]))
+        self.assertEqual(sorted(self.cs.hashed), ['header','vartable','visdata'])
+        self.assertEqual(sorted(self.dbi.get_checksums('pot0', [self.uv])[self.uv]), ['header','vartable','visdata'])
+        # cached: nothing is read again until a component changes
+        self.cs.hashed = []
+        self.assertEqual(self.cs.checksum([self.uv])[self.uv], digests)
+        self.assertEqual(self.cs.hashed, [])
+        f = open(os.path.join(self.uv, 'header'), 'ab')
+        f.write('more')
+        f.close()
+        self.assertNotEqual(self.cs.checksum([self.uv])[self.uv]['header'], digests['header'])
+        self.assertEqual(self.cs.hashed, ['header'])
+        # another host has its own cache
+        cs = CountingChecksumService(self.dbi, host='still1')
+        cs.checksum([self.uv])
+        cs.close()
+        self.assertEqual(len(cs.hashed), 3)
+    def test_dataset_md5(self):
+        digests = self.cs.checksum([self.uv])[self.uv]
+        md5 = ck.dataset_md5(digests)
+        digests['visdata'] = digests['header']
+        self.assertNotEqual(ck.dataset_md5(digests), md5)
+        self.assertEqual(ck.dataset_md5({'':md5}), md5)
+    def test_verify(self):
+        self.cs.checksum([self.uv])
+        copy = os.path.join(self.dir, 'copy')
+        os.mkdir(copy)
+        copy = os.path.join(copy, os.path.basename(self.uv))
+        shutil.copytree(self.uv, copy)
+        still = CountingChecksumService(self.dbi, host='still1')
+        self.assertEqual(still.verify('pot0:' + self.uv, copy), [])
+        self.assertEqual(sorted(still.hashed), ['header','vartable','visdata']) # the copy, not the source
+        f = open(os.path.join(copy, 'visdata'), 'r+b')
+        f.write('x')
+        f.close()
+        os.remove(os.path.join(copy, 'vartable'))
+        self.assertEqual(still.verify('pot0:' + self.uv, copy), ['vartable','visdata'])
+        self.assertEqual(still.verify('pot1:' + self.uv, copy), None)
+        still.close()
+
+if __name__ == '__main__':
+    unittest.main()
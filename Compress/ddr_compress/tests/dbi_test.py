@@ -1,10 +1,14 @@
 import unittest, random, threading, time
 import ddr_compress.scheduler as sch
-from ddr_compress.dbi import Base,File,Observation,Log
-from ddr_compress.dbi import DataBaseInterface,jdpol2obsnum
+from ddr_compress.dbi import Base,File,Observation,Log,StatusCount
+from ddr_compress.dbi import DataBaseInterface,jdpol2obsnum,jdpol2obsnums
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine,func
+from sqlalchemy import create_engine,func,inspect
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.orm.exc import NoResultFound,MultipleResultsFound
 import numpy as n,os,sys,logging
+from datetime import datetime,timedelta
 #logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('dbi_test')
 
@@ -283,6 +287,201 @@ class TestDBI(unittest.TestCase):
         self.dbi.set_obs_pid(obsnum,9999)
         pid = self.dbi.get_obs_pid(obsnum)
         self.assertEqual(pid,9999)
+    def test_get_obs_states(self):
+        obslist =[]
+        jds = n.arange(0,3)*self.length+2456446.1234
+        for jdi in xrange(len(jds)):
+            obslist.append({'julian_date':jds[jdi],
+                            'pol':self.pol,
+                            'host':self.host,
+                            'filename':self.filename,
+                            'length':self.length})
+            if jdi!=0:
+                obslist[-1]['neighbor_low'] = jds[jdi-1]
+            if jdi!=(len(jds)-1):
+                obslist[-1]['neighbor_high'] = jds[jdi+1]
+        obsnums = self.dbi.add_observations(obslist)
+        obsnums.sort()
+        self.dbi.set_obs_pid(obsnums[1],9999)
+        states = self.dbi.get_obs_states()
+        self.assertEqual(sorted(states.keys()),obsnums)
+        for obsnum in obsnums:
+            self.assertEqual(states[obsnum]['neighbors'],self.dbi.get_neighbors(obsnum))
+            self.assertEqual(states[obsnum]['status'],'UV_POT')
+        self.assertEqual(states[obsnum]['currentpid'],None)
+        self.assertEqual(states[obsnums[1]]['currentpid'],9999)
+        states = self.dbi.get_obs_states([obsnums[0]])
+        self.assertEqual(states.keys(),[obsnums[0]])
+        self.assertEqual(states[obsnums[0]]['neighbors'],(None,obsnums[1]))
+        self.assertEqual(states[obsnums[0]]['input_file'],self.dbi.get_input_file(obsnums[0]))
+        # an obs with two input files is an error, as in get_input_file
+        self.dbi.add_file(obsnums[2],'pot1','/data1/zen.2456446.1234.uv')
+        self.assertRaises(MultipleResultsFound,self.dbi.get_input_file,obsnums[2])
+        self.assertRaises(MultipleResultsFound,self.dbi.get_obs_states)
+        self.assertRaises(MultipleResultsFound,self.dbi.get_obs_states,obsnums[2:])
+        self.assertEqual(sorted(self.dbi.get_obs_states(obsnums[:2]).keys()),obsnums[:2])
+    def test_set_obs_fields(self):
+        obsnum1 = self.dbi.add_observation(
+                    self.jd,self.pol,self.filename,self.host,length=self.length)
+        obsnum2 = self.dbi.add_observation(
+                    self.jd+self.length,self.pol,self.filename,self.host,length=self.length)
+        last = self.dbi.get_last_change()
+        self.dbi.set_obs_fields({obsnum1:{'status':'UV','currentpid':0},
+                                 obsnum2:{'stillhost':'still1','stillpath':'/data/'}})
+        states = self.dbi.get_obs_states([obsnum1,obsnum2])
+        self.assertEqual(states[obsnum1]['status'],'UV')
+        self.assertEqual(states[obsnum1]['currentpid'],0)
+        self.assertEqual(states[obsnum2]['stillhost'],'still1')
+        self.assertEqual(states[obsnum2]['stillpath'],'/data/')
+        # only status and pid changes are recorded
+        self.assertEqual(self.dbi.get_changes(last)[0][1:],(obsnum1,'UV',0))
+        self.assertEqual(len(self.dbi.get_changes(last)),1)
+        self.assertRaises(ValueError,self.dbi.set_obs_fields,{obsnum1:{'nosuchcolumn':1}})
+        self.assertRaises(NoResultFound,self.dbi.set_obs_fields,{obsnum1+10:{'status':'UV'}})
+        self.assertEqual(self.dbi.get_obs_status(obsnum1),'UV')
+    def test_task_costs(self):
+        obsnum = self.dbi.add_observation(
+                    self.jd,self.pol,self.filename,self.host)
+        self.dbi.add_task_stat(obsnum,'UVC','still1',100.,200.)
+        self.dbi.add_task_stat(obsnum,'UVC','still2',300.,400.)
+        self.dbi.add_task_stat(obsnum,'NPZ','still1',50.,10.)
+        costs = self.dbi.get_task_costs()
+        self.assertEqual(sorted(costs.keys()),['NPZ','UVC'])
+        self.assertAlmostEqual(costs['UVC'][0],2.)
+        self.assertAlmostEqual(costs['UVC'][1],300.)
+        self.assertAlmostEqual(costs['NPZ'][0],.5)
+    def test_get_stage_history(self):
+        obsnum = self.dbi.add_observation(
+                    self.jd,self.pol,self.filename,self.host)
+        t0 = datetime(2014,8,1)
+        for stage,dt,exit_status in [('UV',0,0),('UVC',100,1),('UVC',130,0),('CLEAN_UV',190,None)]:
+            self.session.add(Log(obsnum=obsnum,stage=stage,exit_status=exit_status,timestamp=t0+timedelta(seconds=dt)))
+        self.session.commit()
+        history = self.dbi.get_stage_history()
+        self.assertEqual(sorted(history.keys()),['CLEAN_UV','UV','UVC'])
+        self.assertEqual(history['UV'],([100.],0.))
+        self.assertEqual(history['UVC'],([30.,60.],.5))
+        self.assertEqual(history['CLEAN_UV'],([],0.))
+    def test_status_counts(self):
+        obslist = []
+        for i in xrange(3):
+            obslist.append({'julian_date':self.jd+i*self.length,'pol':self.pol,'host':self.host,
+                'filename':'/data0/zen.%d.uv' % i,'length':self.length})
+        obsnums = self.dbi.add_observations(obslist)
+        self.assertEqual(self.dbi.get_status_counts(),{'UV_POT':(3,0)})
+        self.dbi.set_obs_fields({obsnums[0]:{'status':'UV','stillhost':'still1','currentpid':0},
+            obsnums[1]:{'stillhost':'still1','currentpid':1234}})
+        self.dbi.set_obs_status(obsnums[2],'UV')
+        self.assertEqual(self.dbi.get_status_counts(),{'UV_POT':(1,1),'UV':(2,0)})
+        self.assertEqual(self.dbi.get_status_counts(by_host=True),
+            {('UV','still1'):(1,0),('UV',''):(1,0),('UV_POT','still1'):(1,1)})
+        self.dbi.set_obs_pid(obsnums[1],-9)
+        counts = self.dbi.get_status_counts(by_host=True)
+        self.dbi.rebuild_status_counts()
+        self.assertEqual(self.dbi.get_status_counts(by_host=True),counts)
+        self.assertEqual(counts[('UV_POT','still1')],(1,0))
+    def test_createdb_upgrade(self):
+        # the schema from before the indexes and the bookkeeping tables
+        engine = create_engine('sqlite:///',connect_args={'check_same_thread':False},poolclass=StaticPool)
+        for name in ['observation','neighbors','file','log','cal']:
+            engine.execute(CreateTable(Base.metadata.tables[name]))
+        self.assertEqual(inspect(engine).get_indexes('observation'),[])
+        self.dbi.engine = engine
+        self.dbi.Session = sessionmaker(bind=engine)
+        s = self.dbi.Session()
+        s.add(Observation(obsnum=1,julian_date=self.jd,pol=self.pol,status='UV_POT',length=self.length))
+        s.commit()
+        s.close()
+        self.dbi.createdb()
+        indexes = dict([(name,[ix['name'] for ix in inspect(engine).get_indexes(name)])
+            for name in ['observation','neighbors','file']])
+        self.assertEqual(indexes,{'observation':['ix_observation_pol_julian_date'],
+            'neighbors':['ix_neighbors_high_neighbor_id'],'file':['ix_file_obsnum']})
+        self.assertEqual(self.dbi.get_status_counts(),{'UV_POT':(1,0)})
+        self.dbi.createdb() # nothing left to add
+        self.dbi.set_obs_status(1,'UV')
+        self.assertEqual(self.dbi.get_changes()[0][1:3],(1,'UV'))
+    def test_status_counts_unbuilt(self):
+        obslist = []
+        for i in xrange(3):
+            obslist.append({'julian_date':self.jd+i*self.length,'pol':self.pol,'host':self.host,
+                'filename':'/data0/zen.%d.uv' % i,'length':self.length})
+        obsnums = self.dbi.add_observations(obslist)
+        # as in a database from before the status_count table existed
+        s = self.dbi.Session()
+        s.query(StatusCount).delete()
+        s.commit()
+        s.close()
+        self.dbi.set_obs_status(obsnums[0],'UV')
+        self.assertEqual(self.dbi.get_status_counts(),{'UV_POT':(2,0),'UV':(1,0)})
+        self.dbi.set_obs_status(obsnums[1],'UV')
+        self.assertEqual(self.dbi.get_status_counts(),{'UV_POT':(1,0),'UV':(2,0)})
+        # createdb brings an existing database up to date
+        s = self.dbi.Session()
+        s.query(StatusCount).delete()
+        s.commit()
+        s.close()
+        self.dbi.createdb()
+        self.dbi.set_obs_status(obsnums[2],'UV')
+        self.assertEqual(self.dbi.get_status_counts(),{'UV':(3,0)})
+    def test_jdpol2obsnums(self):
+        jds = n.arange(0,10)*self.length+2456446.1234
+        pols = ['xx','yy']*5
+        self.assertEqual(list(jdpol2obsnums(jds,pols,[self.length]*10)),
+            [jdpol2obsnum(jd,pol,self.length) for (jd,pol) in zip(jds,pols)])
+    def test_add_observations_night(self):
+        #add a night that continues one already in the db
+        jds = n.arange(0,20)*self.length+2456446.1234
+        def night(jds,first,last):
+            obslist = []
+            for jdi in xrange(first,last):
+                obslist.append({'julian_date':jds[jdi],'pol':self.pol,'host':self.host,
+                    'filename':'/data0/zen.%.5f.uv'%jds[jdi],'length':self.length})
+                if jdi!=0: obslist[-1]['neighbor_low'] = jds[jdi-1]
+                if jdi!=len(jds)-1: obslist[-1]['neighbor_high'] = jds[jdi+1]
+            return obslist
+        obslist = night(jds,0,10)
+        del(obslist[-1]['neighbor_high']) #the next night is not there yet
+        obsnums = self.dbi.add_observations(obslist)
+        obslist = night(jds,10,20)
+        obslist.reverse()
+        obsnums += self.dbi.add_observations(obslist)[::-1]
+        self.assertEqual(obsnums,[jdpol2obsnum(jd,self.pol,self.length) for jd in jds])
+        for i,obsnum in enumerate(obsnums):
+            low,high = self.dbi.get_neighbors(obsnum)
+            if i==0: self.assertEqual(low,None)
+            else: self.assertEqual(low,obsnums[i-1])
+            if i==len(obsnums)-1: self.assertEqual(high,None)
+            elif i!=9: self.assertEqual(high,obsnums[i+1])
+        self.assertEqual(self.dbi.get_input_file(obsnums[12])[2],'zen.%.5f.uv'%jds[12])
+        self.assertEqual(self.dbi.get_status_counts(),{'UV_POT':(20,0)})
+        #a neighbor that is nowhere to be found adds nothing
+        obslist = night(n.arange(0,3)*self.length+2456447.1234,1,3)
+        self.assertRaises(NoResultFound,self.dbi.add_observations,obslist)
+        self.assertEqual(len(self.dbi.list_observations()),20)
+    def test_get_changes(self):
+        obsnum = self.dbi.add_observation(
+                    self.jd,self.pol,self.filename,self.host)
+        last = self.dbi.get_last_change()
+        self.assertEqual(self.dbi.get_changes(),[(last,obsnum,'UV_POT',None)])
+        self.dbi.set_obs_status(obsnum,'UV')
+        self.dbi.set_obs_pid(obsnum,9999)
+        changes = self.dbi.get_changes(last)
+        self.assertEqual([c[1:] for c in changes],[(obsnum,'UV',None),(obsnum,'UV',9999)])
+        self.assertEqual(self.dbi.get_last_change(),changes[-1][0])
+        self.assertEqual(self.dbi.get_changes(changes[-1][0]),[])
+    def test_prune_changes(self):
+        obsnum = self.dbi.add_observation(
+                    self.jd,self.pol,self.filename,self.host)
+        for pid in xrange(1,6): self.dbi.set_obs_pid(obsnum,pid)
+        last = self.dbi.get_last_change()
+        self.assertEqual(self.dbi.prune_changes(keep=2),4)
+        self.assertEqual(self.dbi.get_first_change(),last-1)
+        self.assertEqual([c[3] for c in self.dbi.get_changes()],[4,5])
+        self.assertEqual(self.dbi.prune_changes(keep=0),1) # the last change is kept
+        self.assertEqual(self.dbi.get_changes(),[(last,obsnum,'UV_POT',5)])
+        self.dbi.set_obs_pid(obsnum,6)
+        self.assertEqual(self.dbi.get_last_change(),last+1) # numbering carries on
 
 if __name__=='__main__':
     unittest.main()
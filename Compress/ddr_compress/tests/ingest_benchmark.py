@@ -0,0 +1,57 @@
+#! /usr/bin/env python
+'''Time DataBaseInterface.add_observations ingesting synthetic nights into
+the sqlite test database: a large history (100k observations by default)
+in one call, then one more night on top of that history, then
+get_neighbors on the new night.  Prints the database queries each step
+costs.'''
+from ddr_compress.dbi import DataBaseInterface
+from sqlalchemy import event
+import numpy as n
+import optparse, sys, time
+
+o = optparse.OptionParser()
+o.add_option('--nobs', type='int', default=100000, help='Number of observations in the history.')
+o.add_option('--npols', type='int', default=4, help='Number of pols.')
+o.add_option('--night', type='int', default=72, help='Number of observations per pol in a night.')
+opts, args = o.parse_args(sys.argv[1:])
+
+LENGTH = 10/60./24
+POLS = ['xx','yy','xy','yx'][:opts.npols]
+
+def night(jds, first, last):
+    '''the obslist of jds[first:last] in every pol, as add_observations.py makes it'''
+    obslist = []
+    for pol in POLS:
+        for jdi in xrange(first, last):
+            obslist.append({'julian_date':jds[jdi], 'pol':pol, 'host':'pot0',
+                'filename':'/data0/zen.%.5f.%s.uv' % (jds[jdi],pol), 'length':LENGTH})
+            if jdi != 0: obslist[-1]['neighbor_low'] = jds[jdi-1]
+            if jdi != last-1: obslist[-1]['neighbor_high'] = jds[jdi+1]
+    return obslist
+
+class CountingDataBaseInterface(DataBaseInterface):
+    def __init__(self):
+        DataBaseInterface.__init__(self, configfile=None, test=True)
+        self.nqueries = 0
+        def count(*args): self.nqueries += 1
+        event.listen(self.engine, 'before_cursor_execute', count)
+
+def bench(name, dbi, func, n):
+    q0, t0 = dbi.nqueries, time.time()
+    func()
+    t = time.time() - t0
+    print '%-14s %8d obs %6d queries %10.3f s %10.1f us/obs' % (name, n, dbi.nqueries - q0, t, 1e6 * t / n)
+
+if __name__ == '__main__':
+    dbi = CountingDataBaseInterface()
+    nhist = opts.nobs / len(POLS)
+    jds = n.arange(0, nhist + opts.night) * LENGTH + 2456446.1234
+    history = night(jds, 0, nhist)
+    bench('history', dbi, lambda: dbi.add_observations(history), len(history))
+    # the new night continues the last one in the history
+    new = night(jds, nhist, nhist + opts.night)
+    for obs in new:
+        if obs['julian_date'] == jds[nhist]: obs['neighbor_low'] = jds[nhist-1]
+    obsnums = []
+    bench('night', dbi, lambda: obsnums.extend(dbi.add_observations(new)), len(new))
+    bench('get_neighbors', dbi, lambda: [dbi.get_neighbors(obsnum) for obsnum in obsnums], len(obsnums))
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+'''Count the database queries (and time) that one scheduling cycle costs
+against the in-memory sqlite test database: polling each obs through the
+per-obs DataBaseInterface getters, polling with one bulk get_obs_states
+read, and following status changes in event-driven mode.  Also counts the
+queries TaskClient.gen_args makes per task.'''
+import ddr_compress.scheduler as sch
+import ddr_compress.task_server as ts
+from ddr_compress.dbi import DataBaseInterface
+from sqlalchemy import event
+import numpy as n
+import logging, optparse, sys, time
+
+o = optparse.OptionParser()
+o.add_option('--nobs', type='int', default=200, help='Number of observations per pol.')
+o.add_option('--npols', type='int', default=2, help='Number of pols.')
+o.add_option('--nchanges', type='int', default=10, help='Status changes per event-driven cycle.')
+opts, args = o.parse_args(sys.argv[1:])
+logging.getLogger('scheduler').setLevel(logging.WARNING)
+
+class CountingDataBaseInterface(DataBaseInterface):
+    def __init__(self, nobs, npols):
+        DataBaseInterface.__init__(self, configfile=None, test=True)
+        self.nqueries = 0
+        def count(*args): self.nqueries += 1
+        event.listen(self.engine, 'before_cursor_execute', count)
+        length = 10/60./24
+        jds = n.arange(0,nobs)*length+2456446.1234
+        obslist = []
+        for pol in ['xx','yy','xy','yx'][:npols]:
+            for jdi in xrange(len(jds)):
+                obslist.append({'julian_date':jds[jdi], 'pol':pol, 'host':'pot0',
+                    'filename':'/data0/zen.%.5f.uv' % jds[jdi], 'length':length})
+                if jdi != 0: obslist[-1]['neighbor_low'] = jds[jdi-1]
+                if jdi != len(jds)-1: obslist[-1]['neighbor_high'] = jds[jdi+1]
+        self.add_observations(obslist)
+
+def bench(name, dbi, cycle):
+    q0, t0 = dbi.nqueries, time.time()
+    cycle()
+    print '%-10s %8d queries %10.3f s' % (name, dbi.nqueries - q0, time.time() - t0)
+
+if __name__ == '__main__':
+    dbi = CountingDataBaseInterface(opts.nobs, opts.npols)
+    obsnums = dbi.list_observations()
+    print '%d observations' % len(obsnums)
+    def polling():
+        s = sch.Scheduler(nstills=4)
+        s.get_new_active_obs(dbi)
+        s.update_action_queue(dbi)
+        s.clean_completed_actions(dbi)
+    def bulk():
+        s = sch.Scheduler(nstills=4)
+        states = sch.StateTable()
+        states.load(dbi, changes=False)
+        s.get_new_active_obs(states)
+        s.update_action_queue(states)
+        s.clean_completed_actions(states)
+    s = sch.Scheduler(nstills=4)
+    s.states = sch.StateTable()
+    s.states.load(dbi)
+    s.update_changed_actions(s.states, s.states.pop_dirty())
+    def event_driven():
+        s.states.refresh(dbi)
+        s.update_changed_actions(s.states, s.states.pop_dirty())
+        s.clean_completed_actions(s.states)
+    bench('polling', dbi, polling)
+    bench('bulk', dbi, bulk)
+    bench('event', dbi, event_driven)
+    dbi.set_obs_fields(dict([(obs,{'status':'UV'}) for obs in obsnums[:opts.nchanges]]))
+    bench('event+%d' % opts.nchanges, dbi, event_driven)
+    tc = ts.TaskClient(dbi, 'localhost')
+    bench('gen_args', dbi, lambda: tc.gen_args('UVCRE', obsnums[len(obsnums)/2]))
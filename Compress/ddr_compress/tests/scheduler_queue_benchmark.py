@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+'''Drive a Scheduler against a fake DataBaseInterface holding many
+observations, where every launched action completes at once, and report
+scheduling decisions (actions launched) per second, in polling and in
+event-driven mode.'''
+import ddr_compress.scheduler as sch
+from scheduler_test import FakeEventDataBaseInterface
+import logging, optparse, sys, time
+
+o = optparse.OptionParser()
+o.add_option('--nobs', type='int', default=50000, help='Number of observations.')
+o.add_option('--nstills', type='int', default=4, help='Number of stills.')
+o.add_option('--ncycles', type='int', default=200, help='Number of event-driven scheduling cycles.')
+o.add_option('--npoll', type='int', default=3, help='Number of polling scheduling cycles.')
+opts, args = o.parse_args(sys.argv[1:])
+logging.getLogger('scheduler').setLevel(logging.WARNING)
+
+def run(event_driven, ncycles):
+    dbi = FakeEventDataBaseInterface(opts.nobs)
+    class FakeAction(sch.Action):
+        def _command(self): dbi.set_obs_status(self.obs, self.task)
+    s = sch.Scheduler(nstills=opts.nstills, actions_per_still=8, blocksize=10)
+    nlaunched = [0]
+    launch_action = s.launch_action
+    def count(a):
+        nlaunched[0] += 1
+        launch_action(a)
+    s.launch_action = count
+    t0 = time.time()
+    if event_driven:
+        s.states = sch.StateTable()
+        s.states.load(dbi)
+    t1 = time.time()
+    for i in xrange(ncycles):
+        if event_driven:
+            s.states.refresh(dbi)
+            s.update_changed_actions(s.states, s.states.pop_dirty(), FakeAction)
+            states = s.states
+        else:
+            states = sch.StateTable()
+            states.load(dbi, changes=False)
+            s.get_new_active_obs(states)
+            s.update_action_queue(states, FakeAction)
+        s.launch_actions()
+        s.clean_completed_actions(states)
+    t2 = time.time()
+    print '%-8s load %7.3f s   %7.4f s/cycle   %9.1f decisions/s' % (
+        event_driven and 'event' or 'polling', t1 - t0, (t2 - t1) / ncycles, nlaunched[0] / (t2 - t1))
+
+if __name__ == '__main__':
+    print '%d observations, %d stills' % (opts.nobs, opts.nstills)
+    run(False, opts.npoll)
+    run(True, opts.ncycles)
@@ -10,6 +10,7 @@ class FakeDataBaseInterface:
         self.files = {}
         for i in xrange(nfiles):
             self.files[i] = 'UV_POT'
+        self.pids = {}
     def get_obs_status(self, obsnum):
         return self.files[obsnum]
     def list_observations(self):
@@ -21,6 +22,37 @@ class FakeDataBaseInterface:
         if not self.files.has_key(n1): n1 = None
         if not self.files.has_key(n2): n2 = None
         return (n1,n2)
+    def get_obs_pid(self, obsnum):
+        return self.pids.get(obsnum, None)
+    def get_terminal_obs(self):
+        return []
+
+class FakeEventDataBaseInterface(FakeDataBaseInterface):
+    '''Also records status changes, as DataBaseInterface does.'''
+    def __init__(self, nfiles=10):
+        FakeDataBaseInterface.__init__(self, nfiles)
+        self.changes = []
+        self.nqueries = 0
+    def get_obs_status(self, obsnum):
+        self.nqueries += 1
+        return FakeDataBaseInterface.get_obs_status(self, obsnum)
+    def set_obs_status(self, obsnum, status):
+        self.files[obsnum] = status
+        self.changes.append((self.get_last_change()+1, obsnum, status, self.get_obs_pid(obsnum)))
+    def get_changes(self, since=0):
+        return [c for c in self.changes if c[0] > since]
+    def get_last_change(self):
+        if len(self.changes) == 0: return 0
+        return self.changes[-1][0]
+    def get_first_change(self):
+        if len(self.changes) == 0: return 0
+        return self.changes[0][0]
+    def prune_changes(self, keep=1000):
+        self.changes = self.changes[-keep:]
+    def get_obs_states(self, obsnums=None):
+        if obsnums is None: obsnums = self.files.keys()
+        return dict([(f, {'status':self.files[f], 'currentpid':self.get_obs_pid(f),
+            'neighbors':self.get_neighbors(f)}) for f in obsnums])
 
 class TestAction(unittest.TestCase):
     def setUp(self):
@@ -56,6 +88,40 @@ class TestAction(unittest.TestCase):
         for cnt,a in enumerate(actions):
             self.assertEqual(a.priority, cnt)
         
+class TestActionQueue(unittest.TestCase):
+    def setUp(self):
+        self.actions = []
+        for obs in xrange(20):
+            a = sch.Action(obs, 'UV', [], obs % 2)
+            a.set_priority(random.random())
+            self.actions.append(a)
+    def test_pop(self):
+        q = sch.ActionQueue()
+        for a in self.actions: q.push(a)
+        self.assertEqual(len(q), 20)
+        for still in (0,1):
+            ans = [a for a in self.actions if a.still == still]
+            ans.sort(sch.action_cmp, reverse=True)
+            for a in ans: self.assertEqual(q.pop(still), a)
+            self.assertRaises(IndexError, q.pop, still)
+            self.assertRaises(IndexError, q.pop, still, True)
+        self.assertEqual(len(q), 0)
+    def test_push_remove(self):
+        q = sch.ActionQueue()
+        q.reset(self.actions)
+        a = sch.Action(4, 'UVC', [], 0)
+        a.set_priority(2)
+        q.push(a) # replaces the action queued for obs 4
+        self.assertEqual(len(q), 20)
+        self.assertEqual(q.get(4), a)
+        self.assertEqual(q.pop(0), a)
+        self.assertFalse(4 in q)
+        for obs in xrange(0,20,4): q.remove(obs)
+        self.assertEqual(len(q), 15)
+        ans = [a for a in self.actions if a.obs % 4 != 0]
+        ans.sort(sch.action_cmp, reverse=True)
+        self.assertEqual(q.actions(), ans)
+
 class TestScheduler(unittest.TestCase):
     def setUp(self):
         self.nfiles = 10
@@ -159,7 +225,164 @@ class TestScheduler(unittest.TestCase):
             #for f in dbi.files:
             #    print f, dbi.files[f]
             for f in dbi.files: self.assertEqual(dbi.get_obs_status(f), 'COMPLETE')
-        
+
+class TestResourceScheduler(unittest.TestCase):
+    def setUp(self):
+        self.dbi = FakeDataBaseInterface(20)
+    def launched(self, costs):
+        s = sch.Scheduler(nstills=1, actions_per_still=8, blocksize=10, still_resources=[(4,1000.)])
+        s.task_costs = costs
+        s.get_new_active_obs(self.dbi)
+        s.update_action_queue(self.dbi, ActionClass=NullAction)
+        s.launch_actions()
+        return s
+    def test_pack(self):
+        s = self.launched({'UV':(1.,600.)}) # memory bound
+        self.assertEqual(len(s.launched_actions[0]), 1)
+        s = self.launched({'UV':(1.,100.)}) # core bound
+        self.assertEqual(len(s.launched_actions[0]), 4)
+        s = self.launched({'UV':(.1,10.)}) # capped by actions_per_still
+        self.assertEqual(len(s.launched_actions[0]), 8)
+        s = self.launched({'UV':(8.,2000.)}) # too big for the still: run one at a time
+        self.assertEqual(len(s.launched_actions[0]), 1)
+        self.assertEqual(len(s.action_queue), 19)
+    def test_lookahead(self):
+        s = sch.Scheduler(nstills=1, actions_per_still=8, blocksize=10, still_resources=[(4,1000.)])
+        s.task_costs = {'UV':(1.,600.), 'UVC':(1.,100.)}
+        for obs in xrange(3):
+            a = NullAction(obs, obs == 1 and 'UVC' or 'UV', [], 0)
+            a.set_priority(10-obs)
+            s.queue.push(a)
+        s.launch_actions()
+        # the second UV does not fit beside the first, but the cheaper UVC does
+        self.assertEqual([a.obs for a in s.launched_actions[0]], [0,1])
+        self.assertEqual([a.obs for a in s.action_queue], [2])
+
+class TestRunScheduler(unittest.TestCase):
+    def setUp(self):
+        self.dbi = FakeDataBaseInterface(20)
+        for f in self.dbi.files: self.dbi.files[f] = 'UV' # next is UVC, which takes runs
+    def test_gather_run(self):
+        s = sch.Scheduler(nstills=1, actions_per_still=2, blocksize=10, max_run=4)
+        s.get_new_active_obs(self.dbi)
+        s.update_action_queue(self.dbi, ActionClass=NullAction)
+        s.launch_actions()
+        self.assertEqual([a.obs_run for a in s.launched_actions[0]], [[16,17,18,19],[12,13,14,15]])
+        self.assertEqual(len(s.action_queue), 12)
+        self.assertTrue(s.already_launched(NullAction(17, 'UVC', [], 0)))
+        s.update_action_queue(self.dbi, ActionClass=NullAction)
+        self.assertEqual(len(s.action_queue), 12)
+    def test_stills(self):
+        # runs stay on one still, and only gather actions for the same task
+        self.dbi.files[7] = 'UVC'
+        s = sch.Scheduler(nstills=2, actions_per_still=8, blocksize=5, max_run=10)
+        s.get_new_active_obs(self.dbi)
+        s.update_action_queue(self.dbi, ActionClass=NullAction)
+        s.launch_actions()
+        runs = [a.obs_run for still in s.launched_actions for a in s.launched_actions[still] if a.task == 'UVC']
+        runs.sort()
+        self.assertEqual(runs, [[0,1,2,3,4],[5,6],[8,9],[10,11,12,13,14],[15,16,17,18,19]])
+    def test_single(self):
+        s = sch.Scheduler(nstills=1, actions_per_still=2, blocksize=10, max_run=4)
+        for f in self.dbi.files: self.dbi.files[f] = 'UV_POT' # UV does not take runs
+        s.get_new_active_obs(self.dbi)
+        s.update_action_queue(self.dbi, ActionClass=NullAction)
+        s.launch_actions()
+        self.assertEqual([a.obs_run for a in s.launched_actions[0]], [[19],[18]])
+    def test_start(self):
+        dbi = self.dbi
+        class FakeAction(sch.Action):
+            def _command(self):
+                for f in self.obs_run: dbi.files[f] = self.task
+        s = sch.Scheduler(nstills=1, actions_per_still=1, blocksize=10, max_run=5)
+        t = threading.Thread(target=s.start, args=(dbi, FakeAction), kwargs={'sleeptime':0})
+        t.start()
+        tstart = time.time()
+        while time.time() - tstart < 2:
+            if all([dbi.get_obs_status(f) == 'COMPLETE' for f in dbi.files]): break
+            time.sleep(.1)
+        s.quit()
+        t.join()
+        for f in dbi.files: self.assertEqual(dbi.get_obs_status(f), 'COMPLETE')
+
+class TestStateTable(unittest.TestCase):
+    def setUp(self):
+        self.dbi = FakeEventDataBaseInterface(10)
+        self.states = sch.StateTable()
+        self.states.load(self.dbi)
+    def test_load(self):
+        self.assertEqual(self.states.list_observations(), self.dbi.list_observations())
+        self.assertEqual(self.states.get_neighbors(0), (None,1))
+        self.assertEqual(self.states.pop_dirty(), set(range(10)))
+        self.assertEqual(self.states.pop_dirty(), set())
+    def test_refresh(self):
+        self.states.pop_dirty()
+        self.dbi.set_obs_status(5, 'UV')
+        self.states.refresh(self.dbi)
+        self.assertEqual(self.states.get_obs_status(5), 'UV')
+        self.assertEqual(self.states.pop_dirty(), set([4,5,6]))
+        self.states.refresh(self.dbi) # changes are only applied once
+        self.assertEqual(self.states.pop_dirty(), set())
+    def test_new_obs(self):
+        self.states.pop_dirty()
+        self.dbi.set_obs_status(10, 'UV_POT')
+        self.states.refresh(self.dbi)
+        self.assertEqual(self.states.get_neighbors(10), (9,None))
+        self.assertEqual(self.states.get_neighbors(9), (8,10)) # no longer an end file
+        self.assertEqual(self.states.pop_dirty(), set([9,10]))
+    def test_pruned(self):
+        self.states.pop_dirty()
+        self.dbi.set_obs_status(3, 'UV')
+        self.dbi.set_obs_status(5, 'UV')
+        self.dbi.prune_changes(keep=1) # the change to 3 is lost
+        self.states.refresh(self.dbi)
+        self.assertEqual(self.states.get_obs_status(3), 'UV')
+        self.assertEqual(self.states.pop_dirty(), set(range(10)))
+        self.dbi.set_obs_status(7, 'UV')
+        self.states.refresh(self.dbi)
+        self.assertEqual(self.states.pop_dirty(), set([6,7,8]))
+
+class TestEventScheduler(unittest.TestCase):
+    def test_update_changed_actions(self):
+        dbi = FakeEventDataBaseInterface(10)
+        s = sch.Scheduler(nstills=1, actions_per_still=1, blocksize=10)
+        s.states = sch.StateTable()
+        s.states.load(dbi)
+        s.update_changed_actions(s.states, s.states.pop_dirty())
+        self.assertEqual(len(s.action_queue), 10)
+        for a in s.action_queue: self.assertEqual(a.task, 'UV')
+        self.assertGreater(s.action_queue[0].priority, s.action_queue[-1].priority)
+        a = s.pop_action_queue(0)
+        s.launch_action(a)
+        dbi.set_obs_status(a.obs, a.task)
+        s.states.refresh(dbi)
+        s.clean_completed_actions(s.states)
+        self.assertEqual(len(s.launched_actions[0]), 0)
+        dirty = s.states.pop_dirty()
+        self.assertEqual(dirty, set([a.obs-1, a.obs]))
+        s.update_changed_actions(s.states, dirty)
+        self.assertEqual(len(s.action_queue), 10)
+        self.assertEqual(s.queue.get(a.obs).task, 'UVC')
+    def test_start(self):
+        dbi = FakeEventDataBaseInterface(10)
+        class FakeAction(sch.Action):
+            def _command(self):
+                dbi.set_obs_status(self.obs, self.task)
+        def all_done():
+            for f in dbi.files:
+                if dbi.files[f] != 'COMPLETE': return False
+            return True
+        s = sch.Scheduler(nstills=1, actions_per_still=1, blocksize=10)
+        t = threading.Thread(target=s.start, args=(dbi, FakeAction), kwargs={'sleeptime':0, 'event_driven':True})
+        t.start()
+        tstart = time.time()
+        while not all_done() and time.time() - tstart < 5: time.sleep(.1)
+        s.quit()
+        t.join()
+        for f in dbi.files: self.assertEqual(dbi.files[f], 'COMPLETE')
+        # statuses were never polled from the database
+        self.assertEqual(dbi.nqueries, 0)
+
 
 if __name__ == '__main__':
     unittest.main()
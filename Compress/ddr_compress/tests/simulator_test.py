@@ -0,0 +1,63 @@
+import unittest, random
+import ddr_compress.scheduler as sch
+import ddr_compress.simulator as sim
+import logging; logging.getLogger('scheduler').setLevel(logging.WARNING)
+
+class FakeDataBaseInterface:
+    def get_stage_history(self):
+        return {'UV':([10.,20.],0.), 'UVC':([30.],.5), 'CLEAN_UV':([],0.)}
+
+class TestStageModel(unittest.TestCase):
+    def test_sample(self):
+        m = sim.StageModel({'UV':[10.,20.]}, {'UVC':1.}, default_duration=5.)
+        rng = random.Random(0)
+        for i in xrange(10):
+            d,f = m.sample('UV', rng)
+            self.assertTrue(d in [10.,20.])
+            self.assertFalse(f)
+        self.assertEqual(m.sample('UVC', rng), (5.,True))
+    def test_load(self):
+        m = sim.load_stage_model(FakeDataBaseInterface(), default_duration=5.)
+        self.assertEqual(m.durations, {'UV':[10.,20.], 'UVC':[30.]})
+        self.assertEqual(m.failures['UVC'], .5)
+        self.assertEqual(m.sample('CLEAN_UV'), (5.,False))
+
+class TestSimulator(unittest.TestCase):
+    def run_sim(self, actions_per_still, model=None, until=None, **kwargs):
+        if model is None: model = sim.StageModel(default_duration=100.)
+        s = sch.Scheduler(nstills=2, actions_per_still=actions_per_still, blocksize=5)
+        return sim.Simulator(s, model, seed=0, **kwargs).run(until=until)
+    def test_complete(self):
+        r = self.run_sim(4, nobs=20, npols=2)
+        self.assertEqual(r['nobs'], 40)
+        self.assertEqual(r['ncomplete'], 40)
+        self.assertEqual(r['nfailed'], 0)
+        self.assertEqual(len(r['latency']), 40)
+        self.assertTrue(r['time_to_complete'] <= r['time'])
+        for still in r['utilisation']:
+            self.assertTrue(0 < r['utilisation'][still] <= 1)
+    def test_slots(self):
+        # fewer action slots than the stages need to keep up: obs pile up
+        slow = self.run_sim(1, nobs=20, cadence=300.)
+        fast = self.run_sim(8, nobs=20, cadence=300.)
+        self.assertGreater(slow['time_to_complete'], fast['time_to_complete'])
+        self.assertGreater(slow['mean_queue'], fast['mean_queue'])
+        self.assertGreater(max(slow['latency']), max(fast['latency']))
+    def test_failures(self):
+        model = sim.StageModel({}, {'UVC':1.}, default_duration=10.)
+        r = self.run_sim(4, model=model, nobs=5)
+        self.assertEqual(r['ncomplete'], 0)
+        self.assertEqual(r['nfailed'], 5)
+        self.assertEqual(r['time_to_complete'], None)
+    def test_timeout(self):
+        model = sim.StageModel({'UVC':[10000.]}, default_duration=10.)
+        r = self.run_sim(4, model=model, nobs=3, timeout=100.)
+        self.assertEqual(r['ncomplete'], 0)
+        self.assertEqual(r['nfailed'], 3)
+    def test_until(self):
+        r = self.run_sim(4, nobs=20, cadence=600., until=3000.)
+        self.assertEqual(r['nobs'], 6)
+        self.assertTrue(r['time'] <= 3000.)
+
+if __name__ == '__main__':
+    unittest.main()
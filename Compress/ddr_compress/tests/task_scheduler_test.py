@@ -45,6 +45,17 @@ class FakeDataBaseInterface:
         self.stills[obsnum] = host
     def set_obs_still_path(self, obsnum, path):
         self.paths[obsnum] = path
+    def get_terminal_obs(self):
+        return []
+    def get_obs_states(self, obsnums=None):
+        if obsnums is None: obsnums = self.files.keys()
+        return dict([(f, {'status':self.files[f], 'currentpid':self.pids[f],
+            'stillhost':self.stills[f], 'stillpath':self.paths[f],
+            'neighbors':self.get_neighbors(f), 'input_file':self.get_input_file(f)}) for f in obsnums])
+    def set_obs_fields(self, updates):
+        columns = {'status':self.files, 'currentpid':self.pids, 'stillhost':self.stills, 'stillpath':self.paths}
+        for f,fields in updates.iteritems():
+            for k,v in fields.iteritems(): columns[k][f] = v
 
 class TestTaskScheduler(unittest.TestCase):
     def setUp(self):
@@ -11,12 +11,19 @@ class NullTask(ts.Task):
     def _run(self):
         return subprocess.Popen(['ls'], stdout=open(os.devnull,'w'), cwd=self.cwd)
 
+class EchoTask(ts.Task):
+    def _run(self):
+        return subprocess.Popen(['sh','-c','echo hello; sleep .2; echo world'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
 class FakeDataBaseInterface:
     def __init__(self, nfiles=10):
         self.files = {}
         self.pids = {}
         self.stills = {}
         self.paths = {}
+        self.stats = []
+        self.logs = []
         for i in xrange(nfiles):
             self.files[i] = 'UV_POT'
             self.pids[i] = -1
@@ -51,6 +58,21 @@ class FakeDataBaseInterface:
         self.stills[obsnum] = host
     def set_obs_still_path(self, obsnum, path):
         self.paths[obsnum] = path
+    def get_obs_states(self, obsnums=None):
+        if obsnums is None: obsnums = self.files.keys()
+        return dict([(f, {'status':self.files[f], 'currentpid':self.pids[f],
+            'stillhost':self.stills[f], 'stillpath':self.paths[f],
+            'neighbors':self.get_neighbors(f), 'input_file':self.get_input_file(f)}) for f in obsnums])
+    def add_log(self, obsnum, status, logtext, exit_status):
+        pass
+    def update_log(self, obsnum, status=None, logtext=None, exit_status=None, append=True):
+        if not logtext is None: self.logs.append((obsnum, logtext))
+    def add_task_stat(self, obsnum, task, host, cpu, mem):
+        self.stats.append((obsnum, task, host, cpu, mem))
+    def set_obs_fields(self, updates):
+        columns = {'status':self.files, 'currentpid':self.pids, 'stillhost':self.stills, 'stillpath':self.paths}
+        for f,fields in updates.iteritems():
+            for k,v in fields.iteritems(): columns[k][f] = v
 
 class TestFunctions(unittest.TestCase):
     def test_pad(self):
@@ -106,6 +128,23 @@ class TestTask(unittest.TestCase):
         self.assertEqual(t.poll(), -9)
         self.assertLess(end_t-start_t, 100)
         self.assertEqual(dbi.get_obs_status(1), 'UV_POT')
+    def test_usage(self):
+        dbi = FakeDataBaseInterface()
+        t = NullTask('UVC',1,'still',[],dbi)
+        t.sample_usage(50., 100.)
+        t.sample_usage(20., 300.)
+        t.record_usage()
+        self.assertEqual(dbi.stats, [(1,'UVC','still',50.,300.)])
+    def test_output(self):
+        dbi = FakeDataBaseInterface()
+        t = EchoTask('UVC',1,'still',[],dbi)
+        t.run()
+        while t.poll() is None: time.sleep(.01)
+        self.assertEqual(dbi.logs, []) # output is held for LOG_INTERVAL
+        t.finalize()
+        self.assertEqual(''.join([log for (obs,log) in dbi.logs]), 'hello\nworld\n')
+        self.assertEqual(t.fileno(), None)
+        self.assertEqual(dbi.get_obs_status(1), 'UVC')
 
 class TestTaskServer(unittest.TestCase):
     def setUp(self):
@@ -125,6 +164,29 @@ class TestTaskServer(unittest.TestCase):
         s.is_running = False
         thd.join()
         self.assertEqual(len(s.active_tasks),0)
+    def test_finalize_tasks(self):
+        s = ts.TaskServer(self.dbi)
+        s.is_running = True
+        thd = threading.Thread(target=s.finalize_tasks, args=(100.,))
+        thd.start()
+        try:
+            t0 = time.time()
+            t = EchoTask('UVC',1,'still',[],self.dbi)
+            t.run()
+            s.append_task(t) # wakes finalize_tasks to watch t
+            while len(s.active_tasks) > 0: time.sleep(.01)
+            self.assertLess(time.time() - t0, 5.) # not the poll interval
+            while self.dbi.get_obs_status(1) != 'UVC': time.sleep(.01)
+            self.assertEqual(''.join([log for (obs,log) in self.dbi.logs]), 'hello\nworld\n')
+            self.assertFalse(s.last_done is None)
+            s.record_latency()
+            self.assertEqual(len(s.latencies), 1)
+            self.assertTrue(s.last_done is None)
+        finally:
+            s.is_running = False
+            s.wakeup()
+            thd.join()
+            s.server_close()
     def test_shutdown(self):
         s = ts.TaskServer(self.dbi)
         t = threading.Thread(target=s.start)
@@ -183,6 +245,10 @@ class TestTaskClient(unittest.TestCase):
     def test_attributes(self):
         tc = ts.TaskClient(self.dbi, 'localhost')
         self.assertEqual(tc.host_port, ('localhost', ts.STILL_PORT))
+    def test_no_runs(self):
+        tc = ts.TaskClient(self.dbi, 'localhost')
+        self.assertFalse(hasattr(tc, 'tx_run'))
+        self.assertEqual(ts.Scheduler([tc], max_run=4).max_run, 1)
     def test__tx(self):
         self.pkt = ''
         class SleepHandler(ts.TaskHandler):
@@ -212,6 +278,15 @@ class TestTaskClient(unittest.TestCase):
                 self.assertEqual(len(args), 0)
             elif task in ['UV','NPZ_POT','UVCRRE_POT']:
                 self.assertEqual(len(args), 2)
+    def test_gen_run_args(self):
+        class NamedDataBaseInterface(FakeDataBaseInterface):
+            def get_input_file(self, obsnum):
+                return 'localhost','.','zen.%d.uv' % obsnum
+        tc = ts.TaskClient(NamedDataBaseInterface(), 'localhost')
+        self.assertEqual(tc.gen_run_args('UVC', [3,4,5]), ['zen.3.uv','zen.4.uv','zen.5.uv'])
+        self.assertEqual(tc.gen_run_args('UVCRE', [3,4,5]),
+            ['zen.2.uvcR','zen.3.uvcR','zen.4.uvcR','zen.5.uvcR','zen.6.uvcR'])
+        self.assertEqual(tc.gen_run_args('UVCRE', [4]), tc.gen_args('UVCRE', 4))
     def test_tx(self):
         self.pkt = ''
         class SleepHandler(ts.TaskHandler):
@@ -228,6 +303,84 @@ class TestTaskClient(unittest.TestCase):
             thd.join()
         self.assertEqual(self.pkt, ('UV',1,'localhost',['test.uv', 'localhost:./test.uv']))
 
+class TestStreamTaskServer(unittest.TestCase):
+    def setUp(self):
+        self.dbi = FakeDataBaseInterface()
+        for f in self.dbi.files: self.dbi.files[f] = 'UV_POT'
+        class NullTaskServer(ts.StreamTaskServer):
+            TaskClass = NullTask
+        self.s = NullTaskServer(self.dbi)
+        self.thd = threading.Thread(target=self.s.start)
+        self.thd.start()
+        self.statuses = []
+        self.tc = ts.StreamTaskClient(self.dbi, 'localhost', on_status=self.statuses.append, timeout=5.)
+    def tearDown(self):
+        self.tc.close()
+        self.s.shutdown()
+        self.thd.join()
+    def test_msg(self):
+        a, b = socket.socketpair()
+        ts.send_msg(a, {'type':'tasks', 'id':1, 'tasks':[['UV',1,'still',['a','b']]]})
+        ts.send_msg(a, {'type':'ack', 'id':1})
+        self.assertEqual(ts.recv_msg(b), {'type':'tasks', 'id':1, 'tasks':[['UV',1,'still',['a','b']]]})
+        self.assertEqual(ts.recv_msg(b), {'type':'ack', 'id':1})
+        a.close()
+        self.assertRaises(EOFError, ts.recv_msg, b)
+        b.close()
+    def test_tx(self):
+        self.tc.tx('UV', 1)
+        self.assertEqual(len(self.s.active_tasks), 1)
+        pid = self.s.active_tasks[0].process.pid
+        self.assertEqual(self.dbi.get_obs_pid(1), pid)
+        while len(self.statuses) < 2: time.sleep(.1)
+        self.assertEqual(self.dbi.get_obs_status(1), 'UV')
+        self.assertEqual(self.statuses[0], {'type':'status', 'obs':1, 'task':'UV', 'status':None, 'pid':pid})
+        self.assertEqual(self.statuses[1], {'type':'status', 'obs':1, 'task':'UV', 'status':'UV', 'pid':0})
+    def test_tx_batch(self):
+        self.s.TaskClass = SleepTask # still active when counted
+        self.assertEqual(self.tc.tx_batch([('UV',1), ('UV',2), ('UV',3)]), [None,None,None])
+        self.assertEqual(len(self.s.active_tasks), 3)
+        for t in self.s.active_tasks: self.assertEqual(self.dbi.get_obs_pid(t.obs), t.process.pid)
+    def test_nack(self):
+        class FailTask(ts.Task):
+            def _run(self): raise OSError('no such script')
+        self.s.TaskClass = FailTask
+        errors = self.tc.tx_batch([('UV',1), ('COMPLETE',2)])
+        self.assertEqual(len(errors), 2)
+        self.assertFalse(errors[0] is None)
+        self.assertTrue(errors[1] is None)
+        self.assertEqual(self.dbi.get_obs_status(2), 'COMPLETE')
+        self.assertRaises(IOError, self.tc.tx, 'UV', 1)
+    def test_reconnect(self):
+        self.s.TaskClass = SleepTask # still active when counted
+        self.tc.tx_batch([('UV',1)])
+        self.tc.sock.close() # drop the connection under the client
+        self.tc.sock = None
+        self.tc.tx('UV', 2)
+        self.assertEqual(len(self.s.active_tasks), 2)
+    def test_tx_run(self):
+        self.s.TaskClass = SleepTask
+        self.tc.tx_run('UVC', [1,2,3])
+        self.assertEqual(len(self.s.active_tasks), 1)
+        t = self.s.active_tasks[0]
+        self.assertEqual(t.obs_run, [1,2,3])
+        for f in [1,2,3]: self.assertEqual(self.dbi.get_obs_pid(f), t.process.pid)
+        self.assertEqual([m['obs'] for m in self.statuses], [1,2,3])
+        t.record_completion()
+        for f in [1,2,3]: self.assertEqual(self.dbi.get_obs_status(f), 'UVC')
+    def test_scheduler(self):
+        self.tc.on_status = None
+        s = ts.Scheduler([self.tc], actions_per_still=2)
+        a = ts.Action(1, 'UV', ['UV_POT','UV_POT'], 0, [self.tc])
+        s.launch_action(a)
+        self.assertTrue(s.already_launched(a))
+        notices = []
+        while len(notices) < 2: notices += s.wait_for_notices(1.)
+        self.assertEqual(notices[-1], (1, 'UV', 0))
+        self.s.TaskClass = NotImplemented # every launch now fails
+        s.queue.push(ts.Action(2, 'UV', ['UV_POT','UV_POT'], 0, [self.tc]))
+        s.launch_actions()
+        self.assertEqual(s.get_launched_actions(0), [a])
 
 if __name__ == '__main__':
     unittest.main()
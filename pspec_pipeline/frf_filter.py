@@ -35,8 +35,7 @@ seps = [ bl2sep[b] for b in ants ]
 seps = n.unique(seps)
 print 'These are the separations that we are going to use:', seps
     
-#Get the fir filters for the separation used
-bins = fringe.gen_frbins(inttime)
+#Get the fir filters for the separation used (cached across runs, see capo.frf.get_firs)
 firs = {}
 for sep in seps:
     c = 0 #baseline indices
@@ -45,8 +44,7 @@ for sep in seps:
         bl = a.miriad.ij2bl(*ij)
         if blconj[bl]: c+=1
         else: break #find when conjugation isn't necessary
-    frp, bins = fringe.aa_to_fr_profile(aa, ij, 100, pol=pol, bins=bins) 
-    timebins, firs[sep] = fringe.frp_to_firs(frp, bins, aa.get_freqs(), fq0=aa.get_freqs()[100])
+    timebins, firs[sep] = C.frf.get_firs(aa, ij, 100, inttime, pol=pol, fq0=aa.get_freqs()[100])
 
 
 baselines = ''.join(sep2ij[sep] for sep in seps)
@@ -63,50 +61,22 @@ for bl in data: #orders data and flags correctly by LST
         flags[bl][pol] = flags[bl][pol][lst_order]
 _d = {}
 _w = {}
-bins = fringe.gen_frbins(inttime)
+#group baselines by separation so each sep is filtered as one (nbl,ntime,nchan) block
+sepbls = {}
 for bl in data.keys(): #bl format is (i,j) in data keys
-    if not _d.has_key(bl): _d[bl],_w[bl] = {}, {}
-    #get filter which is baseline dependent
+    _d[bl],_w[bl] = {}, {}
     m_bl = a.miriad.ij2bl(bl[0],bl[1]) #miriad bl
-    sep = bl2sep[m_bl]
-    i,j = bl
-    #fir = firs[sep]
-    #if blconj[m_bl]: fir = n.conj(fir)
-    #print map(int, a.miriad.bl2ij(m_bl)), sep, blconj[m_bl]
-    print bl
-    for pol in data[bl].keys():
-        if blconj[m_bl]: fir = {(i,j,pol):n.conj(firs[sep])} #conjugate fir if needed
-        else: fir = {(i,j,pol):firs[sep]}
-        if not _d[bl].has_key(pol): _d[bl][pol], _w[bl][pol] = {}, {}
-        #_d[bl][pol] = n.zeros_like(data[bl][pol])
-        #_w[bl][pol] = n.zeros_like(data[bl][pol])
-        dij,wij = data[bl][pol],n.logical_not(flags[bl][pol])
-        _d[bl][pol],_w[bl][pol],_,_ = fringe.apply_frf(aa,dij,wij,i,j,pol=pol,bins=bins,firs=fir)
-        """ #stuff below is now in fringe.apply_frf
-        for ch in xrange(data[bl][pol].shape[1]):
-            #flg = n.logical_not(flags[bl][pol][:,ch])
-            #_d[bl][pol][:,ch] = n.convolve(flags[bl][pol][:,ch]*data[bl][pol][:,ch], n.conj(firs[ch,:]), mode='same')
-            _d[bl][pol][:,ch] = n.convolve(flg*data[bl][pol][:,ch], n.conj(fir[ch,:]), mode='same')
-            #_d[bl][pol][:,ch] = n.convolve(flg*data[bl][pol][:,ch], firs[ch,:], mode='same')
-            #_w[bl][pol][:,ch] = n.convolve(flags[bl][pol][:,ch], n.abs(n.conj(firs[ch,:])), mode='same')
-            _w[bl][pol][:,ch] = n.convolve(flg, n.abs(n.conj(fir[ch,:])), mode='same')
-            #_w[bl][pol][:,ch] = n.convolve(flg, n.abs(firs[ch,:]), mode='same')
-            #_d[bl][pol][:,ch] = n.where(flags[bl][pol][:,ch]>0, _d[bl][pol][:,ch]/_w[bl][pol][:,ch], 1)  
-            _d[bl][pol][:,ch] = n.where(flg>0, _d[bl][pol][:,ch]/_w[bl][pol][:,ch], 1)  
-        """
-
-def mfunc(uv, p, d, f):
-    uvw,t,(i,j) = p
-    index = n.where(times['times']==t)
-    #bl = a.miriad.ij2bl(i,j)
-    bl = (i,j)
-    pol = a.miriad.pol2str[uv['pol']]
-    try:
-        #The flags are the same flags as input.
-        d_ = _d[bl][pol][index,:].reshape(203)
-    except(KeyError): return p,None,None
-    else: return p, d_, f
-        
+    sepbls[bl2sep[m_bl]] = sepbls.get(bl2sep[m_bl],[]) + [bl]
+for sep in sepbls:
+    bls = sepbls[sep]
+    conj = [blconj[a.miriad.ij2bl(*bl)] for bl in bls] #conjugate fir if needed
+    for pol in data[bls[0]].keys():
+        print sep, pol, bls
+        dij = n.array([data[bl][pol] for bl in bls])
+        wij = n.logical_not([flags[bl][pol] for bl in bls])
+        dij,wij = C.frf.apply_frf_batch(dij, wij, firs[sep], conj=conj)
+        for cnt,bl in enumerate(bls):
+            _d[bl][pol],_w[bl][pol] = dij[cnt],wij[cnt]
 
 for filename in args:
     if opts.outpath: outfile = opts.outpath + '/'+filename+'L'
@@ -116,4 +86,5 @@ for filename in args:
     uvo = a.miriad.UV(outfile, status='new')
     print 'Writing %s'%(outfile)
     uvo.init_from_uv(uvi)
-    uvo.pipe(uvi, mfunc=mfunc, append2hist=' '.join(sys.argv)+'\n', raw=True)
+    #The flags are the same flags as input.
+    C.miriad.pipe_arrays(uvi, uvo, times['times'], _d, append2hist=' '.join(sys.argv)+'\n')
@@ -220,8 +220,7 @@ if opts.noise_only:
             ij = temp
     timelen = data_dict[keys[0]].shape[0]
     bins = fringe.gen_frbins(inttime)
-    frp, bins = fringe.aa_to_fr_profile(aa, ij, len(afreqs)/2, bins=bins)
-    timebins, firs = fringe.frp_to_firs(frp, bins, aa.get_freqs(), fq0=aa.get_freqs()[len(afreqs)/2])
+    timebins, firs = capo.frf.get_firs(aa, ij, len(afreqs)/2, inttime, fq0=aa.get_freqs()[len(afreqs)/2])
     fir = {(ij[0],ij[1],POL):firs}
     if opts.same and opts.frf: NOISE = frf((len(chans),timelen)) #same noise on all bls
     if opts.same and opts.frf == None: NOISE = oqe.noise((len(chans),timelen))
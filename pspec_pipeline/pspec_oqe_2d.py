@@ -249,8 +249,7 @@ if blconj[a.miriad.ij2bl(ij[0],ij[1])]: #makes sure FRP will be the same whether
 sep_type = bl2sep(bls[0])
 uvw = aa.get_baseline( ij[0], ij[1], src='z')
 bins = fringe.gen_frbins(inttime)
-frp, bins = fringe.aa_to_fr_profile(aa, ij, len(afreqs)/2, bins=bins)
-timebins, firs = fringe.frp_to_firs(frp, bins, aa.get_freqs(), fq0=aa.get_freqs()[len(afreqs)/2])
+timebins, firs = capo.frf.get_firs(aa, ij, len(afreqs)/2, inttime, fq0=aa.get_freqs()[len(afreqs)/2])
 fir = {(ij[0],ij[1],POL):firs}
 
 #If data is replaced by noise
@@ -0,0 +1,21 @@
+#! /usr/bin/env python
+"""
+Scan Miriad files into a file catalog (see capo.filecat), recording their JD
+and LST spans, frequency axis, pols and antennas.  Only files that are new or
+have changed since they were last scanned are read.
+"""
+import capo as C
+import sys, optparse
+
+o = optparse.OptionParser()
+o.set_usage('filecat_update.py [options] *.uv')
+o.set_description(__doc__)
+o.add_option('--catalog', default=None,
+    help='Catalog database to update.  Default is $CAPO_FILECAT or ~/.capo/filecat.db.')
+o.add_option('--nproc', type='int', default=1,
+    help='Number of processes scanning files.  Default is 1.')
+opts, args = o.parse_args(sys.argv[1:])
+
+cat = C.filecat.FileCatalog(opts.catalog)
+nscan = cat.update(args, nproc=opts.nproc, verbose=True)
+print 'Scanned %d of %d files' % (nscan, len(args))
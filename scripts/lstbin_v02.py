@@ -1,6 +1,6 @@
 #! /usr/bin/env python
 import aipy as a, numpy as n,os
-import sys, optparse, ephem
+import sys, optparse, ephem, shutil
 import capo as C
 
 '''
@@ -27,6 +27,10 @@ o.add_option('--nsig', type='float', default=3.,
     help="Number of sigma outlier to flag in median filter.")
 o.add_option('--outpath', action='store', default='.', 
     help="Add output path")
+o.add_option('--state', action='store', default=None,
+    help="npz file of running lst-bin sums, counts and moments.  If it exists, only input files not already binned into it are read, their data are added, and the output file is rewritten from the combined sums.  The state is then updated.  This lets a new night be added without rereading earlier ones.")
+o.add_option('--catalog', action='store', default=None,
+    help="File catalog (see filecat_update.py) giving the LST span of each input file, so that files outside --lst_rng are skipped without being opened.  Files not yet in the catalog are scanned into it.")
 opts, args = o.parse_args(sys.argv[1:])
 
 # ---- Functions for lst binning ----
@@ -49,6 +53,7 @@ def lstbin(lst):
 uv = a.miriad.UV(args[0])
 ants = a.scripting.parse_ants(opts.ant, uv['nants'])
 aa = a.cal.get_aa(opts.cal, uv['sdf'], uv['sfreq'], uv['nchan'])
+nchan = uv['nchan']
 del(uv)
 
 # Creates a src object if opts.src flag is used
@@ -60,6 +65,8 @@ if not opts.src is None:
 
 # Parses the stats flag
 opts.stats = map(str, opts.stats.split(','))
+if opts.stats == ['all']: opts.stats = ['cnt','min','max','median','var']
+if opts.stats == ['none']: opts.stats = []
 
 # Create the lst bins inside the desired range
 opts.lst_rng = map(lambda x: n.pi/12*(float(x)), opts.lst_rng.split('_')) #Hours
@@ -67,102 +74,167 @@ print opts.lst_rng
 lstbins = n.arange(0, 2*n.pi, 2*n.pi*opts.lst_res/a.const.sidereal_day)
 lstbins = [lstbin(lst) for lst in lstbins if in_lst_range(lst)]
 
-# Create dat dict with subdicts for each lst bin
-dat = {}
-for lst in lstbins: dat[lst] = {}
+# Index of each lst bin into the binner arrays
+lstidx = {}
+for cnt,lst in enumerate(lstbins): lstidx[lst] = cnt
 crds = {}
 jd_start = None
 
+# Loads the running sums of nights already binned, if any
+state, binned, prev_outfile = {}, [], None
+jd_min = n.empty(len(lstbins)); jd_min.fill(n.Inf)
+hits = n.zeros(len(lstbins), dtype=n.bool)
+if opts.state and os.path.exists(opts.state):
+    print 'Loading', opts.state
+    state, extra = C.lstbin.load_state(opts.state)
+    if len(extra['lstbins']) != len(lstbins) or not n.allclose(extra['lstbins'], lstbins):
+        print 'LST bins of', opts.state, 'do not match --lst_res/--lst_rng.  Exiting...'
+        sys.exit(1)
+    # Statistics the state does not accumulate cannot be added for new nights only
+    if state['data'].median != ('median' in opts.stats):
+        print 'Median statistic of', opts.state, 'does not match --stats.  Exiting...'
+        sys.exit(1)
+    if state.has_key('center') != opts.median:
+        print 'Outlier filtering of', opts.state, 'does not match --median.  Exiting...'
+        sys.exit(1)
+    binned = list(extra['files'])
+    jd_min, hits = extra['jd_min'], extra['hits']
+    for blp,crd in zip(extra['crd_blps'], extra['crds']): crds[int(blp)] = crd
+    if extra.has_key('outfile'): prev_outfile = str(extra['outfile'])
+
+# Files already binned into the state are not read again
+args_in = []
+for f in args:
+    if os.path.basename(f) in binned:
+        print 'Skipping', f, '(already in %s)' % opts.state
+        continue
+    args_in.append(f)
+
 # Checks each input file for lsts in range, returns nargs = list of files to use
 print 'Filtering input files for LSTs of interest'
 nargs = []
-for f in args:
-    uv = a.miriad.UV(f)
-    # Read the first timestamp from the file
-    (crd,t,bl),_d,_f = uv.read(raw=True)
-    aa.set_jultime(t)
-    if not src is None:
-        src.compute(aa)
-        src_alt_start = src.alt
-    start_t = aa.sidereal_time()
-    # Set the time to the end of the file (file length specified by opts.tfile)
-    aa.set_jultime(t + opts.tfile * a.ephem.second)
-    if not src is None:
-        src.compute(aa)
-        src_alt_end = src.alt
-    end_t = aa.sidereal_time()
-    if start_t < end_t:
-        if opts.lst_rng[0] < opts.lst_rng[1]:
-            if end_t < opts.lst_rng[0] or start_t > opts.lst_rng[1]: continue
-        else:
-            if end_t < opts.lst_rng[0] and start_t > opts.lst_rng[1]: continue
-    else:
-        if opts.lst_rng[0] < opts.lst_rng[1]:
-            if start_t > opts.lst_rng[1] and end_t < opts.lst_rng[0]: continue
-        # ARP: Never bail if both wrap...
-        # JCP: I have yet to wrap my head around how/why this would happen
-    # Include the file is src is below altmax at beginning or end
-    if src is None or (src_alt_start < opts.altmax or src_alt_end < opts.altmax):
+if opts.catalog:
+    # File spans come from the catalog, without opening the files
+    cat = C.filecat.FileCatalog(opts.catalog)
+    cat.update(args_in, verbose=True)
+    for f in cat.missing(args_in):
+        print 'Skipping', f, '(could not be read into %s)' % opts.catalog
+        args_in.remove(f)
+    tbl = cat.table(args_in)
+    overlap = C.filecat.lst_overlap(tbl['lst_start'], tbl['lst_end'], opts.lst_rng)
+    for cnt,f in enumerate(args_in):
+        if not overlap[cnt]: continue
+        # Include the file is src is below altmax at beginning or end
+        if not src is None:
+            alts = []
+            for t in (tbl['jd_start'][cnt], tbl['jd_end'][cnt]):
+                aa.set_jultime(t)
+                src.compute(aa)
+                alts.append(src.alt)
+            if min(alts) >= opts.altmax: continue
         nargs.append(f)
-# Places the data into lst bins, but does not actually combine or average.
-print "binning ",len(nargs),"files"
-jds = {}
-files = {}
-for filename in nargs:
-    uv = a.miriad.UV(filename)
-    print 'Reading', filename
-    sys.stdout.flush()
-    a.scripting.uv_selector(uv, opts.ant, opts.pol)
-    # Gather data from file
-    curtime = None
-    for (uvw,t,(i,j)),d,f in uv.all(raw=True):
-        if t != curtime:
-            aa.set_jultime(t)
-            if not src is None: src.compute(aa)
-            lst = lstbin(aa.sidereal_time())
-            if dat.has_key(lst):
-                jds[lst] = jds.get(lst,[]) + [t] # Keep track of all jds that contribute
-                files[lst] = files.get(lst,[]) + [filename] # Keep track of all files that contribute
-            curtime = t
-        # Only include this integration if it falls within the defined range
-        if not dat.has_key(lst): continue
-        # Don't include the integration is src is above altmax
-        if not src is None and src.alt >= opts.altmax: continue
-        # Records coords of baseline in dict, for writing into uv file later
-        blp = a.pol.ijp2blp(i,j,uv['pol'])
-        crds[blp] = uvw
-        # Keep track of how many (unflagged) samples go into the data
-        # If input file already lstbinned, weight integrations and place in bin
-        # Otherwise, place in bin without weights
-        if not dat[lst].has_key(blp): dat[lst][blp] = {}
-        if 'cnt' in uv.vars():
-            dat[lst][blp]['cnt'] = dat[lst][blp].get('cnt',[]) + [uv['cnt']]
-            dat[lst][blp]['vis'] = dat[lst][blp].get('vis',[]) + [n.where(f,0,d)]
+else:
+    for f in args_in:
+        uv = a.miriad.UV(f)
+        # Read the first timestamp from the file
+        (crd,t,bl),_d,_f = uv.read(raw=True)
+        aa.set_jultime(t)
+        if not src is None:
+            src.compute(aa)
+            src_alt_start = src.alt
+        start_t = aa.sidereal_time()
+        # Set the time to the end of the file (file length specified by opts.tfile)
+        aa.set_jultime(t + opts.tfile * a.ephem.second)
+        if not src is None:
+            src.compute(aa)
+            src_alt_end = src.alt
+        end_t = aa.sidereal_time()
+        if start_t < end_t:
+            if opts.lst_rng[0] < opts.lst_rng[1]:
+                if end_t < opts.lst_rng[0] or start_t > opts.lst_rng[1]: continue
+            else:
+                if end_t < opts.lst_rng[0] and start_t > opts.lst_rng[1]: continue
         else:
-            dat[lst][blp]['cnt'] = dat[lst][blp].get('cnt',[]) + [n.logical_not(f).astype(float)]
-            dat[lst][blp]['vis'] = dat[lst][blp].get('vis',[]) + [n.where(f,0,d)]
+            if opts.lst_rng[0] < opts.lst_rng[1]:
+                if start_t > opts.lst_rng[1] and end_t < opts.lst_rng[0]: continue
+            # ARP: Never bail if both wrap...
+            # JCP: I have yet to wrap my head around how/why this would happen
+        # Include the file is src is below altmax at beginning or end
+        if src is None or (src_alt_start < opts.altmax or src_alt_end < opts.altmax):
+            nargs.append(f)
+
+def bin_files(filenames, binner, jd_min, hits, blocksize=4096):
+# Adds the data of each file to binner in blocks of records, updating in place
+# the earliest jd seen in each lst bin and which lst bins received data
+    lidx = n.empty(blocksize, dtype=n.int)
+    blps = n.empty(blocksize, dtype=n.int)
+    d = n.empty((blocksize,nchan), dtype=n.complex64)
+    w = n.empty((blocksize,nchan), dtype=n.float64)
+    for filename in filenames:
+        uv = a.miriad.UV(filename)
+        print 'Reading', filename
+        sys.stdout.flush()
+        a.scripting.uv_selector(uv, opts.ant, opts.pol)
+        has_cnt = 'cnt' in uv.vars()
+        # Gather data from file
+        curtime, cnt = None, 0
+        for (uvw,t,(i,j)),_d,_f in uv.all(raw=True):
+            if t != curtime:
+                aa.set_jultime(t)
+                if not src is None: src.compute(aa)
+                li = lstidx.get(lstbin(aa.sidereal_time()), -1)
+                if li >= 0: jd_min[li] = min(jd_min[li], t) # Keep track of jds that contribute
+                curtime = t
+            # Only include this integration if it falls within the defined range
+            if li < 0: continue
+            # Don't include the integration is src is above altmax
+            if not src is None and src.alt >= opts.altmax: continue
+            # Records coords of baseline in dict, for writing into uv file later
+            blp = a.pol.ijp2blp(i,j,uv['pol'])
+            crds[blp] = uvw
+            hits[li] = True
+            lidx[cnt], blps[cnt] = li, blp
+            d[cnt] = n.where(_f,0,_d)
+            # If input file already lstbinned, weight integrations by their counts
+            # Otherwise, weight by unflagged samples
+            if has_cnt: w[cnt] = uv['cnt']
+            else: w[cnt] = n.logical_not(_f)
+            cnt += 1
+            if cnt == blocksize:
+                binner.add(lidx, blps, d, w)
+                cnt = 0
+        binner.add(lidx[:cnt], blps[:cnt], d[:cnt], w[:cnt])
+
+# Accumulates running statistics in each lst bin (see capo.lstbin)
+print "binning ",len(nargs),"files"
+if opts.state and len(nargs) == 0:
+    print 'No new files to add to', opts.state, '.  Exiting...'
+    sys.exit(0)
+clip = None
+if opts.median:
+    # Outliers are found against approximate medians from a first pass
+    print 'Finding medians for outlier rejection'
+    clip = state.get('center', None)
+    if clip is None: clip = C.lstbin.LSTBinner(len(lstbins), nchan, center=True)
+    bin_files(nargs, clip, jd_min.copy(), hits.copy())
+binner = state.get('data', None)
+if binner is None:
+    binner = C.lstbin.LSTBinner(len(lstbins), nchan, median=('median' in opts.stats), clip=clip, nsig=opts.nsig)
+else: binner.clip, binner.nsig = clip, opts.nsig
+bin_files(nargs, binner, jd_min, hits)
 
 # Check that data actually got written
-lsts = [lst for lst in dat if len(dat[lst]) > 0] # only record bins with data
+lsts = [lstbins[li] for li in n.where(hits)[0]] # only record bins with data
 
 lsts.sort()
 if len(lsts) == 0:
     print 'No LST bins with data.  Exiting...'
     sys.exit(0)
 # Get list of all blps to record, just to make sure that each time has a record for each blp
-blps = {}
-for lst in dat:
-    for blp in dat[lst]:
-        blps[blp] = None
-blps = blps.keys()
+blps = binner.blps.keys()
 # Find a starting jd for recording in the file
-lst_start, jd_start = n.Inf, n.Inf
-for lst in jds.keys():
-    jds[lst] = n.array(jds[lst])
-    files[lst] = n.array(files[lst])
-    jd_min = n.min(jds[lst])
-    if jd_min < jd_start:
-        lst_start, jd_start = lst, jd_min
+li = n.argmin(jd_min)
+lst_start, jd_start = lstbins[li], jd_min[li]
 djd_dlst = a.const.sidereal_day / (2*n.pi) * a.ephem.second
 jd_start = jd_start + (lsts[0] - lst_start) * djd_dlst #ARP fix; sign was wrong in original code
 lst_start = lsts[0]
@@ -176,79 +248,65 @@ filename=os.path.basename(args[0])
 if filename.split('.')[-1].startswith('bm'):
     filename='lst.%7.5f.uv.%s' % (jd_start,filename.split('.')[-1])
 else: filename = 'lst.%7.5f.%2s.uv' % (jd_start,filename.split('.')[-2])
-print 'Writing to', opts.outpath+'/'+filename
-if os.path.exists(opts.outpath+'/'+filename):
-    print opts.outpath+'/'+filename,"exists"
+outfile = os.path.abspath(opts.outpath+'/'+filename)
+print 'Writing to', outfile
+if os.path.exists(outfile) and not opts.state:
+    print outfile,"exists"
     sys.exit(1)
-uvo = a.miriad.UV(opts.outpath+'/'+filename, status='new')
+# The file is written under a temporary name and moved into place when done
+tmpfile = outfile + '.tmp'
+if os.path.exists(tmpfile): shutil.rmtree(tmpfile)
+uvo = a.miriad.UV(tmpfile, status='new')
 uvo.init_from_uv(uvi,override={'inttime':opts.lst_res})
 
-# What to write in the case of zero data in an lst bin
-dzero = n.zeros(uvi['nchan'], dtype=n.complex64)
-fzero = n.ones(uvi['nchan'], dtype=n.int)
-
 # Add the variables for the statistics if needed
-if opts.stats == ['all']: opts.stats = ['cnt','min','max','median','var']
-if opts.stats == ['none']: opts.stats = []
 if 'cnt' in opts.stats and 'cnt' not in uvo.vars(): uvo.add_var('cnt', 'd')
 if 'min' in opts.stats and 'min' not in uvo.vars(): uvo.add_var('min', 'd')
 if 'max' in opts.stats and 'max' not in uvo.vars(): uvo.add_var('max', 'd')
 if 'median' in opts.stats and 'median' not in uvo.vars(): uvo.add_var('median', 'd')
 if 'var' in opts.stats and 'var' not in uvo.vars(): uvo.add_var('var', 'd')
 
-# This section does the binning and statistics
+# This section writes out the binned data and statistics
+stats = binner.stats()
 for lst in lsts:
     t = jd_start + (lst - lst_start) * djd_dlst
     print 'LST:', a.ephem.hours(lst), '(%f)' % lst, ' -> JD:', t
     sys.stdout.flush()
     uvo['lst'], uvo['ra'], uvo['obsra'] = lst, lst, lst
+    li = lstidx[lst]
     for blp in blps:
         i,j,uvo['pol'] = a.pol.blp2ijp(blp)
         preamble = (crds[blp], t, (i,j))
-        try:
-            d = n.array(dat[lst][blp]['vis'])
-            w = n.array(dat[lst][blp]['cnt'])
-            d = n.ma.array(d, mask=n.where(d==0, 1, 0))
-            # Applies median filter
-            if opts.median:
-                d_med = n.ma.median(d, axis=0)
-                d_med.shape = (1,) + d_med.shape
-                d_res = n.ma.abs(d - d_med)
-                d_sig = n.ma.median(d_res, axis=0)
-                d_sig.shape = (1,) + d_sig.shape
-                d = n.ma.masked_where(d_res > opts.nsig * d_sig, d)
-                w = n.ma.array(w, mask = d.mask).filled(0)
-            # Calculate the statistics as needed
-            if 'cnt' in opts.stats: cnt = n.sum(w, axis=0)
-            #XXX You need to check that all of these statistics are properly done over multiple iterations
-            if 'min' in opts.stats: dmin = n.ma.min(n.abs(d), axis=0).filled(0)
-            if 'max' in opts.stats: dmax = n.ma.max(n.abs(d), axis=0).filled(0)
-            #XXX There is no valid way to keep a running median
-            if 'median' in opts.stats: median = n.ma.median(n.abs(d), axis=0).filled(0)
-            #XXX This is not a running variance
-            if 'var' in opts.stats: var = n.ma.var(d, axis=0).filled(0)
-            # Do the averaging
-            #d = n.ma.mean(d, axis=0).filled(0)
-            #Weighted average
-            d = n.ma.sum(w*d,axis=0)/n.sum(w,axis=0)
-            f = n.where(d == 0, 1, 0)
-       # This happens if we are missing data for a desired LST bin
-        except(KeyError):
-            d,f = dzero, fzero
-            if 'cnt' in opts.stats: cnt = n.zeros_like(fzero)
-            if 'minmax' in opts.stats: dmin, dmax = n.zeros_like(fzero), n.zeros_like(fzero)
-            if 'median' in opts.stats: median = n.zeros_like(fzero)
-            if 'var' in opts.stats: var = n.zeros_like(fzero)
+        bi = binner.blps[blp]
+        # Bins with no data for this blp have d = 0, flagged, and zero statistics
+        d, f = stats['vis'][li,bi], stats['flg'][li,bi].astype(n.int)
         # Set the statistics variables in the uv object and write the data
-        if 'cnt' in opts.stats: uvo['cnt'] = cnt.astype(n.double)
-        if 'min' in opts.stats: uvo['min'] = dmin.astype(n.double)
-        if 'max' in opts.stats: uvo['max'] = dmax.astype(n.double)
-        if 'median' in opts.stats: uvo['median'] = median.astype(n.double)
-        if 'var' in opts.stats: uvo['var'] = var.astype(n.double)
-
-
+        if 'cnt' in opts.stats: uvo['cnt'] = stats['cnt'][li,bi].astype(n.double)
+        if 'min' in opts.stats: uvo['min'] = stats['min'][li,bi].astype(n.double)
+        if 'max' in opts.stats: uvo['max'] = stats['max'][li,bi].astype(n.double)
+        if 'median' in opts.stats: uvo['median'] = stats['median'][li,bi].astype(n.double)
+        if 'var' in opts.stats: uvo['var'] = stats['var'][li,bi].astype(n.double)
         uvo.write(preamble, d, f)
 
 del(uvo)
+if os.path.exists(outfile):
+    os.rename(outfile, outfile + '.old')
+    os.rename(tmpfile, outfile)
+    shutil.rmtree(outfile + '.old')
+else: os.rename(tmpfile, outfile)
 print 'Finished writing', filename
+# An earlier night moves jd_start, and so the name of the file written from the state
+if not prev_outfile is None and prev_outfile != outfile and os.path.exists(prev_outfile):
+    print 'Removing', prev_outfile, '(superseded by %s)' % filename
+    shutil.rmtree(prev_outfile)
+
+if opts.state:
+    binners = {'data':binner}
+    if not clip is None: binners['center'] = clip
+    crd_blps = crds.keys()
+    C.lstbin.save_state(opts.state, binners, lstbins=n.array(lstbins), jd_min=jd_min, hits=hits,
+        files=n.array(binned + [os.path.basename(f) for f in nargs]),
+        crd_blps=n.array(crd_blps), crds=n.array([crds[blp] for blp in crd_blps]),
+        outfile=n.array(outfile))
+    print 'Updated', opts.state
 
@@ -1,4 +1,4 @@
-import pfb, pspec, dspec, red, fringe, miriad, linsolve, xrfi, redcal
+import pfb, pspec, dspec, red, redindex, fringe, frf, miriad, lstbin, filecat, linsolve, xrfi, redcal
 import fringe as frf_conv # for backward compatibility
 import oqe, hex, metrics
 import warnings
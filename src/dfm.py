@@ -3,6 +3,7 @@ import aipy as a
 import ephem
 from scipy.special import fdtri as Finv
 from scipy.special import erfc
+import redindex
 
 ##############################
 # Generally useful functions #
@@ -72,24 +73,16 @@ def grid2ij(GRID):
     Input=GRID: np.array of antenna numbers associated with grid position. The index of the antenna number should be the
     grid-position (modulo stupid python indices). If antenna number 3 is in grid position C4, GRID[4,3] = 3.
     """
-    bls,conj = {},{}
-    for row_i in range(GRID.shape[1]):
-        for col_i in range(GRID.shape[0]):
-            for row_j in range(GRID.shape[1]):
-                for col_j in range(GRID.shape[0]):
-                    if row_i >= row_j and col_i == col_j: continue
-                    sep = '%d,%d' % (col_j-col_i, row_j-row_i)
-                    bls[sep] = bls.get(sep,[]) + [(GRID[col_i,row_i],GRID[col_j,row_j])]
+    groups = redindex.get_groups(GRID, order='F', select='rows')
+    bls = redindex.group_dict(groups)
+    conj = dict(zip(groups.sep_strs(), [groups.conj[idx].tolist() for idx in groups.members()]))
     for sep in bls.keys():
         if sep == '0,0' or len(bls[sep]) < 2: del(bls[sep])
-    for sep in bls:
-        conj[sep] = [i>j for i,j in bls[sep]]
-    
+
     bl_str,bl_conj = {},{}
     for sep in bls:
         bl_str[sep],bl_list = [],[]
         for (i,j),c in zip(bls[sep],conj[sep]):
-            if c: i,j = j,i
             bl_list.append(ij2bl(i,j))
             bl_str[sep].append('%d_%d'%(i,j))
             bl_conj[ij2bl(i,j)] = c
@@ -0,0 +1,153 @@
+'''A catalog of Miriad files, kept in an sqlite database, recording for each
+file its JD and LST span, number of integrations, frequency axis, pols and
+antennas.  Scripts that pick files by time or LST range can then query the
+catalog instead of opening every file.  Files are (re)scanned only when they
+are new or have changed on disk (see FileCatalog.update).'''
+import aipy as a, numpy as n, sqlite3 as sql, os
+import multiprocessing as mpr
+import miriad
+
+# Default location of the catalog; CAPO_FILECAT overrides it.
+CATALOG = os.environ.get('CAPO_FILECAT', os.path.expanduser('~/.capo/filecat.db'))
+FIELDS = ['path', 'stamp', 'jd_start', 'jd_end', 'lst_start', 'lst_end', 'nints',
+    'nchan', 'sfreq', 'sdf', 'inttime', 'pols', 'ants']
+
+def scan_file(filename):
+    '''Read through a Miriad file once and return its catalog row as a dict
+    with the keys in FIELDS.  LSTs are those written in the file.'''
+    uv = a.miriad.UV(filename)
+    row = {'path':os.path.abspath(filename).rstrip('/'),
+        'stamp':','.join(map(repr, miriad.file_stamp(filename))),
+        'nchan':uv['nchan'], 'sfreq':uv['sfreq'], 'sdf':uv['sdf'], 'inttime':uv['inttime']}
+    times, lsts, pols, ants = [], [], {}, {}
+    curtime = None
+    for (crd,t,(i,j)),d,f in uv.all(raw=True):
+        if t != curtime:
+            times.append(t)
+            lsts.append(uv['lst'])
+            curtime = t
+        pols[a.miriad.pol2str[uv['pol']]] = None
+        ants[i] = ants[j] = None
+    del(uv)
+    if len(times) == 0: times, lsts = [0.], [0.]
+    row['jd_start'], row['jd_end'] = min(times), max(times)
+    row['lst_start'], row['lst_end'] = lsts[n.argmin(times)], lsts[n.argmax(times)]
+    row['nints'] = len(times)
+    row['pols'] = ','.join(sorted(pols.keys()))
+    row['ants'] = ','.join(map(str, sorted(ants.keys())))
+    return row
+
+def _scan_file(filename):
+    try: return scan_file(filename)
+    except(IOError,RuntimeError): return None
+
+def lst_overlap(lst_start, lst_end, lst_rng):
+    '''Return a bool array of which spans [lst_start, lst_end] (arrays, in
+    radians, wrapping through 2pi when lst_end < lst_start) overlap the
+    range lst_rng = (lst0, lst1), which may also wrap.'''
+    lst0, lst1 = lst_rng
+    s = n.asarray(lst_start, dtype=n.float64) % (2*n.pi)
+    e = n.asarray(lst_end, dtype=n.float64) % (2*n.pi)
+    def unwrap(x0, x1):
+        # Spans as one or two intervals, without wrapping
+        if x1 < x0: return [(x0, 2*n.pi), (0, x1)]
+        return [(x0, x1)]
+    rv = n.zeros(s.shape, dtype=n.bool)
+    for r0,r1 in unwrap(lst0 % (2*n.pi), lst1 % (2*n.pi)):
+        wrap = e < s
+        # A wrapped span is [s, 2pi) + [0, e]
+        rv |= n.logical_and(s <= r1, n.where(wrap, 2*n.pi, e) >= r0)
+        rv |= n.logical_and(wrap, n.logical_and(0 <= r1, e >= r0))
+    return rv
+
+class FileCatalog:
+    '''An sqlite catalog of Miriad files.  filename is the database to open
+    (or create); CATALOG if None.'''
+    def __init__(self, filename=None):
+        if filename is None: filename = CATALOG
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(dirname): os.makedirs(dirname)
+        self.conn = sql.connect(filename)
+        self.conn.row_factory = sql.Row
+        self.conn.execute('''create table if not exists files (path text primary key,
+            stamp text, jd_start real, jd_end real, lst_start real, lst_end real,
+            nints int, nchan int, sfreq real, sdf real, inttime real, pols text, ants text)''')
+        self.conn.execute('create index if not exists files_jd on files (jd_start)')
+        self.conn.commit()
+    def stale(self, filenames):
+        '''Return the files in filenames that are not in the catalog or have
+        changed on disk since they were scanned.'''
+        stamps = {}
+        paths = [os.path.abspath(f).rstrip('/') for f in filenames]
+        for row in self.rows(filenames): stamps[row['path']] = row['stamp']
+        rv = []
+        for f,path in zip(filenames, paths):
+            stamp = ','.join(map(repr, miriad.file_stamp(f)))
+            if stamps.get(path, None) != stamp: rv.append(f)
+        return rv
+    def update(self, filenames, nproc=1, verbose=False):
+        '''Scan the files in filenames that are new or changed (in nproc
+        worker processes) and write their rows to the catalog.  Files that
+        cannot be read are skipped, and stay out of the catalog (see
+        missing).  Returns the number of files scanned.'''
+        filenames = self.stale(filenames)
+        if len(filenames) == 0: return 0
+        if verbose: print 'Scanning %d files' % len(filenames)
+        if nproc > 1 and len(filenames) > 1:
+            pool = mpr.Pool(processes=nproc)
+            try: rows = pool.map(_scan_file, filenames)
+            finally: pool.close(); pool.join()
+        else: rows = map(_scan_file, filenames)
+        rows = [row for row in rows if not row is None]
+        self.conn.executemany('insert or replace into files (%s) values (%s)' %
+            (','.join(FIELDS), ','.join(['?'] * len(FIELDS))),
+            [[row[k] for k in FIELDS] for row in rows])
+        self.conn.commit()
+        return len(rows)
+    def rows(self, filenames=None):
+        '''Return the catalog rows (sqlite3.Row) of filenames, in no
+        particular order, or of every file if filenames is None.'''
+        if filenames is None: return self.conn.execute('select * from files').fetchall()
+        paths = [os.path.abspath(f).rstrip('/') for f in filenames]
+        rv = []
+        for i in xrange(0, len(paths), 500): # sqlite limits the number of parameters
+            p = paths[i:i+500]
+            rv += self.conn.execute('select * from files where path in (%s)' %
+                ','.join(['?'] * len(p)), p).fetchall()
+        return rv
+    def _lookup(self, filenames):
+        '''Return the files of filenames that are in the catalog, in the
+        order given, and their rows.'''
+        rows = dict([(row['path'], row) for row in self.rows(filenames)])
+        found = [(f, rows.get(os.path.abspath(f).rstrip('/'), None)) for f in filenames]
+        found = [(f,row) for f,row in found if not row is None]
+        return [f for f,row in found], [row for f,row in found]
+    def missing(self, filenames):
+        '''Return the files in filenames that are not in the catalog, such
+        as those update could not read.'''
+        found = set(self._lookup(filenames)[0])
+        return [f for f in filenames if not f in found]
+    def table(self, filenames=None):
+        '''Return the catalog entries of filenames (in the order given,
+        leaving out any that are missing from the catalog), or of every
+        file, as a dict of arrays keyed by the names in FIELDS.'''
+        if filenames is None: rows = self.rows()
+        else: filenames, rows = self._lookup(filenames)
+        rv = {}
+        for k in FIELDS: rv[k] = n.array([row[k] for row in rows])
+        return rv
+    def select(self, filenames=None, lst_rng=None, jd_rng=None, pol=None):
+        '''Return the files (of filenames, or the whole catalog, keeping the
+        order given) whose LST span overlaps lst_rng (radians), whose JD span
+        overlaps jd_rng, and which hold pol.  Files missing from the
+        catalog are not selected.'''
+        if not filenames is None: filenames = self._lookup(filenames)[0]
+        t = self.table(filenames)
+        if len(t['path']) == 0: return []
+        ok = n.ones(len(t['path']), dtype=n.bool)
+        if not lst_rng is None: ok &= lst_overlap(t['lst_start'], t['lst_end'], lst_rng)
+        if not jd_rng is None:
+            ok &= n.logical_and(t['jd_end'] >= jd_rng[0], t['jd_start'] <= jd_rng[1])
+        if not pol is None: ok &= n.array([pol in p.split(',') for p in t['pols']], dtype=n.bool)
+        if filenames is None: filenames = t['path']
+        return [f for f,k in zip(filenames, ok) if k]
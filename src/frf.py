@@ -0,0 +1,147 @@
+'''Fringe-rate filtering of whole (nbl, ntime, nchan) blocks of visibilities.
+Each channel is convolved along time with its own FIR (as produced by
+fringe.frp_to_firs), using FFT overlap-add so that the cost per channel is
+O(T log K) rather than the O(T K) of n.convolve.  FIRs themselves are
+computed once per (array, baseline vector, inttime, pol, freqs) and kept in
+an in-process LRU and an on-disk npz cache (see get_firs).'''
+import numpy as n, os, hashlib, tempfile
+from collections import OrderedDict
+
+# Directory for on-disk FIR caches; CAPO_FIR_CACHE overrides the default.
+FIR_CACHE_DIR = os.environ.get('CAPO_FIR_CACHE', os.path.expanduser('~/.capo/fir_cache'))
+# Number of FIR sets kept in memory by get_firs.
+FIR_LRU_SIZE = 32
+_FIR_LRU = OrderedDict()
+
+def nfft_for(ntime, ntaps):
+    '''Return the FFT length used to convolve ntime samples with ntaps-long
+    FIRs: a power of 2 that holds the whole linear convolution if that is
+    short, otherwise one that holds segments of about 7 FIR lengths.'''
+    full = 2**int(n.ceil(n.log2(ntime + ntaps - 1)))
+    seg = 2**int(n.ceil(n.log2(8 * ntaps)))
+    return min(full, seg)
+
+def apply_frf_batch(data, wgts, firs, conj=None, norm=False, nfft=None):
+    '''Fringe-rate filter a block of baselines that share one set of FIRs.
+    data and wgts are (nbl, ntime, nchan) (or (ntime, nchan) for a single
+    baseline), and firs is the (nchan, ntaps) output of frp_to_firs.  As in
+    fringe.apply_frf, wgts*data is convolved with conj(firs) and wgts with
+    abs(firs), with mode='same' along time.  Baselines flagged in the bool
+    array conj are instead convolved with firs, which is how apply_frf
+    treats baselines whose FIRs were conjugated to match their separation.
+    If norm, data are divided by the filtered weights where these are
+    nonzero (and zeroed elsewhere) before being returned.  Returns the
+    filtered data (dtype of data) and weights (float).'''
+    data, wgts = n.asarray(data), n.asarray(wgts)
+    single = (data.ndim == 2)
+    if single: data, wgts = data[n.newaxis], wgts[n.newaxis]
+    firs = n.asarray(firs)
+    nbl, ntime, nchan = data.shape
+    assert(firs.shape[0] == nchan)
+    ntaps = firs.shape[1]
+    if conj is None: conj = n.zeros(nbl, dtype=n.bool)
+    conj = n.asarray(conj, dtype=n.bool)
+    if nfft is None: nfft = nfft_for(ntime, ntaps)
+    assert(nfft >= ntaps)
+    seglen = nfft - ntaps + 1
+    # Kernels are transformed once per block.  Weights and |fir| are real,
+    # so their half of the work is done with real FFTs.
+    kern = {False: n.fft.fft(n.conj(firs).T, nfft, axis=0),
+            True: n.fft.fft(firs.T, nfft, axis=0)}
+    wkern = n.fft.rfft(n.abs(firs).T, nfft, axis=0)
+    # Accumulate the full linear convolution, then keep the 'same' window.
+    _d = n.zeros((nbl, ntime + nfft, nchan), dtype=n.complex128)
+    _w = n.zeros((nbl, ntime + nfft, nchan), dtype=n.float64)
+    for t0 in xrange(0, ntime, seglen):
+        t1 = min(t0 + seglen, ntime)
+        w = wgts[:,t0:t1].astype(n.float64)
+        wd = w * data[:,t0:t1]
+        _w[:,t0:t0+nfft] += n.fft.irfft(n.fft.rfft(w, nfft, axis=1) * wkern, nfft, axis=1)
+        wd = n.fft.fft(wd, nfft, axis=1)
+        for c in (False, True):
+            bls = n.where(conj == c)[0]
+            if bls.size == 0: continue
+            _d[bls,t0:t0+nfft] += n.fft.ifft(wd[bls] * kern[c], axis=1)
+    i0 = (ntaps - 1) / 2
+    _d, _w = _d[:,i0:i0+ntime], _w[:,i0:i0+ntime]
+    if norm:
+        ok = _w > 0
+        _d = n.where(ok, _d / n.where(ok, _w, 1), 0)
+    _d = _d.astype(data.dtype if n.iscomplexobj(data) else n.complex128)
+    if single: return _d[0], _w[0]
+    return _d, _w
+
+def _hash_update(h, obj):
+    '''Feed obj (nested dicts, lists, arrays and scalars) into hash h in
+    an order that does not depend on dict ordering.'''
+    if isinstance(obj, dict):
+        for k in sorted(obj.keys()):
+            h.update(repr(k))
+            _hash_update(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update('(%d' % len(obj))
+        for v in obj: _hash_update(h, v)
+    elif isinstance(obj, str): h.update(repr(obj))
+    else:
+        obj = n.asarray(obj)
+        h.update(str(obj.dtype) + repr(obj.shape))
+        h.update(n.ascontiguousarray(obj).tostring())
+
+def fir_key(aa, ij, ch, inttime, pol=None, fq0=.15, **kwargs):
+    '''Return a hex digest identifying the FIRs that get_firs computes for
+    these arguments: a hash of the parameters of every antenna in aa, the
+    baseline vector of ij (so that all baselines of a separation share an
+    entry), ch, inttime, pol, the frequency axis, fq0, and any kwargs for
+    frp_to_firs.'''
+    h = hashlib.md5()
+    _hash_update(h, aa.get_params({'*':'*'}))
+    _hash_update(h, n.around(aa.get_baseline(ij[0], ij[1], src='z'), 6))
+    _hash_update(h, [ch, float(inttime), pol, aa.get_freqs(), fq0, kwargs])
+    return h.hexdigest()
+
+def cached_firs(key, compute, cache=None):
+    '''Return the (timebins, firs) stored under key, calling compute() to
+    make them if they are in neither the in-process LRU nor the on-disk
+    cache directory cache (FIR_CACHE_DIR if None, disk skipped if False).
+    New entries are written to a temporary file and renamed into place, so
+    concurrent runs never read a partial entry.'''
+    if _FIR_LRU.has_key(key):
+        _FIR_LRU[key] = val = _FIR_LRU.pop(key)
+        return val
+    if cache is None: cache = FIR_CACHE_DIR
+    filename = cache and os.path.join(cache, key + '.npz')
+    val = None
+    if filename and os.path.exists(filename):
+        try:
+            npz = n.load(filename)
+            val = (npz['timebins'], npz['firs'])
+        except(IOError,KeyError,ValueError): val = None # unreadable entry: recompute
+    if val is None:
+        val = compute()
+        if filename:
+            if not os.path.exists(cache): os.makedirs(cache)
+            fd, tmp = tempfile.mkstemp(suffix='.npz', dir=cache)
+            f = os.fdopen(fd, 'wb')
+            try: n.savez(f, timebins=val[0], firs=val[1])
+            finally: f.close()
+            os.rename(tmp, filename)
+    _FIR_LRU[key] = val
+    while len(_FIR_LRU) > FIR_LRU_SIZE: _FIR_LRU.popitem(last=False)
+    return val
+
+def get_firs(aa, ij, ch, inttime, pol=None, fq0=.15, cache=None, **kwargs):
+    '''Return (timebins, firs) as computed by
+        bins = fringe.gen_frbins(inttime)
+        frp, bins = fringe.aa_to_fr_profile(aa, ij, ch, pol=pol, bins=bins)
+        fringe.frp_to_firs(frp, bins, aa.get_freqs(), fq0=fq0, **kwargs)
+    but reusing the result of any earlier call (in this process or, through
+    the on-disk cache, another) with the same fir_key.  If pol is None it is
+    not passed on, leaving aa_to_fr_profile to use its default.'''
+    def compute():
+        import fringe
+        bins = fringe.gen_frbins(inttime)
+        if pol is None: frp, bins = fringe.aa_to_fr_profile(aa, ij, ch, bins=bins)
+        else: frp, bins = fringe.aa_to_fr_profile(aa, ij, ch, pol=pol, bins=bins)
+        return fringe.frp_to_firs(frp, bins, aa.get_freqs(), fq0=fq0, **kwargs)
+    key = fir_key(aa, ij, ch, inttime, pol=pol, fq0=fq0, **kwargs)
+    return cached_firs(key, compute, cache=cache)
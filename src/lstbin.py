@@ -0,0 +1,215 @@
+'''Accumulate visibilities into LST bins in a single pass over the data.
+Per-bin statistics (weighted average, count, min, max, variance and an
+approximate median) are kept as running (nlst, nblp, nchan) arrays, so
+memory does not grow with the number of nights binned.  The accumulators
+can be saved and reloaded (save_state, load_state), so that a new night can
+be folded into existing LST-binned products without rereading old nights.'''
+import numpy as n, os, tempfile
+
+# Gains of the Robbins-Monro median steps in LSTBinner._step: the n-th sample
+# moves an estimate by MEDIAN_GAIN*scale/n or, for nonnegative estimates
+# without a scale, by a factor 1 + MEDIAN_REL_GAIN/n (clipped to [.5,2]).
+# The asymptotically optimal gain is 1/(2 f(median)) for a sample density f,
+# ~1.9 median absolute deviations for gaussian data.  These were tuned by
+# hand on the |d| of gaussian visibilities (as in tests/lstbin_test.py) at
+# about twice that, since estimates start from the first block mean and
+# the scale they step in is itself still converging.  With ~70 samples per
+# bin the rms error is ~.12 of the spread of the data (worst bin ~.6), and
+# ~.04 with ~270 samples.  Halving the gains gives a similar rms but worse
+# outlying bins; doubling them makes estimates overshoot and diverge when
+# bins have only a few tens of samples.
+MEDIAN_GAIN = 3.7
+MEDIAN_REL_GAIN = 2.3
+
+class LSTBinner:
+    '''Running LST-bin accumulators for nlst bins of nchan channels.  The
+    baseline/pol (blp) axis grows as new blps are added.  Records are
+    added in blocks (see add); a sample takes part in the statistics if its
+    (flag-zeroed) data are nonzero, as in the masked arrays lstbin_v02.py
+    used to build.  The variance is Welford's, merged block by block.
+
+    If median, an approximate median of |d| is kept by stepping towards
+    each new sample with a gain that shrinks as 1/n (a Robbins-Monro
+    estimate of the 50% quantile, see _step).  If center, approximate medians of the
+    real (cre) and imaginary (cim) parts and of |d - cmed| (mad) are kept
+    the same way; a binner built with clip=<such a binner> then drops samples
+    more than nsig*mad from cmed, which is lstbin_v02.py's --median outlier
+    filter done as a second pass over the data.'''
+    def __init__(self, nlst, nchan, nblp=1, median=False, center=False, clip=None, nsig=3.):
+        self.nlst, self.nchan = nlst, nchan
+        self.median, self.center = median, center
+        self.clip, self.nsig = clip, nsig
+        self.blps = {}
+        self.nblp = 0
+        self._alloc(max(nblp,1))
+    def _fields(self):
+        fields = [('wsum', n.float64, 0), ('dsum', n.complex128, 0),
+            ('nsamp', n.int32, 0), ('mean', n.complex128, 0), ('m2', n.float64, 0),
+            ('dmin', n.float64, n.inf), ('dmax', n.float64, 0)]
+        if self.median: fields += [('med', n.float64, 0), ('medsp', n.float64, 0)]
+        if self.center: fields += [('cre', n.float64, 0), ('cim', n.float64, 0), ('mad', n.float64, 0)]
+        return fields
+    def _alloc(self, nblp):
+        '''(Re)allocate accumulators for nblp blps, keeping what was added.'''
+        for name,dtype,init in self._fields():
+            a = n.empty((self.nlst, nblp, self.nchan), dtype=dtype)
+            a.fill(init)
+            if self.nblp > 0: a[:,:self.nblp] = getattr(self, name)
+            setattr(self, name, a)
+        self.nblp = nblp
+    def blp_index(self, blps):
+        '''Return the index along the blp axis of each blp in blps, adding
+        (and growing the accumulators for) any that are new.'''
+        blps = n.asarray(blps)
+        ublps, inv = n.unique(blps, return_inverse=True)
+        for blp in ublps:
+            blp = int(blp)
+            if not self.blps.has_key(blp): self.blps[blp] = len(self.blps)
+        if len(self.blps) > self.nblp: self._alloc(max(len(self.blps), 2*self.nblp))
+        return n.array([self.blps[blp] for blp in ublps], dtype=n.int)[inv]
+    def _step(self, est, u, inv, x, valid, nb, ntot, scale=None,
+            gain=MEDIAN_GAIN, rel_gain=MEDIAN_REL_GAIN):
+        '''Move the running median estimates est (a flat view of an
+        accumulator) for bins u towards the samples x, one Robbins-Monro
+        step of gain*scale/n per sample.  Without a scale, est is taken to
+        be nonnegative and steps of rel_gain/n are relative to it, which
+        keeps a few large outliers from throwing it off.  Bins seen for the first time (or,
+        without a scale, stuck at 0) start at the block mean.'''
+        first = (ntot == nb)
+        if scale is None: first = n.logical_or(first, est[u] == 0)
+        if n.any(first):
+            s = n.zeros((u.size, self.nchan), dtype=n.float64)
+            n.add.at(s, inv, n.where(valid, x, 0))
+            e = est[u]
+            e[first] = (s / n.maximum(nb, 1))[first]
+            est[u] = e
+        e = est[u]
+        sgn = n.zeros((u.size, self.nchan), dtype=n.float64)
+        n.add.at(sgn, inv, n.where(valid, n.sign(x - e[inv]), 0))
+        if scale is None: est[u] = e * n.clip(1 + rel_gain * sgn / n.maximum(ntot, 1), .5, 2)
+        else: est[u] = e + gain * scale * sgn / n.maximum(ntot, 1)
+    def add(self, lidx, blps, d, w, f=None):
+        '''Add a block of nrec records: lidx and blps are (nrec,) arrays of
+        LST bin indices and blp codes, d and w are (nrec, nchan) data and
+        weights (a count of integrations, or 1 for unflagged samples).  If
+        f is given, flagged data are zeroed.  Records outside [0,nlst) are
+        dropped.'''
+        lidx = n.asarray(lidx)
+        d, w = n.asarray(d), n.asarray(w, dtype=n.float64)
+        if not f is None: d = n.where(f, 0, d)
+        ok = n.logical_and(lidx >= 0, lidx < self.nlst)
+        if not n.all(ok):
+            lidx, blps, d, w = lidx[ok], n.asarray(blps)[ok], d[ok], w[ok]
+        if lidx.size == 0: return
+        bidx = self.blp_index(blps)
+        k = lidx * self.nblp + bidx
+        valid = (d != 0)
+        if not self.clip is None:
+            c = self.clip
+            ck = lidx * c.nblp + c.blp_index(blps)
+            cmed = c.cre.reshape(-1, self.nchan)[ck] + 1j * c.cim.reshape(-1, self.nchan)[ck]
+            mad = c.mad.reshape(-1, self.nchan)[ck]
+            valid = n.logical_and(valid, n.abs(d - cmed) <= self.nsig * mad)
+            w = n.where(valid, w, 0)
+        dv = n.where(valid, d, 0)
+        n.add.at(self.wsum.reshape(-1, self.nchan), k, w)
+        n.add.at(self.dsum.reshape(-1, self.nchan), k, w * dv)
+        x = n.abs(d)
+        n.minimum.at(self.dmin.reshape(-1, self.nchan), k, n.where(valid, x, n.inf))
+        n.maximum.at(self.dmax.reshape(-1, self.nchan), k, n.where(valid, x, 0))
+        # Per-bin count, mean and M2 of this block, merged into the totals
+        u, inv = n.unique(k, return_inverse=True)
+        nb = n.zeros((u.size, self.nchan), dtype=n.int32)
+        n.add.at(nb, inv, valid)
+        mb = n.zeros((u.size, self.nchan), dtype=n.complex128)
+        n.add.at(mb, inv, dv)
+        mb /= n.maximum(nb, 1)
+        m2b = n.zeros((u.size, self.nchan), dtype=n.float64)
+        n.add.at(m2b, inv, n.where(valid, n.abs(d - mb[inv])**2, 0))
+        nsamp = self.nsamp.reshape(-1, self.nchan)
+        mean = self.mean.reshape(-1, self.nchan)
+        m2 = self.m2.reshape(-1, self.nchan)
+        na = nsamp[u]
+        ntot = na + nb
+        delta = mb - mean[u]
+        mean[u] += delta * nb / n.maximum(ntot, 1)
+        m2[u] += m2b + n.abs(delta)**2 * na * nb / n.maximum(ntot, 1)
+        nsamp[u] = ntot
+        # Medians are stepped in units of a running median absolute deviation
+        if self.median:
+            med, medsp = self.med.reshape(-1, self.nchan), self.medsp.reshape(-1, self.nchan)
+            self._step(med, u, inv, x, valid, nb, ntot, medsp[u])
+            self._step(medsp, u, inv, n.abs(x - med[k]), valid, nb, ntot)
+        if self.center:
+            cre, cim = self.cre.reshape(-1, self.nchan), self.cim.reshape(-1, self.nchan)
+            mad = self.mad.reshape(-1, self.nchan)
+            scale = mad[u]
+            self._step(cre, u, inv, d.real, valid, nb, ntot, scale)
+            self._step(cim, u, inv, d.imag, valid, nb, ntot, scale)
+            res = n.abs(d - (cre[k] + 1j * cim[k]))
+            self._step(mad, u, inv, res, valid, nb, ntot)
+    def stats(self):
+        '''Return the binned data as a dict of (nlst, nblp, nchan) arrays:
+        'vis' (weighted average), 'flg' (True where vis is 0), 'cnt' (sum of
+        weights), 'min', 'max', 'var' and, if median, 'median' (of |d|).
+        Statistics of empty bins are 0.  The blp of each index along axis 1
+        is given by the blps dict.'''
+        nblp = len(self.blps)
+        wsum, nsamp = self.wsum[:,:nblp], self.nsamp[:,:nblp]
+        has = nsamp > 0
+        rv = {}
+        rv['vis'] = n.where(wsum > 0, self.dsum[:,:nblp] / n.where(wsum > 0, wsum, 1), 0).astype(n.complex64)
+        rv['flg'] = (rv['vis'] == 0)
+        rv['cnt'] = wsum
+        rv['min'] = n.where(has, self.dmin[:,:nblp], 0)
+        rv['max'] = n.where(has, self.dmax[:,:nblp], 0)
+        rv['var'] = n.where(has, self.m2[:,:nblp] / n.maximum(nsamp, 1), 0)
+        if self.median: rv['median'] = n.where(has, self.med[:,:nblp], 0)
+        return rv
+    def state(self, prefix=''):
+        '''Return the accumulators as a dict of arrays (with keys starting
+        with prefix), from which from_state rebuilds this binner.'''
+        nblp = len(self.blps)
+        rv = {}
+        for name,dtype,init in self._fields(): rv[prefix+name] = getattr(self, name)[:,:nblp]
+        blps = sorted(self.blps.keys(), key=lambda blp: self.blps[blp])
+        rv[prefix+'blps'] = n.array(blps, dtype=n.int)
+        rv[prefix+'opts'] = n.array([self.nlst, self.nchan, self.median, self.center, self.nsig])
+        return rv
+
+def from_state(state, prefix='', clip=None):
+    '''Rebuild a LSTBinner from the arrays returned by LSTBinner.state.'''
+    nlst, nchan, median, center, nsig = state[prefix+'opts']
+    blps = state[prefix+'blps']
+    b = LSTBinner(int(nlst), int(nchan), nblp=max(len(blps),1),
+        median=bool(median), center=bool(center), clip=clip, nsig=nsig)
+    for cnt,blp in enumerate(blps): b.blps[int(blp)] = cnt
+    for name,dtype,init in b._fields(): getattr(b, name)[:,:len(blps)] = state[prefix+name]
+    return b
+
+def save_state(filename, binners, **kwargs):
+    '''Write the binners in the dict binners (name -> LSTBinner), along
+    with any extra arrays in kwargs, to the npz file filename.  The file is
+    written under a temporary name and renamed into place, so an existing
+    state is never left half-written.'''
+    arrays = {}
+    for name,b in binners.iteritems(): arrays.update(b.state(prefix=name+'_'))
+    for k,v in kwargs.iteritems(): arrays['x_'+k] = v
+    arrays['binners'] = n.array(binners.keys())
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(suffix='.npz', dir=dirname)
+    f = os.fdopen(fd, 'wb')
+    try: n.savez(f, **arrays)
+    finally: f.close()
+    os.rename(tmp, filename)
+
+def load_state(filename):
+    '''Return (binners, extra) as passed to save_state from the npz file
+    filename.'''
+    npz = n.load(filename)
+    binners = {}
+    for name in npz['binners']: binners[str(name)] = from_state(npz, prefix=name+'_')
+    extra = {}
+    for k in npz.files:
+        if k.startswith('x_'): extra[k[2:]] = npz[k]
+    return binners, extra
@@ -1,6 +1,90 @@
-import aipy as a, numpy as n
+import aipy as a, numpy as n, os, hashlib, shutil, tempfile
+import multiprocessing as mpr
 
-def read_files(filenames, antstr, polstr, decimate=1, decphs=0, verbose=False, recast_as_array=True):
+# Approximate bytes of preamble and variable headers that Miriad writes
+# alongside the spectrum of every record in visdata.
+REC_OVERHEAD = 64
+# Default directory for on-disk visibility caches (see read_files).
+CACHE_DIR = os.environ.get('CAPO_UVCACHE', None)
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.capo/uvcache')
+# Where worker processes of read_files(nproc>1) leave decoded files for the parent.
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def est_ntimes(uv, filename, decimate=1):
+    '''Estimate the number of integrations in an open Miriad file from the
+    size of its visdata and the header, assuming every baseline and pol is
+    present in every integration.'''
+    try: nbytes = os.path.getsize(os.path.join(filename, 'visdata'))
+    except(OSError): return 1
+    if uv.vartable.get('corr', 'r') == 'j': bytes_per_chan = 4
+    else: bytes_per_chan = 8
+    nrec = nbytes / (bytes_per_chan * uv['nchan'] + REC_OVERHEAD)
+    try: npol = uv['npol']
+    except(KeyError): npol = 1
+    nbls = uv['nants'] * (uv['nants'] + 1) / 2 * npol
+    return max(1, int(n.ceil(float(nrec) / max(nbls,1) / decimate)))
+
+class UVBlock:
+    '''Preallocated (ntimes, nchan) complex64 data and bool flag arrays for a
+    single baseline/pol, filled in place one record at a time.  The index
+    of each row into the list of times read is kept in tidx.'''
+    def __init__(self, nrows, nchan):
+        self.dat = n.empty((nrows, nchan), dtype=n.complex64)
+        self.flg = n.empty((nrows, nchan), dtype=n.bool)
+        self.tidx = n.empty((nrows,), dtype=n.int32)
+        self.cnt = 0
+    def append(self, d, f, ti=-1):
+        if self.cnt == self.dat.shape[0]: # header estimate fell short
+            self.resize(self.cnt + max(1, self.cnt / 2))
+        self.dat[self.cnt] = d
+        self.flg[self.cnt] = f
+        self.tidx[self.cnt] = ti
+        self.cnt += 1
+    def resize(self, nrows):
+        # ndarray.resize reallocs in place, so no second copy is held
+        self.dat.resize((nrows, self.dat.shape[1]), refcheck=False)
+        self.flg.resize((nrows, self.flg.shape[1]), refcheck=False)
+        self.tidx.resize((nrows,), refcheck=False)
+    def trim(self):
+        '''Release unused rows and return the filled (dat, flg) arrays.'''
+        if self.cnt != self.dat.shape[0]: self.resize(self.cnt)
+        dat, flg = self.dat, self.flg
+        self.dat, self.flg = None, None
+        return dat, flg
+
+def _read_blocks(filenames, antstr, polstr, decimate=1, decphs=0, verbose=False):
+    '''Read the selected records of filenames into UVBlocks.  Returns a dict
+    of times/lsts (as lists) and header values, and blocks[bl][pol].'''
+    info = {'lsts':[], 'times':[]}
+    ts = {}
+    blocks = {}
+    # Size every block for all files up front; blocks only grow if this falls short
+    nrows = 0
+    for filename in filenames:
+        uv = a.miriad.UV(filename)
+        nrows += est_ntimes(uv, filename, decimate=decimate)
+        del(uv)
+    for filename in filenames:
+        if verbose: print '   Reading', filename
+        uv = a.miriad.UV(filename)
+        a.scripting.uv_selector(uv, antstr, polstr)
+        if decimate > 1: uv.select('decimate', decimate, decphs)
+        for (crd,t,(i,j)),d,f in uv.all(raw=True):
+            if not ts.has_key(t):
+                ts[t] = len(info['times'])
+                info['times'].append(t)
+                info['lsts'].append(uv['lst'])
+            bl = (i,j)
+            if not blocks.has_key(bl): blocks[bl] = {}
+            pol = a.miriad.pol2str[uv['pol']]
+            try: blocks[bl][pol].append(d, f, ts[t])
+            except(KeyError):
+                blocks[bl][pol] = UVBlock(nrows, uv['nchan'])
+                blocks[bl][pol].append(d, f, ts[t])
+    for k in ['sdf', 'sfreq', 'nchan', 'nants']: info[k] = uv[k]
+    return info, blocks
+
+def read_files(filenames, antstr, polstr, decimate=1, decphs=0, verbose=False, recast_as_array=True, cache=None, nproc=1):
     '''Read in miriad uv files.
        Parameters
        ---------
@@ -9,49 +93,366 @@ def read_files(filenames, antstr, polstr, decimate=1, decphs=0, verbose=False, r
             list of antennas and or baselines. e.g. 9_10,5_3,...etc.
        polstr    : string
             polarization to extract.
+       cache     : string or bool
+            directory holding memory-mappable copies of each file (see
+            load_cache).  True uses ~/.capo/uvcache, and the default
+            (None) uses $CAPO_UVCACHE if it is set.
+       nproc     : int
+            number of worker processes decoding files in parallel.  Workers
+            hand decoded arrays back through memory-mapped files in shared
+            memory (/dev/shm), not by pickling, and the result is identical
+            to the serial read.
 
-       Returns 
+       Returns
        -------
-       info      : dict. 
+       info      : dict.
             the lsts and jd's of the data
        dat       : dict
-            the data in dictionary format. dat[bl(in tuple format)][pol(in string)]  
+            the data in dictionary format. dat[bl(in tuple format)][pol(in string)]
        flg       : dict
-            corresponding flags to data. Same format. 
+            corresponding flags to data. Same format.
+
+       Each dat[bl][pol] is a (ntimes, nchan) complex64 array (and each
+       flg[bl][pol] a bool array of the same shape) allocated once, using the
+       file headers to size it, and filled in place as records are read.
     '''
-        
-        
-    info = {'lsts':[], 'times':[]}
-    ts = {}
-    dat, flg = {}, {}
-    if type(filenames) == 'str': filenames = [filenames]
+    if isinstance(filenames, str): filenames = [filenames]
+    if cache is None: cache = CACHE_DIR
+    if cache is True: cache = DEFAULT_CACHE_DIR
+    if cache:
+        info, dat, flg = read_cached(filenames, antstr, polstr, cache, decimate=decimate, decphs=decphs, verbose=verbose, nproc=nproc)
+    elif nproc > 1 and len(filenames) > 1:
+        info, dat, flg = read_parallel(filenames, antstr, polstr, nproc, decimate=decimate, decphs=decphs, verbose=verbose)
+    else:
+        info, blocks = _read_blocks(filenames, antstr, polstr, decimate=decimate, decphs=decphs, verbose=verbose)
+        dat, flg = {}, {}
+        for bl in blocks.keys():
+            dat[bl], flg[bl] = {}, {}
+            for pol in blocks[bl].keys():
+                dat[bl][pol], flg[bl][pol] = blocks[bl][pol].trim()
+            del(blocks[bl])
+    info['freqs'] = a.cal.get_freqs(info.pop('sdf'), info.pop('sfreq'), info.pop('nchan'))
+    del(info['nants'])
+    if recast_as_array:
+        info['lsts'] = n.array(info['lsts'])
+        info['times'] = n.array(info['times'])
+    else:
+        info['lsts'] = list(info['lsts'])
+        info['times'] = list(info['times'])
+        for bl in dat:
+            for pol in dat[bl]:
+                dat[bl][pol], flg[bl][pol] = list(dat[bl][pol]), list(flg[bl][pol])
+    return info, dat, flg
+
+def time_index(times):
+    '''Return a dict mapping each JD in times to its row, for O(1) lookup of
+    the row a Miriad record belongs to.'''
+    return dict(zip(times, xrange(len(times))))
+
+def pipe_arrays(uvi, uvo, times, dat, flg=None, append2hist=''):
+    '''Pipe uvi into uvo, replacing the spectrum of each record with the
+    matching row of dat[bl][pol], where rows are ordered as times (e.g. the
+    info['times'] and dat returned by read_files).  Flags come from
+    flg[bl][pol] if provided, and otherwise pass through from uvi.  Records
+    whose baseline, pol or time is not in dat are dropped.  The time index
+    is built once, so each record costs a dict lookup rather than a search
+    over times.'''
+    t2i = time_index(times)
+    nchan = uvi['nchan']
+    def mfunc(uv, p, d, f):
+        uvw,t,(i,j) = p
+        pol = a.miriad.pol2str[uv['pol']]
+        try:
+            ti = t2i[t]
+            d = dat[(i,j)][pol][ti]
+            if not flg is None: f = flg[(i,j)][pol][ti]
+        except(KeyError): return p, None, None
+        assert(d.size == nchan)
+        return p, d, f
+    uvo.pipe(uvi, mfunc=mfunc, append2hist=append2hist, raw=True)
+
+def read_chunks(filenames, antstr, polstr, chunk=64, pad=0, decimate=1, decphs=0, verbose=False):
+    '''Stream miriad uv files as a sequence of fixed-length time chunks.
+       Parameters
+       ---------
+       filenames : list of files, read in order as one continuous stream
+       antstr    : string
+            list of antennas and or baselines. e.g. 9_10,5_3,...etc.
+       polstr    : string
+            polarization to extract.
+       chunk     : int
+            number of integrations in the core of each chunk.
+       pad       : int
+            number of integrations of neighboring chunks to include on
+            either side of the core (at most chunk), for filters that need
+            context.  Pads are trimmed at the start and end of the stream.
+
+       Yields
+       -------
+       info      : dict.
+            the lsts and jd's of the chunk, the freqs, and 'core', the
+            slice of the chunk's times that are not padding.
+       dat       : dict
+            dat[bl][pol] is a (ntimes, nchan) complex64 array for the chunk.
+       flg       : dict
+            corresponding bool flags.  Baselines missing at a time are
+            flagged, so every block is aligned with info['times'].
+
+       Peak memory is set by chunk+2*pad, not by the number of files.
+    '''
+    assert(pad <= chunk)
+    if isinstance(filenames, str): filenames = [filenames]
+    nwin = chunk + 2 * pad
+    times, lsts = [], []
+    buf = {} # buf[(bl,pol)] = (data, flags) with room for nwin integrations
+    state = {'cs':0, 'ws':0} # absolute index of the core and window starts
+    def alloc():
+        return n.zeros((nwin,nchan), dtype=n.complex64), n.ones((nwin,nchan), dtype=n.bool)
+    def emit(ntimes):
+        '''Yield the window, then drop integrations before the next window.'''
+        cs, ws = state['cs'], state['ws']
+        ce = min(cs + chunk, ws + ntimes)
+        nrows = min(ce + pad, ws + ntimes) - ws
+        info = {'times':n.array(times[:nrows]), 'lsts':n.array(lsts[:nrows]),
+            'freqs':freqs, 'core':slice(cs - ws, ce - ws)}
+        dat, flg = {}, {}
+        for (bl,pol),(d,f) in buf.iteritems():
+            if not dat.has_key(bl): dat[bl], flg[bl] = {}, {}
+            dat[bl][pol], flg[bl][pol] = d[:nrows].copy(), f[:nrows].copy()
+        nws = max(ws, ce - pad)
+        drop = nws - ws
+        del(times[:drop]); del(lsts[:drop])
+        for d,f in buf.itervalues():
+            d[:nwin-drop] = d[drop:]; d[nwin-drop:] = 0
+            f[:nwin-drop] = f[drop:]; f[nwin-drop:] = True
+        state['cs'], state['ws'] = ce, nws
+        return info, dat, flg
+    curtime = None
     for filename in filenames:
         if verbose: print '   Reading', filename
         uv = a.miriad.UV(filename)
+        nchan = uv['nchan']
+        freqs = a.cal.get_freqs(uv['sdf'], uv['sfreq'], nchan)
         a.scripting.uv_selector(uv, antstr, polstr)
         if decimate > 1: uv.select('decimate', decimate, decphs)
         for (crd,t,(i,j)),d,f in uv.all(raw=True):
-            if not ts.has_key(t):
-                info['times'].append(t)
-                info['lsts'].append(uv['lst'])
-                ts[t] = None
-            bl = (i,j)
-            if not dat.has_key(bl): dat[bl],flg[bl] = {},{}
-            pol = a.miriad.pol2str[uv['pol']]
-            if not dat[bl].has_key(pol):
-                dat[bl][pol],flg[bl][pol] = [],[]
-            dat[bl][pol].append(d)
-            flg[bl][pol].append(f)
-    info['freqs'] = a.cal.get_freqs(uv['sdf'], uv['sfreq'], uv['nchan'])
-    if recast_as_array:
-        # This option helps reduce memory footprint, but it shouldn't
-        # be necessary: the replace below should free RAM as quickly
-        # as it is allocated.  Unfortunately, it doesn't seem to...
-        for bl in dat.keys():
-          for pol in dat[bl].keys():
-            dat[bl][pol] = n.array(dat[bl][pol])
-            flg[bl][pol] = n.array(flg[bl][pol])
-        info['lsts'] = n.array(info['lsts'])
-        info['times'] = n.array(info['times'])
-    return info, dat, flg
+            if t != curtime:
+                # full window and a new integration: the current core is done
+                if len(times) == state['cs'] + chunk + pad - state['ws']:
+                    yield emit(len(times))
+                times.append(t); lsts.append(uv['lst'])
+                curtime = t
+            key = ((i,j), a.miriad.pol2str[uv['pol']])
+            if not buf.has_key(key): buf[key] = alloc()
+            ti = len(times) - 1
+            buf[key][0][ti], buf[key][1][ti] = d, f
+        del(uv)
+    while state['cs'] < state['ws'] + len(times):
+        yield emit(len(times))
 
+# ---- On-disk visibility cache ----
+# A cache entry for a Miriad file is a directory holding meta.npz (times,
+# lsts, header values, and the baseline/pol/offset of each block), and
+# dat.npy/flg.npy/tidx.npy with the rows of every block stacked in order.
+
+def file_stamp(filename):
+    '''Return the mtimes and sizes of the files making up a Miriad dataset,
+    used to decide whether a cache entry is stale.'''
+    stamp = []
+    for name in ['header', 'vartable', 'visdata', 'flags']:
+        try:
+            st = os.stat(os.path.join(filename, name))
+            stamp += [st.st_mtime, st.st_size]
+        except(OSError): stamp += [0, 0]
+    return n.array(stamp, dtype=n.float64)
+
+def cache_path(filename, cache_dir):
+    '''Return the cache entry directory for filename inside cache_dir.'''
+    filename = os.path.abspath(filename).rstrip('/')
+    key = hashlib.md5(filename).hexdigest()[:16]
+    return os.path.join(cache_dir, '%s.%s' % (os.path.basename(filename), key))
+
+def write_cache(filename, path, antstr='all', polstr=-1, decimate=1, decphs=0, verbose=False):
+    '''Decode the selected records (by default, every record) of filename
+    and write a cache entry to path.  The entry is assembled in a temporary
+    directory and renamed into place, so readers never see a partial entry.'''
+    stamp = file_stamp(filename)
+    info, blocks = _read_blocks([filename], antstr, polstr, decimate=decimate, decphs=decphs, verbose=verbose)
+    keys = [(bl,pol) for bl in blocks for pol in blocks[bl]]
+    keys.sort()
+    cnts = n.array([blocks[bl][pol].cnt for bl,pol in keys], dtype=n.int64)
+    offsets = n.cumsum(cnts) - cnts
+    nrows, nchan = cnts.sum(), info['nchan']
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    if not os.path.exists(tmp): os.makedirs(tmp)
+    if nrows == 0: # nothing selected; empty arrays cannot be mapped
+        n.save(os.path.join(tmp, 'dat.npy'), n.empty((0,nchan), dtype=n.complex64))
+        n.save(os.path.join(tmp, 'flg.npy'), n.empty((0,nchan), dtype=n.bool))
+        n.save(os.path.join(tmp, 'tidx.npy'), n.empty((0,), dtype=n.int32))
+    else:
+        dat = n.lib.format.open_memmap(os.path.join(tmp, 'dat.npy'), mode='w+', dtype=n.complex64, shape=(nrows,nchan))
+        flg = n.lib.format.open_memmap(os.path.join(tmp, 'flg.npy'), mode='w+', dtype=n.bool, shape=(nrows,nchan))
+        tidx = n.lib.format.open_memmap(os.path.join(tmp, 'tidx.npy'), mode='w+', dtype=n.int32, shape=(nrows,))
+        for (bl,pol),off,cnt in zip(keys, offsets, cnts):
+            b = blocks[bl].pop(pol)
+            dat[off:off+cnt] = b.dat[:cnt]
+            flg[off:off+cnt] = b.flg[:cnt]
+            tidx[off:off+cnt] = b.tidx[:cnt]
+            del(b)
+        dat.flush(); flg.flush(); tidx.flush()
+        del(dat, flg, tidx)
+    n.savez(os.path.join(tmp, 'meta.npz'), stamp=stamp,
+        times=n.array(info['times']), lsts=n.array(info['lsts']),
+        hdr=n.array([info['sdf'], info['sfreq'], info['nchan'], info['nants']], dtype=n.float64),
+        bl_i=n.array([bl[0] for bl,pol in keys], dtype=n.int32),
+        bl_j=n.array([bl[1] for bl,pol in keys], dtype=n.int32),
+        pols=n.array([a.miriad.str2pol[pol] for bl,pol in keys], dtype=n.int32),
+        offsets=offsets, cnts=cnts)
+    if os.path.exists(path): shutil.rmtree(path)
+    os.rename(tmp, path)
+
+def update_cache(filename, cache_dir, verbose=False):
+    '''(Re)write the cache entry for filename if it is missing or filename
+    has changed since it was made.  Returns the entry's path.'''
+    path = cache_path(filename, cache_dir)
+    try:
+        meta = n.load(os.path.join(path, 'meta.npz'))
+        if n.all(meta['stamp'] == file_stamp(filename)): return path
+    except(IOError, OSError, KeyError): pass
+    if verbose: print '   Caching', filename, '->', path
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+    write_cache(filename, path, verbose=verbose)
+    return path
+
+def _update_cache(args):
+    filename, cache_dir, verbose = args
+    return update_cache(filename, cache_dir, verbose=verbose)
+
+def open_entry(path):
+    '''Return the cache entry at path as (meta, dat, flg, tidx), where
+    dat/flg/tidx are copy-on-write memory maps.'''
+    meta = dict(n.load(os.path.join(path, 'meta.npz')))
+    if meta['cnts'].sum() == 0: mode = None # empty arrays cannot be mapped
+    else: mode = 'c'
+    dat = n.load(os.path.join(path, 'dat.npy'), mmap_mode=mode)
+    flg = n.load(os.path.join(path, 'flg.npy'), mmap_mode=mode)
+    tidx = n.load(os.path.join(path, 'tidx.npy'), mmap_mode=mode)
+    return meta, dat, flg, tidx
+
+def load_cache(filename, cache_dir, verbose=False):
+    '''Return the cache entry for filename as (meta, dat, flg, tidx), where
+    dat/flg/tidx are copy-on-write memory maps.  The entry is (re)written
+    first if it is missing or filename has changed since it was made.'''
+    return open_entry(update_cache(filename, cache_dir, verbose=verbose))
+
+def select_bls(antstr, polstr, nants, i, j, pol):
+    '''Emulate a.scripting.uv_selector on arrays of the ants and pol codes
+    of cached blocks, returning a bool mask of the blocks that uv_selector
+    would have selected.  Terms are combined left to right, with included
+    terms or-ed and excluded terms and-ed, as in uv_selector.  Like
+    uv_selector, polstr is ignored when antstr parses to no terms ('all').'''
+    i, j, pol = n.asarray(i), n.asarray(j), n.asarray(pol)
+    def pol_mask(polstr):
+        return n.in1d(pol, [a.miriad.str2pol[p] for p in polstr.split(',')])
+    mask, terms = None, []
+    if antstr != -1:
+        terms = a.scripting.parse_ants(antstr, nants)
+        for bl,include,p in terms:
+            if bl == 'auto': sel = (i == j)
+            else:
+                bi,bj = a.miriad.bl2ij(bl)
+                sel = n.logical_or(n.logical_and(i == bi, j == bj), n.logical_and(i == bj, j == bi))
+            if p != -1: sel = n.logical_and(sel, pol_mask(p))
+            if not include: sel = n.logical_not(sel)
+            if mask is None: mask = sel
+            elif include: mask = n.logical_or(mask, sel)
+            else: mask = n.logical_and(mask, sel)
+    if mask is None: mask = n.ones(pol.shape, dtype=n.bool)
+    if polstr != -1 and (antstr == -1 or len(terms) > 0):
+        mask = n.logical_and(mask, pol_mask(polstr))
+    return mask
+
+def read_cached(filenames, antstr, polstr, cache_dir, decimate=1, decphs=0, verbose=False, nproc=1):
+    '''Return the same (info, dat, flg) as reading filenames directly, but
+    serve them by slicing the memory-mapped cache entry of each file.
+    Missing or stale entries are written by nproc worker processes.
+    Unlike read_files, info holds lists and header values.'''
+    args = [(filename, cache_dir, verbose) for filename in filenames]
+    if nproc > 1 and len(filenames) > 1:
+        pool = mpr.Pool(processes=min(nproc, len(filenames)))
+        try: paths = pool.map(_update_cache, args)
+        finally: pool.close(); pool.join()
+    else: paths = map(_update_cache, args)
+    entries = [open_entry(path) for path in paths]
+    return select_entries(entries, antstr, polstr, decimate=decimate, decphs=decphs)
+
+def _decode_to_shm(args):
+    filename, antstr, polstr, decimate, decphs, path, verbose = args
+    write_cache(filename, path, antstr=antstr, polstr=polstr, decimate=decimate, decphs=decphs, verbose=verbose)
+    return path
+
+def read_parallel(filenames, antstr, polstr, nproc, decimate=1, decphs=0, verbose=False):
+    '''Decode filenames in nproc worker processes.  Each worker writes the
+    selected records of its file as a cache entry in shared memory, and
+    the parent maps the entries and copies them, in file order, into the
+    output arrays.  Unlike read_files, info holds lists and header values.'''
+    tmpdir = tempfile.mkdtemp(prefix='capo_uv', dir=SHM_DIR)
+    try:
+        args = [(filename, antstr, polstr, decimate, decphs, os.path.join(tmpdir, '%d' % cnt), verbose)
+            for cnt,filename in enumerate(filenames)]
+        pool = mpr.Pool(processes=min(nproc, len(filenames)))
+        try: paths = pool.map(_decode_to_shm, args)
+        finally: pool.close(); pool.join()
+        entries = [open_entry(path) for path in paths]
+        return select_entries(entries, 'all', -1, view=False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def select_entries(entries, antstr, polstr, decimate=1, decphs=0, view=True):
+    '''Select records from opened cache entries and concatenate them, in
+    entry order, into the (info, dat, flg) that read_files returns.  If
+    view, a single undecimated entry is served as views of its maps.'''
+    info = {'lsts':[], 'times':[]}
+    ts = {}
+    sel = []
+    for meta,dat,flg,tidx in entries:
+        mask = select_bls(antstr, polstr, int(meta['hdr'][3]), meta['bl_i'], meta['bl_j'], meta['pols'])
+        rows = {}
+        for b in n.where(mask)[0]:
+            off, cnt = meta['offsets'][b], meta['cnts'][b]
+            r = n.arange(off, off+cnt)
+            if decimate > 1: r = r[tidx[off:off+cnt] % decimate == decphs]
+            if r.size == 0: continue
+            key = ((int(meta['bl_i'][b]), int(meta['bl_j'][b])), a.miriad.pol2str[meta['pols'][b]])
+            rows[key] = r
+        # times/lsts are recorded in order of first appearance, as read_files does
+        if len(rows) > 0:
+            for ti in n.unique(n.concatenate([tidx[r] for r in rows.values()])):
+                t = meta['times'][ti]
+                if not ts.has_key(t):
+                    ts[t] = None
+                    info['times'].append(t)
+                    info['lsts'].append(meta['lsts'][ti])
+        sel.append(rows)
+    sdf, sfreq, nchan, nants = meta['hdr']
+    info['sdf'], info['sfreq'], info['nchan'], info['nants'] = sdf, sfreq, int(nchan), int(nants)
+    dat, flg = {}, {}
+    keys = {}
+    for rows in sel: keys.update(rows)
+    for bl,pol in keys:
+        if not dat.has_key(bl): dat[bl], flg[bl] = {}, {}
+        nrows = sum([rows[(bl,pol)].size for rows in sel if rows.has_key((bl,pol))])
+        if view and len(entries) == 1 and decimate == 1: # serve a view of the map directly
+            r = sel[0][(bl,pol)]
+            dat[bl][pol], flg[bl][pol] = entries[0][1][r[0]:r[-1]+1], entries[0][2][r[0]:r[-1]+1]
+            continue
+        d = n.empty((nrows, info['nchan']), dtype=n.complex64)
+        f = n.empty((nrows, info['nchan']), dtype=n.bool)
+        cnt = 0
+        for (meta,_dat,_flg,tidx),rows in zip(entries, sel):
+            if not rows.has_key((bl,pol)): continue
+            r = rows[(bl,pol)]
+            d[cnt:cnt+r.size], f[cnt:cnt+r.size] = _dat[r], _flg[r]
+            cnt += r.size
+        dat[bl][pol], flg[bl][pol] = d, f
+    return info, dat, flg
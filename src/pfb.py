@@ -18,6 +18,7 @@ pfb.WINDOWS is a list of built-in windowing functions."""
 
 import numpy as n
 from aipy._cephes import i0
+from collections import OrderedDict
 
 NOISE_EQUIV_BW = {
     'blackman': 1.73,
@@ -32,6 +33,12 @@ NOISE_EQUIV_BW = {
 }
 WINDOWS = NOISE_EQUIV_BW.keys()
 
+# Number of coefficient arrays kept by get_coeffs, so that alternating
+# between (L, window, taps, fwidth) configurations does not recompute them.
+PFB_LRU_SIZE = 16
+_PFB_LRU = OrderedDict()
+
+# The last configuration passed to __set_pm__, kept for backward compatibility.
 pm = {}
 pm['L'] = None
 pm['taps'] = None
@@ -41,67 +48,102 @@ pm['window_name'] = None
 pm['sinx_x'] = None
 pm['window_sinx_x'] = None
 
+def _cached(key, compute):
+    """Return the array stored under key in the LRU, calling compute() to
+    make it (read-only, since it is shared) if it is not there."""
+    if _PFB_LRU.has_key(key):
+        _PFB_LRU[key] = val = _PFB_LRU.pop(key)
+        return val
+    val = compute()
+    val.flags.writeable = False
+    _PFB_LRU[key] = val
+    while len(_PFB_LRU) > PFB_LRU_SIZE: _PFB_LRU.popitem(last=False)
+    return val
+
+def get_sinx_x(L, taps=8, fwidth=1, dtype=n.float64):
+    """Return the sinc of length L that the window is multiplied by."""
+    def sinx_x(x):
+        t = n.pi * taps * fwidth * (x/float(L) - .5)
+        v = n.where(t != 0, t, 1)
+        return n.where(t != 0, n.sin(v) / v, 1)
+    return _cached(('sinx_x', L, taps, fwidth, n.dtype(dtype).str),
+        lambda: n.fromfunction(sinx_x, (L,)).astype(dtype))
+
+def get_window(L, window='hamming', dtype=n.float64):
+    """Return the built-in window named 'window' (see WINDOWS), of length L."""
+    wf = {}
+    wf['blackman'] = lambda x: .42-.5*n.cos(2*n.pi*x/(L-1))+.08*n.cos(4*n.pi*x/(L-1))
+    wf['blackman-harris'] = lambda x: .35875 - .48829*n.cos(2*n.pi*x/(L-1)) + .14128*n.cos(4*n.pi*x/(L-1)) - .01168*n.cos(6*n.pi*x/(L-1))
+    wf['gaussian0.4'] = lambda x: n.exp(-0.5 * ((x - (L-1)/2)/(0.4 * (L-1)/2))**2)
+    wf['kaiser2'] = lambda x: i0(n.pi * 2 * n.sqrt(1-(2*x/(L-1) - 1)**2)) / i0(n.pi * 2)
+    wf['kaiser3'] = lambda x: i0(n.pi * 3 * n.sqrt(1-(2*x/(L-1) - 1)**2)) / i0(n.pi * 3)
+    wf['hamming'] = lambda x: .54 - .46 * n.cos(2*n.pi*x/(L-1))
+    wf['hanning'] = lambda x: .5 - .5 * n.cos(2*n.pi*x/(L-1))
+    wf['parzen'] = lambda x: 1 - n.abs(L/2. - x) / (L/2.)
+    wf['none'] = lambda x: n.ones_like(x)
+    return _cached(('window', L, window, n.dtype(dtype).str),
+        lambda: n.fromfunction(wf[window], (L,)).astype(dtype))
+
+def get_coeffs(L, window='hamming', taps=8, fwidth=1, dtype=n.float64):
+    """Return the window * sinc coefficients of a PFB of length L.  A named
+    window's coefficients are cached per (L, window, taps, fwidth, dtype);
+    an array window is multiplied by the cached sinc."""
+    sinx_x = get_sinx_x(L, taps, fwidth, dtype)
+    if type(window) != str: return window * sinx_x
+    return _cached(('coeffs', L, window, taps, fwidth, n.dtype(dtype).str),
+        lambda: get_window(L, window, dtype) * sinx_x)
+
 def __set_pm__(L, window, taps, fwidth):
     global pm
-    if pm['L'] == L and pm['taps'] == taps and \
-       pm['fwidth'] == fwidth:
-        if type(window) == str and pm['window_name'] == window: return
-        elif window is pm['window']: return
-    else:
-        pm['L'] = L
-        pm['taps'] = taps
-        pm['fwidth'] = fwidth
-        def sinx_x(x):
-            t = n.pi * taps * fwidth * (x/float(L) - .5)
-            v = n.where(t != 0, t, 1)
-            return n.where(t != 0, n.sin(v) / v, 1)
-        pm['sinx_x'] = n.fromfunction(sinx_x, (L,))
-    if type(window) == str: 
-        wf = {}
-        wf['blackman'] = lambda x: .42-.5*n.cos(2*n.pi*x/(L-1))+.08*n.cos(4*n.pi*x/(L-1))
-        wf['blackman-harris'] = lambda x: .35875 - .48829*n.cos(2*n.pi*x/(L-1)) + .14128*n.cos(4*n.pi*x/(L-1)) - .01168*n.cos(6*n.pi*x/(L-1))
-        wf['gaussian0.4'] = lambda x: n.exp(-0.5 * ((x - (L-1)/2)/(0.4 * (L-1)/2))**2)
-        wf['kaiser2'] = lambda x: i0(n.pi * 2 * n.sqrt(1-(2*x/(L-1) - 1)**2)) / i0(n.pi * 2)
-        wf['kaiser3'] = lambda x: i0(n.pi * 3 * n.sqrt(1-(2*x/(L-1) - 1)**2)) / i0(n.pi * 3)
-        wf['hamming'] = lambda x: .54 - .46 * n.cos(2*n.pi*x/(L-1))
-        wf['hanning'] = lambda x: .5 - .5 * n.cos(2*n.pi*x/(L-1))
-        wf['parzen'] = lambda x: 1 - n.abs(L/2. - x) / (L/2.)
-        wf['none'] = lambda x: 1
-        pm['window'] = n.fromfunction(wf[window], (L,))
+    pm['L'] = L
+    pm['taps'] = taps
+    pm['fwidth'] = fwidth
+    pm['sinx_x'] = get_sinx_x(L, taps, fwidth)
+    if type(window) == str:
+        pm['window'] = get_window(L, window)
         pm['window_name'] = window
-    else: 
+    else:
         pm['window'] = window
         pm['window_name'] = None
-    pm['window_sinx_x'] = pm['window'] * pm['sinx_x']
+    pm['window_sinx_x'] = get_coeffs(L, window, taps, fwidth)
 
-def __pfb_fir__(data, window='hamming', taps=8, fwidth=1):
+def __pfb_fir__(data, window='hamming', taps=8, fwidth=1, dtype=n.float64):
     L = data.shape[-1]
-    __set_pm__(L, window, taps, fwidth)
-    d = data * pm['window_sinx_x']
+    d = data * get_coeffs(L, window, taps, fwidth, dtype)
     try: d.shape = d.shape[:-1] + (taps, L/taps)
     except: raise ValueError("More taps than samples")
     return n.sum(d, len(d.shape) - 2)
 
-def pfb(data, window='hamming', taps=8, fwidth=1, fft=n.fft.fft):
+def pfb(data, window='hamming', taps=8, fwidth=1, fft=n.fft.fft, dtype=n.float64):
     """Perform PFB on last dimension of 'data' for multi-dimensional arrays.
     'window' may be a name (e.g. 'hamming') or an array with length of the
     last dimension of 'data'.  'taps' is the number of PFB taps to use.  The
     number of channels out of the PFB will be length out of the last 
     dimension divided by the number of taps. 'fwidth' scales the width of 
-    each channel bandpass (to create overlapping filters, for example)."""
-    return fft(__pfb_fir__(data, window, taps, fwidth))
+    each channel bandpass (to create overlapping filters, for example).
+    'dtype' is the type of the coefficients (n.float32 keeps single-precision
+    data single).  Real data stays real through the filter, so fft=n.fft.rfft
+    returns its non-negative channels for about half the cost."""
+    return fft(__pfb_fir__(data, window, taps, fwidth, dtype))
 
 def streaming_pfb(data, nfreq, window='hamming', taps=8, fwidth=1,
-        fft=n.fft.fft):
-    """Perform as many PFBs of length 'nfreq' as fit in the 1d array 'data'.
+        fft=n.fft.fft, dtype=n.float64):
+    """Perform as many PFBs of length 'nfreq' as fit in the last dimension
+    of 'data' (which may hold, e.g., one stream per baseline).
     PFBs are computed using windows of length 'taps' * 'nfreq', which step
-    through 'data' in increments of 'nfreq'."""
-    d = n.resize(data, (n.floor(len(data)/nfreq), nfreq))
-    for t in range(taps-1):
-        d = n.concatenate([d[:-1], d[1:,t*nfreq:(t+1)*nfreq]], axis=1)
-    return pfb(d, window=window, taps=taps, fwidth=fwidth, fft=fft)
+    through 'data' in increments of 'nfreq'.  The windows are never copied
+    out of 'data': each tap is a strided view of its blocks of 'nfreq'."""
+    nblocks = data.shape[-1] / nfreq
+    nspec = nblocks - taps + 1
+    if nspec < 1: raise ValueError("More taps than samples")
+    d = data[...,:nblocks*nfreq].reshape(data.shape[:-1] + (nblocks, nfreq))
+    c = n.reshape(get_coeffs(taps*nfreq, window, taps, fwidth, dtype), (taps, nfreq))
+    fir = d[...,:nspec,:] * c[0]
+    for t in xrange(1, taps): fir += d[...,t:t+nspec,:] * c[t]
+    return fft(fir)
 
 def streaming_fft(data, nfreq, fft=n.fft.fft):
-    """Perform as many FFTs of length 'nfreq' as fit in the 1d array 'data'."""
-    d = n.resize(data, (n.floor(len(data)/nfreq), nfreq))
+    """Perform as many FFTs of length 'nfreq' as fit in the last dimension of 'data'."""
+    nblocks = data.shape[-1] / nfreq
+    d = data[...,:nblocks*nfreq].reshape(data.shape[:-1] + (nblocks, nfreq))
     return fft(d)
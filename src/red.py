@@ -2,30 +2,23 @@
 Tools for dealing with redundant array configurations.
 '''
 
-import numpy as n
+import numpy as n, os, shutil, tempfile
 from aipy.miriad import ij2bl, bl2ij
 import aipy as a
 import pylab as p
 import time 
 import multiprocessing as mpr
+from scipy import sparse
+import redindex
+from miriad import SHM_DIR
 
 def group_redundant_bls(antpos):
     '''Return 2 dicts: bls contains baselines grouped by separation ('drow,dcol'), conj indicates for each
-    baseline whether it must be conjugated to be redundant with the rest of the baselines in its redundancy group.'''
-    bls,conj = {}, {}
-    for ri in xrange(antpos.shape[0]):
-        for ci in xrange(antpos.shape[1]):
-            for rj in xrange(antpos.shape[0]):
-                for cj in xrange(ci,antpos.shape[1]):
-                    if ri >= rj and ci == cj: continue # exclude repeat +/- listings of certain bls
-                    sep = '%d,%d' % (rj-ri, cj-ci)
-                    i,j = antpos[ri,ci], antpos[rj,cj]
-                    if i > j: i,j,c = j,i,True
-                    else: c = False
-                    #bl = ij2bl(i,j)
-                    bl = (i,j)
-                    bls[sep] = bls.get(sep,[]) + [bl]
-                    conj[bl] = c
+    baseline whether it must be conjugated to be redundant with the rest of the baselines in its redundancy group.
+    See redindex.get_groups for the same grouping as integer arrays.'''
+    groups = redindex.get_groups(antpos, select='half')
+    bls = redindex.group_dict(groups)
+    conj = dict(zip(zip(groups.i.tolist(), groups.j.tolist()), groups.conj.tolist()))
     return bls, conj
 
 def redundant_bl_cal(d1, w1, d2, w2, fqs, use_offset=False, maxiter=10, window='blackman-harris',
@@ -92,6 +85,108 @@ def redundant_bl_cal(d1, w1, d2, w2, fqs, use_offset=False, maxiter=10, window='
     if use_offset: return gain, (tau,off), info
     else: return gain, tau, info
 
+def _bl_cal_batch(d1, w1, d2, w2, fqs, use_offset, maxiter, window, clean, tau, off):
+    '''The work of redundant_bl_cal_batch, for pairs that all have weight.'''
+    d12 = d2 * n.conj(d1)
+    if d12.ndim > 2: d12_sum,d12_wgt = n.sum(d12,axis=1), n.sum(w1*w2,axis=1)
+    else: d12_sum,d12_wgt = d12, w1*w2
+    d11 = d1 * n.conj(d1)
+    if d11.ndim > 2: d11_sum,d11_wgt = n.sum(d11,axis=1), n.sum(w1*w1,axis=1)
+    else: d11_sum,d11_wgt = d11, w1*w1
+    npairs, nchan = d12_sum.shape
+    pairs = n.arange(npairs)
+    window = a.dsp.gen_window(nchan, window=window)
+    dlys = n.fft.fftfreq(fqs.size, fqs[1]-fqs[0])
+    dtau,doff,mx = n.zeros(npairs), n.zeros(npairs), n.zeros(npairs, dtype=n.int)
+    # Begin at the beginning
+    d12_sum = d12_sum * n.exp(-2j*n.pi*(n.outer(tau,fqs)+off[:,None]))
+    for j in range(maxiter):
+        d12_sum *= n.exp(-2j*n.pi*(n.outer(dtau,fqs)+doff[:,None]))
+        tau += dtau; off += doff
+        _phs = n.fft.fft(window*d12_sum, axis=-1)
+        _wgt = n.fft.fft(window*d12_wgt, axis=-1)
+        _phs = n.abs([a.deconv.clean(_phs[k], _wgt[k], tol=clean)[0] for k in pairs])
+        mx = n.argmax(_phs, axis=-1)
+        # Pull out an integral number of phase wraps
+        fine = n.logical_and(j > maxiter/2, mx == 0)
+        mx = n.where(mx > nchan/2, mx - nchan, mx)
+        mxs = (mx[:,None] + n.array([-1,0,1])) % nchan
+        pk = _phs[pairs[:,None],mxs]
+        dtau = n.sum(pk * dlys[mxs], axis=1) / n.sum(pk, axis=1)
+        doff = n.zeros(npairs)
+        if n.any(fine): # Fine-tune calibration with linear fit
+            f_sum,f_wgt = d12_sum[fine], d12_wgt[fine]
+            valid = n.logical_and(f_wgt > f_wgt.max(axis=1)[:,None]/2, n.abs(f_sum) > 0)
+            dly = n.real(n.log(n.where(valid, f_sum, 1))/(2j*n.pi)) # This doesn't weight data
+            wgt = n.where(valid, f_wgt, 0)
+            if use_offset: # allow for an offset component: per-pair normal equations of the weighted fit
+                ww = wgt**2
+                s_ff,s_f1,s_11 = n.sum(ww*fqs**2,axis=1), n.sum(ww*fqs,axis=1), n.sum(ww,axis=1)
+                r_f,r_1 = n.sum(ww*fqs*dly,axis=1), n.sum(ww*dly,axis=1)
+                det = s_ff*s_11 - s_f1**2
+                dtau[fine] = (s_11*r_f - s_f1*r_1) / det
+                doff[fine] = (s_ff*r_1 - s_f1*r_f) / det
+            else:
+                dtau[fine] = n.sum(wgt*dly/fqs,axis=1) / n.sum(wgt,axis=1)
+    off %= 1
+    info = {'dtau':dtau, 'doff':doff, 'mx':mx}
+    g12 = d12_sum / d12_wgt.clip(1,n.Inf)
+    g11 = d11_sum / d11_wgt.clip(1,n.Inf)
+    gain = n.where(g11 != 0, g12/g11, 0)
+    return gain, tau, off, info
+
+def _bl_cal_chunk(args):
+    tmpdir, start, stop, fqs, kwargs = args
+    d1,w1,d2,w2 = [n.load(os.path.join(tmpdir, name+'.npy'), mmap_mode='r')[start:stop]
+        for name in ('d1','w1','d2','w2')]
+    tau = n.load(os.path.join(tmpdir, 'tau.npy'))[start:stop]
+    off = n.load(os.path.join(tmpdir, 'off.npy'))[start:stop]
+    return _bl_cal_batch(d1, w1, d2, w2, fqs, tau=tau, off=off, **kwargs)
+
+def redundant_bl_cal_batch(d1, w1, d2, w2, fqs, use_offset=False, maxiter=10, window='blackman-harris',
+        clean=1e-4, tau=0., off=0., nproc=1):
+    '''Run redundant_bl_cal on a stack of baseline pairs at once.  d1,w1,d2,w2
+    are (npairs,nchan) or (npairs,ntimes,nchan) arrays; tau,off are starting
+    values, one for all pairs or one per pair.  The FFT and peak-finding of
+    each iteration run across all the pairs together.  With nproc > 1, the
+    pairs are split among nproc worker processes that map the stacks from
+    shared memory.  Returns gain (npairs,nchan) and tau (npairs), or
+    (tau,off) if use_offset, and info, a dict of per-pair arrays.  Pairs
+    without weight get zero gain and delay.'''
+    d1,w1,d2,w2 = [n.asarray(d) for d in (d1,w1,d2,w2)]
+    npairs, nchan = d1.shape[0], d1.shape[-1]
+    tau = n.resize(n.asarray(tau, dtype=n.float), npairs)
+    off = n.resize(n.asarray(off, dtype=n.float), npairs)
+    wgt = w1*w2
+    live = n.where(n.any(wgt.reshape(npairs,-1) != 0, axis=1))[0]
+    gain = n.zeros((npairs,nchan), dtype=n.result_type(d1, d2, n.complex64))
+    info = {'dtau':n.zeros(npairs), 'doff':n.zeros(npairs), 'mx':n.zeros(npairs, dtype=n.int)}
+    tau[n.setdiff1d(n.arange(npairs), live)] = 0
+    off[n.setdiff1d(n.arange(npairs), live)] = 0
+    kwargs = {'use_offset':use_offset, 'maxiter':maxiter, 'window':window, 'clean':clean}
+    if live.size == 0: results = []
+    elif nproc > 1 and live.size > 1:
+        tmpdir = tempfile.mkdtemp(prefix='capo_red', dir=SHM_DIR)
+        try:
+            for name,d in zip(('d1','w1','d2','w2','tau','off'), (d1,w1,d2,w2,tau,off)):
+                n.save(os.path.join(tmpdir, name+'.npy'), d[live])
+            bounds = n.linspace(0, live.size, min(nproc, live.size)+1).astype(n.int)
+            args = [(tmpdir, start, stop, fqs, kwargs) for start,stop in zip(bounds[:-1], bounds[1:])]
+            pool = mpr.Pool(processes=len(args))
+            try: results = pool.map(_bl_cal_chunk, args)
+            finally: pool.close(); pool.join()
+        finally:
+            shutil.rmtree(tmpdir)
+    else:
+        results = [_bl_cal_batch(d1[live], w1[live], d2[live], w2[live], fqs, tau=tau[live], off=off[live], **kwargs)]
+    if len(results) > 0:
+        gain[live] = n.concatenate([r[0] for r in results])
+        tau[live] = n.concatenate([r[1] for r in results])
+        off[live] = n.concatenate([r[2] for r in results])
+        for k in info: info[k][live] = n.concatenate([r[3][k] for r in results])
+    if use_offset: return gain, (tau,off), info
+    else: return gain, tau, info
+
 def fit_line(phs, fqs, valid, offset=False):
     fqs = fqs.compress(valid)
     dly = phs.compress(valid)
@@ -239,16 +334,58 @@ def redundant_bl_cal_simple(d1,w1,d2,w2,fqs, cleantol=1e-4, window='none', finet
 
 
 
+def sparse_rows(rows, ncols):
+    '''Return the CSR matrix whose rows are given as dicts of column:value.'''
+    indptr = n.cumsum([0] + [len(r) for r in rows])
+    indices = n.array([c for r in rows for c in r], dtype=n.int64)
+    data = n.array([r[c] for r in rows for c in r], dtype=n.double)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), ncols))
+
+class LeastSquaresSolver:
+    '''Solves M x = y in the least-squares sense for a sparse (nmeas,nprms) M, giving the same minimum-norm
+    solution as n.dot(n.linalg.pinv(M), y).  Only the (nprms,nprms) normal matrix M^T M is factored, once, and
+    the factorization is reused for every y.  The normal matrix is scaled to unit diagonal before its
+    eigendecomposition (so that heavily weighted rows do not swamp the rest), and the null space of M (the
+    degeneracies of redundant calibration) is projected out of the solution, as pinv does.'''
+    def __init__(self, M, rcond=1e-10):
+        self.M = sparse.csr_matrix(M)
+        N = (self.M.T * self.M).toarray()
+        d = n.sqrt(n.diag(N))
+        d = 1 / n.where(d > 0, d, 1)
+        lam, V = n.linalg.eigh(N * d.reshape((-1,1)) * d)
+        keep = lam > rcond * max(lam.max(), 0)
+        Ninv = n.dot(d.reshape((-1,1)) * V[:,keep] / lam[keep], (d.reshape((-1,1)) * V[:,keep]).T)
+        if not n.all(keep):
+            Z = n.linalg.qr(d.reshape((-1,1)) * V[:,~keep])[0]
+            Ninv -= n.dot(Z, n.dot(Z.T, Ninv))
+        self.Ninv = Ninv
+    def solve(self, y):
+        '''Solve for every column of y: y is (nmeas,...) and the solution is (nprms,...).'''
+        shape = y.shape
+        x = self.M.T.dot(n.reshape(y, (shape[0], -1)))
+        return n.dot(self.Ninv, x).reshape((self.M.shape[1],) + shape[1:])
+    def einsum(self, einstr, y):
+        '''Return what n.einsum(einstr, n.linalg.pinv(M), y) would, where the first operand of einstr indexes
+        (prm,meas): all other axes of y (e.g. times and channels) are solved for in one batched call.'''
+        if '->' in einstr: ins, out = einstr.split('->')
+        else: ins, out = einstr, None
+        a, b = ins.split(',')
+        prm, meas = a
+        if out is None: out = ''.join(sorted([c for c in a+b if (a+b).count(c) == 1]))
+        x = self.solve(n.rollaxis(n.asarray(y), b.index(meas)))
+        return n.einsum(prm + b.replace(meas,'') + '->' + out, x)
+
 class LogCalMatrix:
     def __init__(self, nants, npols, nseps):
         self.nants = nants
         self.npols = npols
         self.nseps = nseps
         self.nprms = nants * npols + nseps # total number of parameters being solved for
+        # one dict of prm:coefficient per measurement; only 3 of the nprms are non-zero
         self.M_phs = []
         self.M_amp = []
-        self.M_phs_inv = None
-        self.M_amp_inv = None
+        self.phs_solver = None
+        self.amp_solver = None
         self.seps = {}
         self.pols = {}
         self.ants = {}
@@ -274,8 +411,7 @@ class LogCalMatrix:
             a = self.ants[i]
         return self.npols * a + p
     def add_meas_record(self, bl, pol, sep, conj):
-        amp_line = n.zeros((self.nprms,), dtype=n.double)
-        phs_line = n.zeros((self.nprms,), dtype=n.double)
+        amp_line, phs_line = {}, {}
         i,j = bl2ij(bl)
         if conj: i,j = j,i
         s = self.sep_index(sep)
@@ -285,17 +421,24 @@ class LogCalMatrix:
         phs_line[i], phs_line[j], phs_line[s] = -1, 1, 1
         self.M_phs.append(phs_line)
         self.meas_order.append((bl,pol,sep,conj))
+        self.phs_solver, self.amp_solver = None, None
+    def phs_matrix(self):
+        '''Return the (nmeas,nprms) CSR matrix of the phases each measurement involves.'''
+        return sparse_rows(self.M_phs, self.nprms)
+    def amp_matrix(self):
+        '''Return the (nmeas,nprms) CSR matrix of the amplitudes each measurement involves.'''
+        return sparse_rows(self.M_amp, self.nprms)
     #def invert(self, amp_meas, phs_meas):
     def invert(self, logvis, einstr='pm,mq'):
         '''Return the antenna gain solutions and sky/sep solutions for the provided set of amp/phs measurements.
-        phs_meas needs to have had any necessary conjugation applied already'''
-        # Invert the matrices recording which parameters are involved in each measurement
-        # M_phs is (nmeas,nprm), so M_phs_inv is (nprm,nmeas)
-        if self.M_phs_inv is None: self.M_phs_inv = n.linalg.pinv(n.array(self.M_phs))
-        if self.M_amp_inv is None: self.M_amp_inv = n.linalg.pinv(n.array(self.M_amp))
+        phs_meas needs to have had any necessary conjugation applied already.  Solving is equivalent to
+        n.einsum(einstr, n.linalg.pinv(M), logvis) for the phase and amplitude matrices M, but the
+        factorizations are computed once (until more records are added) and reused for every call.'''
+        if self.phs_solver is None: self.phs_solver = LeastSquaresSolver(self.phs_matrix())
+        if self.amp_solver is None: self.amp_solver = LeastSquaresSolver(self.amp_matrix())
         #logvis = n.log(vis)
-        phs = n.einsum(einstr, self.M_phs_inv, logvis.imag)
-        amp = n.einsum(einstr, self.M_amp_inv, logvis.real)
+        phs = self.phs_solver.einsum(einstr, logvis.imag)
+        amp = self.amp_solver.einsum(einstr, logvis.real)
         g = n.exp(amp + 1j * phs)
         i = self.nants * self.npols
         g_avg = n.sqrt(n.average(n.abs(g[:i])**2, axis=0))
@@ -319,58 +462,47 @@ class RelativeLogCalMatrix(LogCalMatrix):
         self.constraint = []
         self.constraint_val = []
         self.constraint_wgt = []
+        self._wgts = None
     # xXX sep_index shouldn't exist
     def add_meas_record(self, bl1, pol1, conj1, bl2, pol2, conj2):
-        #amp_line = n.zeros((self.nprms,), dtype=n.double)
-        phs_line = n.zeros((self.nprms,), dtype=n.double)
+        phs_line = {}
         i1,j1 = bl2ij(bl1)
         i2,j2 = bl2ij(bl2)
         if conj1: i1,j1 = j1,i1
         if conj2: i2,j2 = j2,i2
         i1,j1 = self.antpol_index(i1,pol1), self.antpol_index(j1,pol1)
         i2,j2 = self.antpol_index(i2,pol2), self.antpol_index(j2,pol2)
-        #amp_line[j2], amp_line[i2], amp_line[j1], amp_line[i1] = 1, 1, -1, -1
-        #self.M_amp.append(amp_line)
         #phs_line[j2], phs_line[i2], phs_line[j1], phs_line[i1] = 1, -1, -1, 1
-        phs_line[j2] += 1; phs_line[i2] += -1; phs_line[j1] += -1; phs_line[i1] += 1
+        for k,v in [(j2,1), (i2,-1), (j1,-1), (i1,1)]: phs_line[k] = phs_line.get(k,0) + v
         self.M_phs.append(phs_line)
         self.meas_order.append((bl1,pol1,conj1,bl2,pol2,conj2))
+        self.phs_solver = None
     def add_constraint(self, ant, pol, val, wgt=1000.):
         '''Additional constraints is a list of (ant,pol,val) constraints that are priced into the fit with the
         provided weight.'''
-        line = n.zeros((self.nprms,), dtype=n.double)
-        line[self.antpol_index(ant,pol)] = wgt
-        self.constraint.append(line)
+        self.constraint.append({self.antpol_index(ant,pol):wgt})
         self.constraint_val.append(val)
         self.constraint_wgt.append(wgt)
+        self.phs_solver = None
     def invert(self, dly, wgts=None, einstr='pm,m'):
         '''Return the antenna gain solutions and sky/sep solutions for the provided set of amp/phs measurements.
-        phs_meas needs to have had any necessary conjugation applied already.'''
-        # Invert the matrices recording which parameters are involved in each measurement
-        # M_phs is (nmeas,nprm), so M_phs_inv is (nprm,nmeas)
-        #if self.M_phs_inv is None:
-        #    self.M_phs_inv = n.linalg.pinv(n.array(self.constraint + self.M_phs))
+        phs_meas needs to have had any necessary conjugation applied already.  The factorization of the
+        weighted matrix is reused by later calls with the same weights.'''
         if wgts is None: wgts = n.ones_like(dly)
         wgts = n.concatenate([self.constraint_wgt, wgts])
-        #wgts.shape = (wgts.size, 1)
-        M = n.array(self.constraint + self.M_phs)
         val = n.concatenate([self.constraint_val, dly])
-        
-        self.M_phs_inv = n.linalg.pinv(M * wgts.reshape((wgts.size,1)))
-        #if self.M_amp_inv is None: self.M_amp_inv = n.linalg.pinv(n.array(self.M_amp))
-        dly = n.einsum(einstr, self.M_phs_inv, val * wgts)
-        #dly = n.linalg.lstsq(n.array([phs_line1, phs_line2, phs_line3] + self.M_phs), dly)[0]
-        #gain = n.einsum(einstr, self.M_amp_inv, gain)
+        if self.phs_solver is None or not n.array_equal(wgts, self._wgts):
+            M = sparse_rows(self.constraint + self.M_phs, self.nprms)
+            self.phs_solver = LeastSquaresSolver(sparse.diags(wgts) * M)
+            self._wgts = wgts
+        dly = self.phs_solver.einsum(einstr, val * wgts)
         dly_sol = {}
-        #gain_sol = {}
         for ant in self.ants:
-            #dly_sol[ant], gain_sol[ant] = {}, {}
             dly_sol[ant] = {}
             for pol in self.pols:
                 i = self.antpol_index(ant,pol)
-                #gain_sol[ant][pol] = gain[i]
                 dly_sol[ant][pol] = dly[i]
-        return dly_sol#, gain_sol
+        return dly_sol
 
 def estimate_xtalk(ant_sol, vis, meas_order):
     dsum,dwgt = {},{}
@@ -0,0 +1,110 @@
+'''
+Redundancy indices of antennas laid out on a grid (as in aa.ant_layout).
+All pairwise grid offsets are computed at once with broadcasting, and
+baselines are grouped by integer separation ids rather than by string keys.
+Groupings are cached per layout, so the many scripts that regroup the same
+layout at start-up only pay for it once.  red.group_redundant_bls,
+zsa.grid2ij and dfm.grid2ij are dict views of these groupings.
+'''
+
+import numpy as n
+import hashlib
+from collections import OrderedDict
+
+# Number of groupings kept by get_groups.
+GROUPS_LRU_SIZE = 16
+_GROUPS_LRU = OrderedDict()
+
+def layout_key(antpos, *args):
+    '''Return a hex digest identifying the grid antpos (and any args).'''
+    antpos = n.asarray(antpos)
+    h = hashlib.md5()
+    h.update(str(antpos.dtype) + repr(antpos.shape) + repr(args))
+    h.update(n.ascontiguousarray(antpos).tostring())
+    return h.hexdigest()
+
+def grid_pairs(antpos, order='C'):
+    '''Return (i, j, drow, dcol) arrays over every ordered pair of grid
+    positions (p,q) (including p == q): i,j are the antennas at p,q and
+    drow,dcol the offset from p to q along the two grid axes.  Pairs are in
+    the order of a loop over p then q, each stepping through the grid in
+    'order' ('C': last axis fastest, 'F': first axis fastest).'''
+    antpos = n.asarray(antpos)
+    rows, cols = n.indices(antpos.shape)
+    rows, cols = rows.flatten(order=order), cols.flatten(order=order)
+    ants = antpos.flatten(order=order)
+    p, q = n.indices((ants.size, ants.size)).reshape(2, -1)
+    return ants[p], ants[q], rows[q] - rows[p], cols[q] - cols[p]
+
+class RedundantGroups:
+    '''Baselines grouped by separation, as integer arrays (one entry per
+    baseline, in the order they were given):
+    i, j: the antennas, swapped so that i <= j.
+    conj: True where i,j were swapped (the baseline must be conjugated to
+        be redundant with the others of its separation).
+    sep_id: the index of the baseline's separation in seps.
+    seps: (nseps, 2) array of (drow, dcol) separations, in the order each
+        first appears among the baselines.'''
+    def __init__(self, i, j, drow, dcol):
+        i, j = n.asarray(i), n.asarray(j)
+        self.conj = i > j
+        self.i = n.where(self.conj, j, i)
+        self.j = n.where(self.conj, i, j)
+        drow, dcol = n.asarray(drow), n.asarray(dcol)
+        if drow.size == 0:
+            self.seps, self.sep_id = n.zeros((0,2), dtype=n.int), n.zeros(0, dtype=n.int)
+        else:
+            span = 2 * n.abs(dcol).max() + 1
+            key = drow * span + dcol
+            ukey, first, inverse = n.unique(key, return_index=True, return_inverse=True)
+            order = n.argsort(first)
+            rank = n.empty_like(order)
+            rank[order] = n.arange(order.size)
+            self.sep_id = rank[inverse]
+            self.seps = n.array([drow[first[order]], dcol[first[order]]]).T
+        for arr in (self.i, self.j, self.conj, self.sep_id, self.seps): arr.flags.writeable = False
+    def members(self):
+        '''Return a list, per separation, of the indices of its baselines
+        (in the order the baselines were given).'''
+        idx = n.argsort(self.sep_id, kind='mergesort')
+        bounds = n.searchsorted(self.sep_id[idx], n.arange(1, len(self.seps)))
+        return n.split(idx, bounds)
+    def sep_strs(self):
+        '''Return the 'drow,dcol' string of each separation.'''
+        return ['%d,%d' % (dr,dc) for dr,dc in self.seps.tolist()]
+
+def get_groups(antpos, order='C', select=None):
+    '''Return the RedundantGroups of the pairs of grid_pairs(antpos, order)
+    that select (a name, see SELECT) keeps, reusing the result of any
+    earlier call with the same layout.'''
+    key = layout_key(antpos, order, select)
+    if _GROUPS_LRU.has_key(key):
+        _GROUPS_LRU[key] = groups = _GROUPS_LRU.pop(key)
+        return groups
+    i, j, drow, dcol = grid_pairs(antpos, order=order)
+    if not select is None:
+        keep = SELECT[select](drow, dcol)
+        i, j, drow, dcol = i[keep], j[keep], drow[keep], dcol[keep]
+    groups = RedundantGroups(i, j, drow, dcol)
+    _GROUPS_LRU[key] = groups
+    while len(_GROUPS_LRU) > GROUPS_LRU_SIZE: _GROUPS_LRU.popitem(last=False)
+    return groups
+
+# Which ordered pairs of grid positions each grouping keeps.
+SELECT = {
+    # one of each pair of positions: increasing column, or same column and increasing row
+    'half': lambda drow, dcol: (dcol > 0) | ((dcol == 0) & (drow > 0)),
+    # non-decreasing column (both directions along a column, and each position with itself)
+    'cols': lambda drow, dcol: dcol >= 0,
+    # both directions of each pair, except within a row (increasing column only)
+    'rows': lambda drow, dcol: (drow != 0) | (dcol > 0),
+}
+
+def group_dict(groups):
+    '''Return a dict of 'drow,dcol':list of (i,j) baselines (i <= j), with
+    the separations inserted in the order they first appear.'''
+    bls = {}
+    i, j = groups.i.tolist(), groups.j.tolist()
+    for sep,idx in zip(groups.sep_strs(), groups.members()):
+        bls[sep] = [(i[k],j[k]) for k in idx]
+    return bls
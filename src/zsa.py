@@ -1,6 +1,7 @@
 import aipy as a, numpy as n, pylab as p
 import sys, scipy
 import capo.omni as omni
+import redindex
 
 
 def redundant_bl_cal(d1, w1, d2, w2, fqs, use_offset=False, maxiter=10, window='blackman-harris',
@@ -80,28 +81,16 @@ def grid2ij(GRID):
         bl_conj = given a baseline (miriad bl) gives separation.
         bl2sep_str = given baseline (miriad) return its separation.    
     '''
-    bls, conj = {}, {}
-    for ri in range(GRID.shape[0]):
-        for ci in range(GRID.shape[1]):
-            for rj in range(GRID.shape[0]):
-                for cj in range(GRID.shape[1]):
-                    if ci > cj: continue
-#                    if ri > rj and ci == cj: continue
-#                    if ci > cj and ri == rj: continue
-                    sep = (rj-ri, cj-ci)
-                    sep = '%d,%d'%sep
-                    i,j = GRID[ri, ci], GRID[rj,cj]
-                    bls[sep] = bls.get(sep,[]) + [(i,j)]
+    groups = redindex.get_groups(GRID, select='cols')
+    bls = redindex.group_dict(groups)
+    conj = dict(zip(groups.sep_strs(), [groups.conj[idx].tolist() for idx in groups.members()]))
     for sep in bls.keys():
         if sep == '0,0' or len(bls[sep]) < 2 or (sep[-1] == '0' and sep[0] == '-'): del(bls[sep])
-    for sep in bls:
-        conj[sep] = [i>j for i,j in bls[sep]]
 
     bl_str,bl_conj,bl2sep_str = {}, {}, {}
     for sep in bls:
         bl_str[sep],bl_list = [], []
         for (i,j),c in zip(bls[sep],conj[sep]):
-            if c: i,j = j,i
             bl_list.append(a.miriad.ij2bl(i,j))
             bl_str[sep].append('%d_%d'%(i,j))
             bl2sep_str[a.miriad.ij2bl(i,j)] = bl2sep_str.get(a.miriad.ij2bl(i,j),'') + sep
@@ -0,0 +1,66 @@
+import unittest
+import aipy as a, numpy as n
+import capo.filecat as filecat
+import os, shutil, tempfile, time
+from miriad_test import mk_test_file
+
+class TestLstOverlap(unittest.TestCase):
+    def test_overlap(self):
+        s = n.array([1., 2., 6., 6.])
+        e = n.array([1.5, 3., 0.5, 6.2])
+        n.testing.assert_array_equal(filecat.lst_overlap(s, e, (1.2, 2.5)), [True, True, False, False])
+        n.testing.assert_array_equal(filecat.lst_overlap(s, e, (0.2, 0.4)), [False, False, True, False])
+        n.testing.assert_array_equal(filecat.lst_overlap(s, e, (6.1, 0.1)), [False, False, True, True])
+        n.testing.assert_array_equal(filecat.lst_overlap(s, e, (3.5, 5.)), [False, False, False, False])
+
+class TestFileCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for cnt in xrange(3):
+            filename = os.path.join(self.tmpdir, 'zen.%d.uv' % cnt)
+            mk_test_file(filename, jd0=2456000.1 + cnt * .25, pols=['xx'])
+            self.files.append(filename)
+        self.cat = filecat.FileCatalog(os.path.join(self.tmpdir, 'cat.db'))
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_scan(self):
+        self.assertEqual(self.cat.update(self.files), 3)
+        t = self.cat.table(self.files[::-1])
+        self.assertEqual(list(t['path']), self.files[::-1])
+        uv = a.miriad.UV(self.files[0])
+        self.assertEqual(t['jd_start'][-1], uv.read()[0][1])
+        self.assertEqual(t['nints'][0], 10)
+        self.assertEqual(t['nchan'][0], 16)
+        self.assertEqual(t['pols'][0], 'xx')
+        self.assertEqual(t['ants'][0], '0,1,2,3')
+        self.assertTrue(n.all(t['jd_end'] > t['jd_start']))
+    def test_incremental(self):
+        self.cat.update(self.files[:2])
+        self.assertEqual(self.cat.update(self.files), 1)
+        self.assertEqual(self.cat.update(self.files), 0)
+        shutil.rmtree(self.files[0])
+        mk_test_file(self.files[0], ntimes=5, jd0=2456000.1, pols=['xx'])
+        self.assertEqual(self.cat.stale(self.files), [self.files[0]])
+        self.cat.update(self.files)
+        self.assertEqual(self.cat.table(self.files[:1])['nints'][0], 5)
+    def test_select(self):
+        self.cat.update(self.files)
+        t = self.cat.table(self.files)
+        lst = t['lst_start'][1]
+        self.assertEqual(self.cat.select(self.files, lst_rng=(lst, lst + .001)), self.files[1:2])
+        self.assertEqual(self.cat.select(self.files, jd_rng=(2456000.3, 2456000.4)), self.files[1:2])
+        self.assertEqual(self.cat.select(self.files, pol='yy'), [])
+        self.assertEqual(sorted(self.cat.select()), sorted(self.files))
+    def test_unreadable(self):
+        bad = os.path.join(self.tmpdir, 'zen.bad.uv')
+        os.mkdir(bad)
+        open(os.path.join(bad, 'visdata'), 'w').close()
+        files = self.files[:1] + [bad] + self.files[1:]
+        self.assertEqual(self.cat.update(files), 3)
+        self.assertEqual(self.cat.missing(files), [bad])
+        self.assertEqual(list(self.cat.table(files)['path']), self.files)
+        self.assertEqual(self.cat.select(files, pol='xx'), self.files)
+
+if __name__ == '__main__':
+    unittest.main()
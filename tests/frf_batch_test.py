@@ -0,0 +1,97 @@
+import unittest
+import aipy as a, numpy as n
+import capo.frf as frf
+import os, shutil, tempfile
+
+def apply_frf_loop(data, wgts, fir):
+    '''Per-channel n.convolve reference, as in fringe.apply_frf.'''
+    _d, _w = n.zeros_like(data), n.zeros(data.shape)
+    for ch in xrange(data.shape[-1]):
+        _d[:,ch] = n.convolve(wgts[:,ch]*data[:,ch], n.conj(fir[ch,:]), mode='same')
+        _w[:,ch] = n.convolve(wgts[:,ch], n.abs(n.conj(fir[ch,:])), mode='same')
+    return _d, _w
+
+class TestApplyFrfBatch(unittest.TestCase):
+    def setUp(self):
+        n.random.seed(0)
+        self.nbl, self.ntime, self.nchan, self.ntaps = 3, 100, 8, 21
+        shape = (self.nbl, self.ntime, self.nchan)
+        self.data = n.random.normal(size=shape) + 1j * n.random.normal(size=shape)
+        self.wgts = (n.random.uniform(size=shape) > .1).astype(n.float64)
+        self.firs = n.random.normal(size=(self.nchan,self.ntaps)) + 1j * n.random.normal(size=(self.nchan,self.ntaps))
+    def check(self, **kwargs):
+        conj = n.array([False, True, False])
+        _d, _w = frf.apply_frf_batch(self.data, self.wgts, self.firs, conj=conj, **kwargs)
+        self.assertEqual(_d.shape, self.data.shape)
+        for b in xrange(self.nbl):
+            fir = n.conj(self.firs) if conj[b] else self.firs
+            d, w = apply_frf_loop(self.data[b], self.wgts[b], fir)
+            n.testing.assert_allclose(_d[b], d, atol=1e-10)
+            n.testing.assert_allclose(_w[b], w, atol=1e-10)
+    def test_one_segment(self):
+        self.check()
+    def test_overlap_add(self):
+        self.check(nfft=32)
+        self.check(nfft=64)
+    def test_even_taps(self):
+        self.firs = self.firs[:,:20]
+        self.check(nfft=32)
+    def test_single_baseline(self):
+        _d, _w = frf.apply_frf_batch(self.data[0].astype(n.complex64), self.wgts[0] > 0, self.firs)
+        d, w = apply_frf_loop(self.data[0], self.wgts[0], self.firs)
+        self.assertEqual(_d.dtype, n.complex64)
+        n.testing.assert_allclose(_d, d, rtol=1e-4, atol=1e-4)
+        n.testing.assert_allclose(_w, w, atol=1e-10)
+    def test_norm(self):
+        _d, _w = frf.apply_frf_batch(self.data, self.wgts, self.firs)
+        _dn, _wn = frf.apply_frf_batch(self.data, self.wgts, self.firs, norm=True)
+        ok = _w > 0
+        n.testing.assert_allclose(_dn[ok], _d[ok] / _w[ok])
+        self.assertTrue(n.all(_dn[n.logical_not(ok)] == 0))
+
+def mk_aa(nants=3, nchan=16, sep=100.):
+    freqs = n.linspace(.1, .2, nchan)
+    ants = [a.fit.Antenna(i*sep, 0, 0, a.fit.Beam(freqs)) for i in xrange(nants)]
+    return a.fit.AntennaArray(('0','0'), ants)
+
+class TestFirCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        frf._FIR_LRU.clear()
+        self.ncalls = 0
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        frf._FIR_LRU.clear()
+    def compute(self):
+        self.ncalls += 1
+        return n.arange(5.), n.ones((16,5), dtype=n.complex128) * self.ncalls
+    def test_key(self):
+        aa = mk_aa()
+        k = frf.fir_key(aa, (0,1), 8, 42.9, pol='xx')
+        self.assertEqual(k, frf.fir_key(aa, (1,2), 8, 42.9, pol='xx')) # same separation
+        self.assertNotEqual(k, frf.fir_key(aa, (0,2), 8, 42.9, pol='xx'))
+        self.assertNotEqual(k, frf.fir_key(aa, (0,1), 8, 42.9, pol='yy'))
+        self.assertNotEqual(k, frf.fir_key(aa, (0,1), 8, 31.6, pol='xx'))
+        self.assertNotEqual(k, frf.fir_key(mk_aa(nchan=32), (0,1), 8, 42.9, pol='xx'))
+        aa.set_params({'0':{'dly':1.}})
+        self.assertNotEqual(k, frf.fir_key(aa, (0,1), 8, 42.9, pol='xx'))
+    def test_lru(self):
+        tb, firs = frf.cached_firs('a', self.compute, cache=False)
+        tb, firs = frf.cached_firs('a', self.compute, cache=False)
+        self.assertEqual(self.ncalls, 1)
+        for cnt in xrange(frf.FIR_LRU_SIZE): frf.cached_firs(str(cnt), self.compute, cache=False)
+        self.assertFalse(frf._FIR_LRU.has_key('a'))
+        self.assertEqual(len(frf._FIR_LRU), frf.FIR_LRU_SIZE)
+    def test_disk(self):
+        cache = os.path.join(self.tmpdir, 'firs')
+        tb, firs = frf.cached_firs('a', self.compute, cache=cache)
+        self.assertTrue(os.path.exists(os.path.join(cache, 'a.npz')))
+        self.assertEqual(os.listdir(cache), ['a.npz'])
+        frf._FIR_LRU.clear()
+        _tb, _firs = frf.cached_firs('a', self.compute, cache=cache)
+        self.assertEqual(self.ncalls, 1)
+        n.testing.assert_array_equal(_tb, tb)
+        n.testing.assert_array_equal(_firs, firs)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+import numpy as n
+import capo.lstbin as lstbin
+import os, shutil, tempfile
+
+class TestLSTBinner(unittest.TestCase):
+    def setUp(self):
+        n.random.seed(0)
+        self.nlst, self.nchan, nrec = 4, 8, 1200
+        self.lidx = n.random.randint(-1, self.nlst + 1, nrec) # some out of range
+        self.blps = n.random.choice([100, 200, 300], nrec)
+        shape = (nrec, self.nchan)
+        self.d = (3 + n.random.normal(size=shape) + 1j * n.random.normal(size=shape)).astype(n.complex64)
+        self.f = n.random.uniform(size=shape) < .1
+        self.w = n.random.randint(1, 4, size=shape).astype(n.float64) * n.logical_not(self.f)
+    def bin(self, binner, blocksize=101):
+        for i in xrange(0, self.lidx.size, blocksize):
+            sl = slice(i, i + blocksize)
+            binner.add(self.lidx[sl], self.blps[sl], self.d[sl], self.w[sl], f=self.f[sl])
+        return binner
+    def reference(self, li, blp):
+        '''The masked-array statistics lstbin_v02.py used to compute.'''
+        sel = n.logical_and(self.lidx == li, self.blps == blp)
+        d = n.ma.array(n.where(self.f[sel], 0, self.d[sel]), mask=self.f[sel])
+        w = self.w[sel]
+        return {'vis': n.ma.sum(w*d, axis=0) / n.sum(w, axis=0), 'cnt': n.sum(w, axis=0),
+            'min': n.ma.min(n.abs(d), axis=0), 'max': n.ma.max(n.abs(d), axis=0),
+            'var': n.ma.var(d, axis=0), 'median': n.ma.median(n.abs(d), axis=0),
+            'std': n.ma.std(n.abs(d), axis=0)}
+    def test_stats(self):
+        b = self.bin(lstbin.LSTBinner(self.nlst, self.nchan, median=True))
+        self.assertEqual(sorted(b.blps.keys()), [100, 200, 300])
+        stats = b.stats()
+        err = []
+        for li in xrange(self.nlst):
+            for blp,bi in b.blps.items():
+                ref = self.reference(li, blp)
+                for k in ['vis', 'cnt', 'min', 'max', 'var']:
+                    n.testing.assert_allclose(stats[k][li,bi], ref[k], rtol=1e-5)
+                for k in ['min', 'max']: # copies of input amplitudes
+                    n.testing.assert_array_equal(stats[k][li,bi], ref[k])
+                err.append((stats['median'][li,bi] - ref['median']) / ref['std'])
+        # The median is approximate: within a fraction of the spread of the data
+        err = n.array(err)
+        self.assertTrue(n.sqrt(n.mean(err**2)) < .25)
+        self.assertTrue(n.all(n.abs(err) < 1))
+    def test_blocksize(self):
+        s1 = self.bin(lstbin.LSTBinner(self.nlst, self.nchan)).stats()
+        s2 = self.bin(lstbin.LSTBinner(self.nlst, self.nchan), blocksize=7).stats()
+        for k in s1: n.testing.assert_allclose(s1[k], s2[k], rtol=1e-6, atol=1e-8)
+    def test_empty_bin(self):
+        b = lstbin.LSTBinner(self.nlst, self.nchan)
+        b.add([0], [100], n.ones((1,self.nchan)), n.ones((1,self.nchan)))
+        b.add([1], [200], n.ones((1,self.nchan)), n.ones((1,self.nchan)))
+        stats = b.stats()
+        self.assertEqual(stats['vis'].shape, (self.nlst, 2, self.nchan))
+        self.assertTrue(n.all(stats['flg'][0,b.blps[200]]))
+        self.assertTrue(n.all(stats['cnt'][0,b.blps[200]] == 0))
+        self.assertTrue(n.all(stats['min'][0,b.blps[200]] == 0))
+    def test_clip(self):
+        self.d[::50] *= 100 # outliers
+        self.f[::50] = False
+        ref = self.bin(lstbin.LSTBinner(self.nlst, self.nchan, center=True))
+        b = self.bin(lstbin.LSTBinner(self.nlst, self.nchan, clip=ref, nsig=5.))
+        stats = b.stats()
+        self.assertTrue(n.all(stats['max'] < 20))
+        self.assertTrue(n.all(n.abs(stats['vis'][stats['cnt'] > 0] - 3) < 1))
+
+class TestState(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        n.random.seed(1)
+        self.nlst, self.nchan = 3, 4
+        self.nights = []
+        for night in xrange(3):
+            nrec = 200
+            lidx = n.random.randint(0, self.nlst, nrec)
+            blps = n.random.choice([1, 2, 3 + night], nrec) # a blp new to each night
+            d = n.random.normal(size=(nrec,self.nchan)) + 1j * n.random.normal(size=(nrec,self.nchan))
+            self.nights.append((lidx, blps, d, n.ones((nrec,self.nchan))))
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_incremental(self):
+        b = lstbin.LSTBinner(self.nlst, self.nchan, median=True)
+        for night in self.nights: b.add(*night)
+        filename = os.path.join(self.tmpdir, 'state.npz')
+        _b = lstbin.LSTBinner(self.nlst, self.nchan, median=True)
+        for cnt,night in enumerate(self.nights):
+            if cnt > 0:
+                binners, extra = lstbin.load_state(filename)
+                _b = binners['data']
+                self.assertEqual(list(extra['files']), ['night%d' % i for i in xrange(cnt)])
+            _b.add(*night)
+            lstbin.save_state(filename, {'data':_b}, files=['night%d' % i for i in xrange(cnt+1)])
+            self.assertEqual(os.listdir(self.tmpdir), ['state.npz'])
+        binners, extra = lstbin.load_state(filename)
+        _b = binners['data']
+        self.assertEqual(_b.blps, b.blps)
+        stats, _stats = b.stats(), _b.stats()
+        for k in stats: n.testing.assert_allclose(_stats[k], stats[k], rtol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+'''Benchmark capo.miriad.read_files against the list-append reader it
+replaced, and the parallel reader (nproc>1) against the serial one.  Each
+reader runs in a fresh child process so that the reported peak RSS belongs
+to that reader alone (worker processes are not included).'''
+import aipy as a, numpy as n
+import capo.miriad as m
+import multiprocessing as mpr
+import os, sys, time, shutil, tempfile, resource, optparse
+from miriad_test import mk_test_file, read_files_lists
+
+o = optparse.OptionParser()
+o.add_option('--nfiles', type='int', default=4, help='Number of synthetic files.')
+o.add_option('--nants', type='int', default=32, help='Number of antennas per file.')
+o.add_option('--nchan', type='int', default=203, help='Number of channels.')
+o.add_option('--ntimes', type='int', default=56, help='Integrations per file.')
+o.add_option('--nproc', default='1,4,16', help='Comma-separated numbers of worker processes to compare.')
+opts, args = o.parse_args(sys.argv[1:])
+
+def run(reader, files, q):
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    info, dat, flg = reader(files, 'all', 'xx,yy')
+    dt = time.time() - t0
+    nrec = sum([dat[bl][pol].shape[0] for bl in dat for pol in dat[bl]])
+    nbytes = sum([dat[bl][pol].nbytes + flg[bl][pol].nbytes for bl in dat for pol in dat[bl]])
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    q.put((nrec / dt, (rss1 - rss0) / 1024., nbytes / 1024.**2))
+
+def bench(name, reader, files):
+    q = mpr.Queue()
+    p = mpr.Process(target=run, args=(reader, files, q))
+    p.start()
+    rate, peak, final = q.get()
+    p.join()
+    print '%-12s %10.0f rec/s   peak %8.1f MB   final arrays %8.1f MB' % (name, rate, peak, final)
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = []
+        for cnt in xrange(opts.nfiles):
+            filename = os.path.join(tmpdir, 'zen.%d.uv' % cnt)
+            mk_test_file(filename, nants=opts.nants, nchan=opts.nchan, ntimes=opts.ntimes,
+                jd0=2456000.5 + cnt * opts.ntimes * 10. / a.const.s_per_day)
+            files.append(filename)
+        bench('lists', read_files_lists, files)
+        bench('read_files', m.read_files, files)
+        for nproc in map(int, opts.nproc.split(',')):
+            reader = lambda files, antstr, polstr: m.read_files(files, antstr, polstr, nproc=nproc)
+            bench('nproc=%d' % nproc, reader, files)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,224 @@
+import unittest
+import aipy as a, numpy as n
+import capo.miriad as m
+import os, shutil, tempfile
+
+def mk_test_file(filename, nants=4, nchan=16, ntimes=10, pols=['xx','yy'], jd0=2456000.5, inttime=10.):
+    '''Write a small synthetic Miriad file holding every baseline (autos
+    included) for each pol at ntimes integrations.  Data are set so that
+    each record can be identified: real part = time index, imag = ant i.'''
+    uv = a.miriad.UV(filename, status='new')
+    uv._wrhd('obstype', 'mixed-auto-cross')
+    uv._wrhd('history', 'mk_test_file\n')
+    uv.add_var('telescop', 'a'); uv['telescop'] = 'AIPY'
+    uv.add_var('nchan', 'i'); uv['nchan'] = nchan
+    uv.add_var('sfreq', 'd'); uv['sfreq'] = .1
+    uv.add_var('sdf', 'd'); uv['sdf'] = .1 / nchan
+    uv.add_var('nants', 'i'); uv['nants'] = nants
+    uv.add_var('npol', 'i'); uv['npol'] = len(pols)
+    uv.add_var('inttime', 'r'); uv['inttime'] = inttime
+    uv.add_var('pol', 'i')
+    uv.add_var('lst', 'd')
+    uv.add_var('ra', 'd')
+    uv.add_var('obsra', 'd')
+    crd = n.zeros(3, dtype=n.double)
+    for ti in xrange(ntimes):
+        t = jd0 + ti * inttime / a.const.s_per_day
+        uv['lst'] = uv['ra'] = uv['obsra'] = 2 * n.pi * (t % 1)
+        for pol in pols:
+            uv['pol'] = a.miriad.str2pol[pol]
+            for i in xrange(nants):
+                for j in xrange(i, nants):
+                    d = n.ones(nchan, dtype=n.complex64) * (ti + 1j * i)
+                    f = n.zeros(nchan, dtype=n.int32)
+                    f[ti % nchan] = 1
+                    uv.write((crd, t, (i,j)), d, f)
+    del(uv)
+
+def read_files_lists(filenames, antstr, polstr):
+    '''The list-append reader that read_files replaced, kept for comparison.'''
+    info = {'lsts':[], 'times':[]}
+    ts = {}
+    dat, flg = {}, {}
+    for filename in filenames:
+        uv = a.miriad.UV(filename)
+        a.scripting.uv_selector(uv, antstr, polstr)
+        for (crd,t,(i,j)),d,f in uv.all(raw=True):
+            if not ts.has_key(t):
+                info['times'].append(t)
+                info['lsts'].append(uv['lst'])
+                ts[t] = None
+            bl = (i,j)
+            if not dat.has_key(bl): dat[bl],flg[bl] = {},{}
+            pol = a.miriad.pol2str[uv['pol']]
+            if not dat[bl].has_key(pol):
+                dat[bl][pol],flg[bl][pol] = [],[]
+            dat[bl][pol].append(d)
+            flg[bl][pol].append(f)
+    for bl in dat.keys():
+        for pol in dat[bl].keys():
+            dat[bl][pol] = n.array(dat[bl][pol])
+            flg[bl][pol] = n.array(flg[bl][pol])
+    info['lsts'] = n.array(info['lsts'])
+    info['times'] = n.array(info['times'])
+    return info, dat, flg
+
+class TestReadFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for cnt in xrange(3):
+            filename = os.path.join(self.tmpdir, 'zen.%d.uv' % cnt)
+            mk_test_file(filename, jd0=2456000.5 + cnt * .01)
+            self.files.append(filename)
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_est_ntimes(self):
+        uv = a.miriad.UV(self.files[0])
+        ntimes = m.est_ntimes(uv, self.files[0])
+        self.assertTrue(ntimes > 0)
+        self.assertTrue(ntimes < 20)
+    def test_uvblock_grows(self):
+        b = m.UVBlock(1, 4)
+        for i in xrange(5): b.append(n.ones(4) * i, n.zeros(4))
+        d,f = b.trim()
+        self.assertEqual(d.shape, (5,4))
+        self.assertEqual(f.dtype, n.bool)
+        n.testing.assert_array_equal(d[:,0], n.arange(5))
+    def test_matches_lists(self):
+        info, dat, flg = m.read_files(self.files, 'cross', 'xx,yy')
+        info0, dat0, flg0 = read_files_lists(self.files, 'cross', 'xx,yy')
+        n.testing.assert_array_equal(info['times'], info0['times'])
+        n.testing.assert_array_equal(info['lsts'], info0['lsts'])
+        self.assertEqual(sorted(dat.keys()), sorted(dat0.keys()))
+        for bl in dat0:
+            for pol in dat0[bl]:
+                self.assertEqual(dat[bl][pol].dtype, n.complex64)
+                self.assertEqual(flg[bl][pol].dtype, n.bool)
+                n.testing.assert_array_equal(dat[bl][pol], dat0[bl][pol])
+                n.testing.assert_array_equal(flg[bl][pol], flg0[bl][pol].astype(n.bool))
+    def test_parallel(self):
+        info0, dat0, flg0 = m.read_files(self.files, 'cross', 'xx,yy')
+        info, dat, flg = m.read_files(self.files, 'cross', 'xx,yy', nproc=2)
+        n.testing.assert_array_equal(info['times'], info0['times'])
+        n.testing.assert_array_equal(info['lsts'], info0['lsts'])
+        self.assertEqual(sorted(dat.keys()), sorted(dat0.keys()))
+        for bl in dat0:
+            for pol in dat0[bl]:
+                self.assertFalse(isinstance(dat[bl][pol], n.memmap))
+                n.testing.assert_array_equal(dat[bl][pol], dat0[bl][pol])
+                n.testing.assert_array_equal(flg[bl][pol], flg0[bl][pol])
+    def test_parallel_empty_selection(self):
+        info, dat, flg = m.read_files(self.files, '0_1', 'xy', nproc=2)
+        self.assertEqual(dat, {})
+    def test_single_filename(self):
+        info, dat, flg = m.read_files(self.files[0], '0_1', 'xx')
+        self.assertEqual(dat.keys(), [(0,1)])
+        self.assertEqual(dat[(0,1)]['xx'].shape, (10,16))
+
+class TestPipeArrays(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'zen.uv')
+        mk_test_file(self.filename)
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_roundtrip(self):
+        info, dat, flg = m.read_files(self.filename, '0_1,1_2', 'xx')
+        order = n.argsort(info['times'])[::-1] # rows need not be in file order
+        times = info['times'][order]
+        for bl in dat: dat[bl]['xx'] = 2 * dat[bl]['xx'][order]
+        uvi = a.miriad.UV(self.filename)
+        outfile = self.filename + 'L'
+        uvo = a.miriad.UV(outfile, status='new')
+        uvo.init_from_uv(uvi)
+        m.pipe_arrays(uvi, uvo, times, dat)
+        del(uvo)
+        _info, _dat, _flg = m.read_files(outfile, 'all', -1)
+        self.assertEqual(sorted(_dat.keys()), [(0,1),(1,2)])
+        self.assertEqual(_dat[(0,1)].keys(), ['xx'])
+        for bl in _dat:
+            n.testing.assert_array_equal(_dat[bl]['xx'], dat[bl]['xx'][order])
+            n.testing.assert_array_equal(_flg[bl]['xx'], flg[bl]['xx'])
+
+class TestReadChunks(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        for cnt in xrange(3):
+            filename = os.path.join(self.tmpdir, 'zen.%d.uv' % cnt)
+            mk_test_file(filename, jd0=2456000.5 + cnt * .01)
+            self.files.append(filename)
+        self.info, self.dat, self.flg = m.read_files(self.files, 'cross', 'xx,yy')
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def check_chunks(self, chunk, pad):
+        times, dat = [], {}
+        for info, d, f in m.read_chunks(self.files, 'cross', 'xx,yy', chunk=chunk, pad=pad):
+            self.assertTrue(len(info['times']) <= chunk + 2*pad)
+            core = info['core']
+            self.assertTrue(core.stop - core.start <= chunk)
+            times.append(info['times'][core])
+            for bl in d:
+                for pol in d[bl]:
+                    self.assertEqual(d[bl][pol].shape[0], len(info['times']))
+                    dat[(bl,pol)] = dat.get((bl,pol),[]) + [d[bl][pol][core]]
+        n.testing.assert_array_equal(n.concatenate(times), self.info['times'])
+        for (bl,pol),d in dat.iteritems():
+            n.testing.assert_array_equal(n.concatenate(d), self.dat[bl][pol])
+    def test_no_pad(self):
+        self.check_chunks(7, 0)
+    def test_pad(self):
+        self.check_chunks(7, 3)
+        self.check_chunks(4, 4)
+    def test_pad_contents(self):
+        for info, d, f in m.read_chunks(self.files, '0_1', 'xx', chunk=10, pad=2):
+            i0 = n.searchsorted(self.info['times'], info['times'][0])
+            n.testing.assert_array_equal(d[(0,1)]['xx'], self.dat[(0,1)]['xx'][i0:i0+len(info['times'])])
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmpdir, 'cache')
+        self.files = []
+        for cnt in xrange(2):
+            filename = os.path.join(self.tmpdir, 'zen.%d.uv' % cnt)
+            mk_test_file(filename, jd0=2456000.5 + cnt * .01)
+            self.files.append(filename)
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def check_same(self, antstr, polstr, **kwargs):
+        info, dat, flg = m.read_files(self.files, antstr, polstr, cache=False, **kwargs)
+        _info, _dat, _flg = m.read_files(self.files, antstr, polstr, cache=self.cache, **kwargs)
+        n.testing.assert_array_equal(info['times'], _info['times'])
+        n.testing.assert_array_equal(info['lsts'], _info['lsts'])
+        n.testing.assert_array_equal(info['freqs'], _info['freqs'])
+        self.assertEqual(sorted(dat.keys()), sorted(_dat.keys()))
+        for bl in dat:
+            self.assertEqual(sorted(dat[bl].keys()), sorted(_dat[bl].keys()))
+            for pol in dat[bl]:
+                n.testing.assert_array_equal(dat[bl][pol], _dat[bl][pol])
+                n.testing.assert_array_equal(flg[bl][pol], _flg[bl][pol])
+    def test_selections(self):
+        self.check_same('cross', 'xx')
+        self.check_same('auto', 'xx,yy')
+        self.check_same('0_1,2_3', 'yy')
+        self.check_same('1', 'xx')
+        self.check_same('cross,-0_1', 'xx')
+        self.check_same('all', 'xx', decimate=3, decphs=1)
+    def test_entry_reused(self):
+        m.read_files(self.files, 'cross', 'xx', cache=self.cache)
+        path = m.cache_path(self.files[0], self.cache)
+        mtime = os.path.getmtime(os.path.join(path, 'meta.npz'))
+        info, dat, flg = m.read_files(self.files[:1], '0_1', 'xx', cache=self.cache)
+        self.assertEqual(mtime, os.path.getmtime(os.path.join(path, 'meta.npz')))
+        self.assertTrue(isinstance(dat[(0,1)]['xx'], n.memmap))
+    def test_stale_entry(self):
+        m.read_files(self.files[:1], 'cross', 'xx', cache=self.cache)
+        shutil.rmtree(self.files[0])
+        mk_test_file(self.files[0], ntimes=5)
+        info, dat, flg = m.read_files(self.files[:1], 'cross', 'xx', cache=self.cache)
+        self.assertEqual(dat[(0,1)]['xx'].shape, (5,16))
+
+if __name__ == '__main__':
+    unittest.main()
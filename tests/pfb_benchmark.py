@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+'''Benchmark capo.pfb against the implementations it replaced: pfb
+alternating between two configurations (which recomputed the window and
+sinc on every call when they were kept in one global), and streaming_pfb
+against the tap matrix built with n.concatenate.'''
+import capo.pfb as P
+import numpy as n
+import optparse, sys, time
+from pfb_test import streaming_pfb_concat
+
+o = optparse.OptionParser()
+o.add_option('--nchan', type='int', default=1024, help='Number of channels.')
+o.add_option('--taps', type='int', default=8, help='Number of taps.')
+o.add_option('--nbls', type='int', default=32, help='Number of baselines (streams).')
+o.add_option('--nspec', type='int', default=256, help='Number of spectra per stream.')
+o.add_option('--niter', type='int', default=20, help='Number of calls timed.')
+opts, args = o.parse_args(sys.argv[1:])
+
+def bench(name, func, niter=opts.niter):
+    t0 = time.time()
+    for i in xrange(niter): func(i)
+    print '%-28s %10.3f ms/call' % (name, 1e3 * (time.time() - t0) / niter)
+
+if __name__ == '__main__':
+    L = opts.nchan * opts.taps
+    data = n.random.normal(size=(opts.nbls,L)).astype(n.complex64)
+    configs = [('hamming', opts.taps), ('kaiser3', opts.taps)]
+    def alternate(i):
+        window, taps = configs[i % 2]
+        P.pfb(data, window=window, taps=taps)
+    def alternate_uncached(i):
+        P._PFB_LRU.clear()
+        alternate(i)
+    bench('pfb, uncached coeffs', alternate_uncached)
+    bench('pfb, cached coeffs', alternate)
+    bench('pfb, rfft of real data', lambda i: P.pfb(data.real, taps=opts.taps, fft=n.fft.rfft))
+    stream = n.random.normal(size=(opts.nbls, (opts.nspec + opts.taps - 1) * opts.nchan)).astype(n.complex64)
+    bench('streaming_pfb, concatenate', lambda i: [streaming_pfb_concat(s, opts.nchan, taps=opts.taps) for s in stream], niter=2)
+    bench('streaming_pfb, per stream', lambda i: [P.streaming_pfb(s, opts.nchan, taps=opts.taps) for s in stream], niter=2)
+    bench('streaming_pfb, batched', lambda i: P.streaming_pfb(stream, opts.nchan, taps=opts.taps), niter=2)
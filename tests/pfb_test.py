@@ -1,3 +1,4 @@
+import unittest
 import capo.pfb as P
 import numpy as n
 
@@ -26,5 +27,55 @@ def plot_pfb_windows(L=4096, taps=4, fwidth=1):
     pylab.grid()
     pylab.show()
 
+def streaming_pfb_concat(data, nfreq, window='hamming', taps=8, fwidth=1, fft=n.fft.fft):
+    '''The tap matrix built with n.concatenate that streaming_pfb replaced,
+    kept for comparison.'''
+    d = n.resize(data, (len(data)/nfreq, nfreq))
+    for t in range(taps-1):
+        d = n.concatenate([d[:-1], d[1:,t*nfreq:(t+1)*nfreq]], axis=1)
+    return P.pfb(d, window=window, taps=taps, fwidth=fwidth, fft=fft)
+
+class TestPFB(unittest.TestCase):
+    def setUp(self):
+        self.data = n.random.normal(size=(3,4096)) + 1j*n.random.normal(size=(3,4096))
+    def test_coeffs_cached(self):
+        c1 = P.get_coeffs(256, 'hamming', 4, 1)
+        c2 = P.get_coeffs(512, 'kaiser3', 8, 1)
+        self.assertTrue(P.get_coeffs(256, 'hamming', 4, 1) is c1)
+        self.assertTrue(P.get_coeffs(512, 'kaiser3', 8, 1) is c2)
+        self.assertFalse(P.get_coeffs(256, 'hamming', 4, 2) is c1)
+        self.assertEqual(P.get_coeffs(256, 'hamming', 4, 1, dtype=n.float32).dtype, n.float32)
+        self.assertRaises(ValueError, c1.__setitem__, 0, 0)
+        P.__set_pm__(256, 'hamming', 4, 1)
+        self.assertTrue(P.pm['window_sinx_x'] is c1)
+        n.testing.assert_allclose(c1, P.pm['window'] * P.pm['sinx_x'])
+        w = n.hanning(256)
+        n.testing.assert_allclose(P.get_coeffs(256, w, 4, 1), w * P.get_sinx_x(256, 4, 1))
+    def test_pfb(self):
+        for w in P.WINDOWS:
+            sp = P.pfb(self.data, window=w, taps=4)
+            self.assertEqual(sp.shape, (3,1024))
+            n.testing.assert_allclose(sp[1], P.pfb(self.data[1], window=w, taps=4))
+        self.assertRaises(ValueError, P.pfb, self.data[:,:4095], taps=4)
+    def test_rfft(self):
+        sp = P.pfb(self.data.real, taps=4, fft=n.fft.rfft)
+        n.testing.assert_allclose(sp, P.pfb(self.data.real, taps=4)[...,:513])
+    def test_streaming_pfb(self):
+        for taps in [1,2,4]:
+            sp = P.streaming_pfb(self.data[0], 64, taps=taps)
+            n.testing.assert_allclose(sp, streaming_pfb_concat(self.data[0], 64, taps=taps))
+            self.assertEqual(sp.shape, (4096/64-taps+1, 64))
+        # one stream per baseline
+        sp = P.streaming_pfb(self.data[:,:4000], 64, window='kaiser3', taps=4)
+        for i in xrange(3):
+            n.testing.assert_allclose(sp[i], streaming_pfb_concat(self.data[i,:4000], 64, window='kaiser3', taps=4))
+        sp = P.streaming_pfb(self.data.real, 64, taps=4, fft=n.fft.rfft)
+        n.testing.assert_allclose(sp, P.streaming_pfb(self.data.real, 64, taps=4)[...,:33])
+        self.assertRaises(ValueError, P.streaming_pfb, self.data[0,:200], 64, taps=4)
+    def test_streaming_fft(self):
+        sp = P.streaming_fft(self.data[:,:4000], 64)
+        self.assertEqual(sp.shape, (3,62,64))
+        n.testing.assert_allclose(sp[2,5], n.fft.fft(self.data[2,320:384]))
+
 if __name__ == '__main__':
     plot_pfb_windows()        
@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+'''Benchmark capo.red.LogCalMatrix.invert, which factors the sparse normal
+matrix once and solves every time and channel in one batched call, against
+the dense n.linalg.pinv it replaced, for hex arrays from hex-3 (19
+antennas) to hex-11 (331 antennas).'''
+import capo.red as red
+import numpy as n
+import optparse, sys, time
+from red_test import mk_logcal
+
+o = optparse.OptionParser()
+o.add_option('--hexnums', default='3,5,7,9,11', help='Comma-separated hex sizes.')
+o.add_option('--npols', type='int', default=1, help='Number of pols.')
+o.add_option('--ntimes', type='int', default=10, help='Number of integrations.')
+o.add_option('--nchan', type='int', default=203, help='Number of channels.')
+o.add_option('--max_dense', type='int', default=5, help='Largest hex size to run the dense pinv on.')
+opts, args = o.parse_args(sys.argv[1:])
+
+def dense_invert(LCM, logvis, einstr='im,mtz'):
+    '''The dense pseudoinverse that invert replaced, kept for comparison.'''
+    M_phs_inv = n.linalg.pinv(LCM.phs_matrix().toarray())
+    M_amp_inv = n.linalg.pinv(LCM.amp_matrix().toarray())
+    return n.einsum(einstr, M_phs_inv, logvis.imag), n.einsum(einstr, M_amp_inv, logvis.real)
+
+if __name__ == '__main__':
+    print '%4s %5s %7s %6s %12s %12s %12s' % ('hex', 'nants', 'nmeas', 'nprms', 'dense (s)', 'factor (s)', 'solve (s)')
+    for hexnum in map(int, opts.hexnums.split(',')):
+        LCM, logvis = mk_logcal(hexnum, pols=['xx','yy','xy','yx'][:opts.npols], ntimes=opts.ntimes, nchan=opts.nchan)
+        if hexnum <= opts.max_dense:
+            t0 = time.time()
+            dense_invert(LCM, logvis)
+            dense = '%12.3f' % (time.time() - t0)
+        else: dense = '%12s' % '-'
+        t0 = time.time()
+        LCM.invert(logvis, einstr='im,mtz') # factors, then solves
+        t1 = time.time()
+        LCM.invert(logvis, einstr='im,mtz') # reuses the factorization
+        t2 = time.time()
+        print '%4d %5d %7d %6d %s %12.3f %12.3f' % (hexnum, LCM.nants, len(LCM.meas_order), LCM.nprms,
+            dense, (t1 - t0) - (t2 - t1), t2 - t1)
@@ -0,0 +1,26 @@
+#! /usr/bin/env python
+'''Benchmark capo.red.redundant_bl_cal_batch, which runs the FFT and
+peak-finding of every iteration across a stack of baseline pairs and splits
+the pairs among worker processes, against calling redundant_bl_cal on one
+pair at a time.'''
+import capo.red as red
+import numpy as n
+import optparse, sys, time
+from red_test import mk_pairs
+
+o = optparse.OptionParser()
+o.add_option('--npairs', type='int', default=1000, help='Number of baseline pairs.')
+o.add_option('--ntimes', type='int', default=10, help='Number of integrations.')
+o.add_option('--nchan', type='int', default=1024, help='Number of channels.')
+o.add_option('--nprocs', default='1,2,4,8', help='Comma-separated numbers of processes.')
+opts, args = o.parse_args(sys.argv[1:])
+
+if __name__ == '__main__':
+    d1, w1, d2, w2, fqs = mk_pairs(opts.npairs, ntimes=opts.ntimes, nchan=opts.nchan)
+    t0 = time.time()
+    taus = [red.redundant_bl_cal(d1[k], w1[k], d2[k], w2[k], fqs)[1] for k in xrange(opts.npairs)]
+    print '%-10s %10.3f s' % ('per pair', time.time() - t0)
+    for nproc in map(int, opts.nprocs.split(',')):
+        t0 = time.time()
+        gain, tau, info = red.redundant_bl_cal_batch(d1, w1, d2, w2, fqs, nproc=nproc)
+        print '%-10s %10.3f s   max |dtau| %.2e' % ('nproc=%d' % nproc, time.time() - t0, n.abs(tau - taus).max())
@@ -0,0 +1,203 @@
+import unittest
+import capo.red as red, capo.redindex as redindex
+import numpy as n
+from aipy.miriad import ij2bl
+
+def hex_layout(hexnum):
+    '''Return the (q,r) axial coordinates of the antennas of a hex array.'''
+    return [(q,r) for q in range(-hexnum+1,hexnum) for r in range(-hexnum+1,hexnum) if abs(q+r) < hexnum]
+
+def hex_seps(hexnum):
+    '''Return a dict of separation:list of (i,j) baselines for a hex array.'''
+    pos = hex_layout(hexnum)
+    seps = {}
+    for i in xrange(len(pos)):
+        for j in xrange(i+1,len(pos)):
+            seps.setdefault((pos[j][0]-pos[i][0],pos[j][1]-pos[i][1]),[]).append((i,j))
+    return seps
+
+def mk_logcal(hexnum, pols=['xx'], ntimes=3, nchan=4):
+    '''Return a LogCalMatrix of a hex array, and the simulated log visibilities of random gains and skies,
+    (nmeas,ntimes,nchan).'''
+    seps = hex_seps(hexnum)
+    nants = len(hex_layout(hexnum))
+    LCM = red.LogCalMatrix(nants, len(pols), len(seps))
+    for pol in pols:
+        for sep in seps:
+            for i,j in seps[sep]: LCM.add_meas_record(ij2bl(i,j), pol, sep, False)
+    amp = n.random.normal(size=(LCM.nprms,ntimes*nchan))
+    phs = n.random.uniform(-.3,.3,size=(LCM.nprms,ntimes*nchan))
+    logvis = LCM.amp_matrix().dot(amp) + 1j*LCM.phs_matrix().dot(phs)
+    return LCM, logvis.reshape((-1,ntimes,nchan))
+
+class TestLogCalMatrix(unittest.TestCase):
+    def test_sparse(self):
+        LCM, logvis = mk_logcal(2, pols=['xx','yy'])
+        M = LCM.phs_matrix()
+        self.assertEqual(M.shape, (2*21, LCM.nprms))
+        self.assertEqual(M.nnz, 3*M.shape[0])
+        self.assertEqual(list(n.asarray(M.sum(axis=1)).flatten()), [1]*M.shape[0])
+    def test_solver(self):
+        M = n.random.randint(-1,2,size=(30,8)).astype(n.double)
+        M[:,-1] = M[:,0] # degenerate, as redundant calibration is
+        y = n.random.normal(size=(30,5,2))
+        S = red.LeastSquaresSolver(M)
+        n.testing.assert_allclose(S.solve(y), n.einsum('pm,mtf->ptf', n.linalg.pinv(M), y), atol=1e-10)
+        n.testing.assert_allclose(S.einsum('pm,tmf', y.transpose(1,0,2)), n.einsum('pm,mtf', n.linalg.pinv(M), y), atol=1e-10)
+        n.testing.assert_allclose(S.einsum('pm,mq->qp', y[:,:,0]), n.einsum('pm,mq->qp', n.linalg.pinv(M), y[:,:,0]), atol=1e-10)
+    def test_invert(self):
+        LCM, logvis = mk_logcal(3)
+        ant_sol, sep_sol = LCM.invert(logvis, einstr='im,mtz')
+        self.assertEqual(ant_sol[0]['xx'].shape, (3,4))
+        # matches the dense pseudoinverse
+        for M,d in [(LCM.phs_matrix(), logvis.imag), (LCM.amp_matrix(), logvis.real)]:
+            n.testing.assert_allclose(red.LeastSquaresSolver(M).solve(d),
+                n.einsum('pm,mtf->ptf', n.linalg.pinv(M.toarray()), d), atol=1e-8)
+        # the calibrated visibilities reproduce the measurements
+        for (bl,pol,sep,cnj),lv in zip(LCM.meas_order, logvis):
+            i,j = red.bl2ij(bl)
+            v = n.conj(ant_sol[i][pol]) * ant_sol[j][pol] * sep_sol[sep]
+            n.testing.assert_allclose(v, n.exp(lv), rtol=1e-6)
+        solver = LCM.phs_solver
+        LCM.invert(logvis[...,0], einstr='im,mt')
+        self.assertTrue(LCM.phs_solver is solver)
+    def test_relative(self):
+        RLCM = red.RelativeLogCalMatrix(7, 1)
+        seps = hex_seps(2)
+        for sep in seps:
+            for bl2 in seps[sep][1:]:
+                RLCM.add_meas_record(ij2bl(*seps[sep][0]), 'xx', False, ij2bl(*bl2), 'xx', False)
+        dlys = n.random.normal(size=7)
+        dly = n.array([dlys[j2]-dlys[i2]-dlys[j1]+dlys[i1] for (bl1,p1,c1,bl2,p2,c2) in RLCM.meas_order
+            for (i1,j1),(i2,j2) in [(red.bl2ij(bl1),red.bl2ij(bl2))]])
+        for ant in [0,1,3]: RLCM.add_constraint(ant, 'xx', 1000.*dlys[ant])
+        sol = RLCM.invert(dly)
+        for ant in xrange(7): self.assertAlmostEqual(sol[ant]['xx'], dlys[ant], 6)
+        # matches the dense pseudoinverse of the weighted matrix
+        wgts = n.random.uniform(.5,1,size=dly.size)
+        dly += n.random.normal(scale=.1,size=dly.size)
+        sol = RLCM.invert(dly, wgts=wgts)
+        w = n.concatenate([RLCM.constraint_wgt, wgts])
+        M = red.sparse_rows(RLCM.constraint + RLCM.M_phs, RLCM.nprms).toarray()
+        val = n.concatenate([RLCM.constraint_val, dly])
+        solver = RLCM.phs_solver
+        sol0 = n.dot(n.linalg.pinv(M * w.reshape((w.size,1))), val * w)
+        for ant in xrange(7): self.assertAlmostEqual(sol[ant]['xx'], sol0[RLCM.antpol_index(ant,'xx')], 6)
+        RLCM.invert(dly, wgts=wgts)
+        self.assertTrue(RLCM.phs_solver is solver)
+
+def group_redundant_bls_loops(antpos):
+    '''The four-deep loop that red.group_redundant_bls replaced, kept for comparison.'''
+    bls,conj = {}, {}
+    for ri in xrange(antpos.shape[0]):
+        for ci in xrange(antpos.shape[1]):
+            for rj in xrange(antpos.shape[0]):
+                for cj in xrange(ci,antpos.shape[1]):
+                    if ri >= rj and ci == cj: continue # exclude repeat +/- listings of certain bls
+                    sep = '%d,%d' % (rj-ri, cj-ci)
+                    i,j = antpos[ri,ci], antpos[rj,cj]
+                    if i > j: i,j,c = j,i,True
+                    else: c = False
+                    bl = (i,j)
+                    bls[sep] = bls.get(sep,[]) + [bl]
+                    conj[bl] = c
+    return bls, conj
+
+def grid2ij_loops(GRID):
+    '''The loop that dfm.grid2ij replaced, up to the grouping, kept for comparison.'''
+    bls = {}
+    for row_i in range(GRID.shape[1]):
+        for col_i in range(GRID.shape[0]):
+            for row_j in range(GRID.shape[1]):
+                for col_j in range(GRID.shape[0]):
+                    if row_i >= row_j and col_i == col_j: continue
+                    sep = '%d,%d' % (col_j-col_i, row_j-row_i)
+                    bls[sep] = bls.get(sep,[]) + [(GRID[col_i,row_i],GRID[col_j,row_j])]
+    return bls
+
+class TestRedIndex(unittest.TestCase):
+    def setUp(self):
+        self.layout = n.random.permutation(32).reshape(4,8)
+    def test_groups(self):
+        g = redindex.get_groups(self.layout, select='half')
+        self.assertEqual(len(g.i), 32*31/2)
+        self.assertTrue(n.all(g.i <= g.j))
+        self.assertTrue(redindex.get_groups(self.layout.copy(), select='half') is g)
+        self.assertFalse(redindex.get_groups(self.layout.T, select='half') is g)
+        # every baseline of a separation is the same offset on the grid
+        pos = dict([(ant,(r,c)) for (r,c),ant in n.ndenumerate(self.layout)])
+        for k in xrange(len(g.i)):
+            i,j = g.i[k], g.j[k]
+            if g.conj[k]: i,j = j,i
+            self.assertEqual(tuple(g.seps[g.sep_id[k]]), (pos[j][0]-pos[i][0], pos[j][1]-pos[i][1]))
+    def test_group_redundant_bls(self):
+        bls, conj = red.group_redundant_bls(self.layout)
+        bls0, conj0 = group_redundant_bls_loops(self.layout)
+        self.assertEqual(bls, bls0)
+        self.assertEqual(bls.keys(), bls0.keys()) # same iteration order
+        self.assertEqual(conj, conj0)
+        # callers may modify what they are given
+        del(bls['0,1'])
+        self.assertEqual(red.group_redundant_bls(self.layout)[0], bls0)
+    def test_dfm_grid2ij(self):
+        import capo.dfm as dfm
+        bls0 = grid2ij_loops(self.layout)
+        bl_str, bl_conj = dfm.grid2ij(self.layout)
+        self.assertEqual(sorted(bl_str.keys()), sorted([sep for sep in bls0 if len(bls0[sep]) > 1]))
+        for sep in bl_str:
+            self.assertEqual(bl_str[sep], ','.join(['%d_%d' % (min(i,j),max(i,j)) for i,j in bls0[sep]]))
+
+def mk_pairs(npairs, ntimes=4, nchan=128, seed=0):
+    n.random.seed(seed)
+    fqs = n.linspace(.1, .2, nchan)
+    taus = n.random.uniform(-30, 30, size=npairs)
+    offs = n.random.uniform(0, 1, size=npairs)
+    d1 = n.random.normal(size=(npairs,ntimes,nchan)) + 1j*n.random.normal(size=(npairs,ntimes,nchan))
+    d2 = d1 * n.exp(2j*n.pi*(n.outer(taus,fqs)+offs[:,None]))[:,None,:]
+    d2 += .1 * (n.random.normal(size=d2.shape) + 1j*n.random.normal(size=d2.shape))
+    w1 = n.ones(d1.shape); w2 = n.ones(d2.shape)
+    w1[:,:,:10] = 0 # flagged band edge
+    return d1, w1, d2, w2, fqs
+
+class TestRedundantBlCalBatch(unittest.TestCase):
+    def setUp(self):
+        self.d1, self.w1, self.d2, self.w2, self.fqs = mk_pairs(6)
+        self.w2[2] = 0 # a pair without weight
+    def check(self, use_offset, **kwargs):
+        gain, sol, info = red.redundant_bl_cal_batch(self.d1, self.w1, self.d2, self.w2, self.fqs, use_offset=use_offset, **kwargs)
+        for k in xrange(len(self.d1)):
+            ans = red.redundant_bl_cal(self.d1[k], self.w1[k], self.d2[k], self.w2[k], self.fqs, use_offset=use_offset)
+            if k == 2:
+                self.assertTrue(n.all(gain[k] == 0))
+                self.assertEqual(ans[1], 0)
+                if use_offset: self.assertEqual((sol[0][k],sol[1][k]), (0,0))
+                else: self.assertEqual(sol[k], 0)
+                continue
+            g, s, i = ans
+            n.testing.assert_allclose(gain[k], g, atol=1e-8)
+            if use_offset:
+                self.assertAlmostEqual(sol[0][k], s[0], 6)
+                self.assertAlmostEqual(sol[1][k], s[1], 6)
+            else: self.assertAlmostEqual(sol[k], s, 6)
+            self.assertEqual(info['mx'][k], i['mx'])
+            self.assertAlmostEqual(info['dtau'][k], i['dtau'], 6)
+        return gain, sol, info
+    def test_delay(self):
+        self.check(False)
+    def test_offset(self):
+        self.check(True)
+    def test_nproc(self):
+        gain, sol, info = self.check(True, nproc=3)
+        gain1, sol1, info1 = red.redundant_bl_cal_batch(self.d1, self.w1, self.d2, self.w2, self.fqs, use_offset=True)
+        n.testing.assert_allclose(gain, gain1)
+        n.testing.assert_allclose(sol, sol1)
+    def test_single_time(self):
+        d1, w1, d2, w2 = self.d1[:,0], self.w1[:,0], self.d2[:,0], self.w2[:,0]
+        gain, tau, info = red.redundant_bl_cal_batch(d1, w1, d2, w2, self.fqs)
+        for k in [0,1,3]:
+            g, t, i = red.redundant_bl_cal(d1[k], w1[k], d2[k], w2[k], self.fqs)
+            n.testing.assert_allclose(gain[k], g, atol=1e-8)
+            self.assertAlmostEqual(tau[k], t, 6)
+
+if __name__ == '__main__':
+    unittest.main()